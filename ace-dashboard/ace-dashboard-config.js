@@ -17,10 +17,6 @@ const ACE_DASHBOARD_CONFIG = {
     // wsBase: 'wss://moonraker.example.com',
     // wsBase: null, // null = автоматическое определение
     
-    // Интервал автоматического обновления статуса (в миллисекундах)
-    // По умолчанию: 5000 (5 секунд)
-    autoRefreshInterval: 5000,
-    
     // Таймаут для WebSocket переподключения (в миллисекундах)
     // По умолчанию: 3000 (3 секунды)
     wsReconnectTimeout: 3000,
@@ -2,6 +2,42 @@
 
 const { createApp } = Vue;
 
+// Apply an RFC 6902 patch (add/remove/replace) from ace_status_update.
+// The document is copied so Vue sees a fresh object.
+function applyJsonPatch(doc, patch) {
+    let result = JSON.parse(JSON.stringify(doc));
+    for (const op of patch || []) {
+        if (op.path === '') {
+            result = op.value;
+            continue;
+        }
+        const keys = op.path.split('/').slice(1)
+            .map(key => key.replace(/~1/g, '/').replace(/~0/g, '~'));
+        const last = keys.pop();
+        let target = result;
+        for (const key of keys) {
+            if (target === null || typeof target !== 'object' || !(key in target)) {
+                throw new Error(`Invalid patch path ${op.path}`);
+            }
+            target = target[key];
+        }
+        if (op.op === 'remove') {
+            if (Array.isArray(target)) {
+                target.splice(parseInt(last), 1);
+            } else {
+                delete target[last];
+            }
+        } else if (op.op === 'add' && Array.isArray(target)) {
+            target.splice(last === '-' ? target.length : parseInt(last), 0, op.value);
+        } else if (op.op === 'add' || op.op === 'replace') {
+            target[last] = op.value;
+        } else {
+            throw new Error(`Unsupported patch op ${op.op}`);
+        }
+    }
+    return result;
+}
+
 createApp({
     data() {
         return {
@@ -135,6 +171,14 @@ createApp({
             // Connection
             wsConnected: false,
             ws: null,
+            rpcId: 0,
+            rpcPending: {},
+
+            // Delta channel: snapshot from server.ace.snapshot plus patches
+            aceState: null,
+            aceVersion: null,
+            aceSeq: 0,
+            resyncPending: false,
             apiBase: ACE_DASHBOARD_CONFIG?.apiBase || window.location.origin,
             
             // Device Status
@@ -192,7 +236,6 @@ createApp({
     
     mounted() {
         this.connectWebSocket();
-        this.loadStatus();
         this.updateDocumentTitle();
         
     },
@@ -234,7 +277,7 @@ createApp({
             this.ws.onopen = () => {
                 this.wsConnected = true;
                 this.showNotification(this.t('notifications.websocketConnected'), 'success');
-                this.subscribeToStatus();
+                this.resyncStatus();
             };
             
             this.ws.onmessage = (event) => {
@@ -253,6 +296,12 @@ createApp({
             
             this.ws.onclose = () => {
                 this.wsConnected = false;
+                this.rejectPendingCalls();
+                // Patches are lost while disconnected; resync on reconnect
+                this.aceVersion = null;
+                if (!this.aceState) {
+                    this.loadStatus();
+                }
                 this.showNotification(this.t('notifications.websocketDisconnected'), 'error');
                 // Reconnect after configured timeout
                 const reconnectTimeout = ACE_DASHBOARD_CONFIG?.wsReconnectTimeout || 3000;
@@ -260,27 +309,82 @@ createApp({
             };
         },
         
-        subscribeToStatus() {
-            if (!this.ws || this.ws.readyState !== WebSocket.OPEN) return;
-            
-            this.ws.send(JSON.stringify({
-                jsonrpc: "2.0",
-                method: "printer.objects.subscribe",
-                params: {
-                    objects: {
-                        "ace": null
-                    }
-                },
-                id: 5434
-            }));
+        callMethod(method, params = {}) {
+            return new Promise((resolve, reject) => {
+                if (!this.ws || this.ws.readyState !== WebSocket.OPEN) {
+                    reject(new Error('WebSocket not connected'));
+                    return;
+                }
+                const id = ++this.rpcId;
+                this.rpcPending[id] = { resolve, reject };
+                this.ws.send(JSON.stringify({ jsonrpc: "2.0", method, params, id }));
+            });
         },
-        
+
+        rejectPendingCalls() {
+            for (const id of Object.keys(this.rpcPending)) {
+                this.rpcPending[id].reject(new Error('WebSocket closed'));
+            }
+            this.rpcPending = {};
+        },
+
+        // Load the full snapshot; patches continue from its version/seq
+        async resyncStatus() {
+            if (this.resyncPending) return;
+            this.resyncPending = true;
+            try {
+                const snapshot = await this.callMethod('server.ace.snapshot');
+                if (snapshot.error) {
+                    throw new Error(snapshot.error);
+                }
+                this.aceVersion = snapshot.version;
+                this.aceSeq = snapshot.seq;
+                this.aceState = snapshot.status;
+                this.updateStatus(this.aceState);
+            } catch (error) {
+                console.error('Error loading ACE snapshot:', error);
+            } finally {
+                this.resyncPending = false;
+            }
+        },
+
+        handleStatusPatch(message) {
+            if (!message || this.resyncPending) return;
+            if (message.version !== this.aceVersion || !this.aceState) {
+                this.resyncStatus();
+                return;
+            }
+            if (message.seq <= this.aceSeq) return;  // already applied
+            if (message.seq !== this.aceSeq + 1) {
+                // Gap in the sequence, a patch was missed
+                this.resyncStatus();
+                return;
+            }
+            try {
+                this.aceState = applyJsonPatch(this.aceState, message.patch);
+            } catch (error) {
+                console.error('Error applying ACE patch:', error);
+                this.resyncStatus();
+                return;
+            }
+            this.aceSeq = message.seq;
+            this.updateStatus(this.aceState);
+        },
+
         handleWebSocketMessage(data) {
-            if (data.method === "notify_status_update") {
-                const aceData = data.params[0]?.ace;
-                if (aceData) {
-                    this.updateStatus(aceData);
+            if (data.id !== undefined && this.rpcPending[data.id]) {
+                const pending = this.rpcPending[data.id];
+                delete this.rpcPending[data.id];
+                if (data.error) {
+                    pending.reject(new Error(data.error.message || 'RPC error'));
+                } else {
+                    pending.resolve(data.result);
                 }
+                return;
+            }
+
+            if (data.method === "notify_ace_status_update") {
+                this.handleStatusPatch(data.params?.[0]);
             }
 
             if (data.method === "notify_gcode_response") {
@@ -288,14 +392,6 @@ createApp({
 
                 if (!text) return;
 
-                // Look for your ACE_SET_SLOT response
-                if (text.includes("Slot") && text.includes("set:")) {
-                    console.log("ACE slot update detected:", text);
-
-                    // Just reload status once
-                    this.loadStatus();
-                }
-
                 // Filament position update
                 if (text.includes("ace_filament_pos set to")) {
                     const match = text.match(/ace_filament_pos set to (\w+)/);
@@ -354,7 +450,6 @@ createApp({
                 parseInt(hex.substring(2, 4), 16),
                 parseInt(hex.substring(4, 6), 16)
             ];
-            this.loadStatus();
             this.updateSlot(index, { color: rgb });
 
         },
@@ -379,7 +474,10 @@ createApp({
                     return;
                 }
 
-                this.loadStatus();
+                // With the websocket up the change arrives as a status patch
+                if (!this.wsConnected) {
+                    this.loadStatus();
+                }
                 console.log("Slot updated:", updates);
 
             } catch (e) {
@@ -389,6 +487,11 @@ createApp({
 
         // API Calls
         async loadStatus() {
+            if (this.wsConnected) {
+                await this.resyncStatus();
+                return;
+            }
+            // HTTP fallback while the websocket is down
             try {
                 const response = await fetch(`${this.apiBase}/server/ace/status`);
                 
@@ -554,8 +657,6 @@ createApp({
                 if (result.result) {
                     if (result.result.success !== false && !result.result.error) {
                         this.showNotification(this.t('notifications.commandSuccess', { command }), 'success');
-                        // Reload status after command
-                        setTimeout(() => this.loadStatus(), 1000);
                         return true;
                     } else {
                         const errorMsg = result.result.error || result.result.message || this.t('notifications.commandErrorGeneric');
@@ -566,7 +667,6 @@ createApp({
                 
                 // Если нет result, но и нет ошибки - считаем успехом
                 this.showNotification(this.t('notifications.commandSent', { command }), 'success');
-                setTimeout(() => this.loadStatus(), 1000);
                 return true;
             } catch (error) {
                 console.error('Error executing command:', error);
@@ -1,43 +1,334 @@
-import subprocess
+"""
+Static server for the ACE dashboard
+
+Serves ace-dashboard.html/js/css from memory with ETag/Last-Modified,
+gzip/brotli variants and cache headers, plus a /health endpoint.
+
+    python3 ace-dashboard.py                 # detach and serve on port 4410
+    python3 ace-dashboard.py --foreground    # serve in this process
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
 import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_PORT = 4410
+DEFAULT_DIRECTORY = "/usr/data/ace-dashboard"
+DEFAULT_PIDFILE = "/tmp/ace-dashboard.pid"
+INDEX_FILE = "ace-dashboard.html"
+
+CONTENT_TYPES = {
+    ".html": "text/html; charset=utf-8",
+    ".js": "application/javascript; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+    ".png": "image/png",
+    ".ico": "image/x-icon",
+}
+COMPRESSIBLE = (".html", ".js", ".css", ".svg", ".json")
+
+# HTML is always revalidated; assets it references get a ?v=<etag> suffix so
+# they can be cached for a long time and still change on every update
+HTML_CACHE_CONTROL = "no-cache"
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# How often the directory is checked for changed files
+RESCAN_INTERVAL = 2.0
+
+_ASSET_REF = re.compile(r'(src|href)="([^"/:?#]+)"')
+
+
+class Asset:
+    """One file held in memory with its compressed variants"""
 
-def run_http_server_in_background(port=4410, directory="/usr/data/ace-dashboard"):
+    def __init__(self, name, data, mtime, variants):
+        self.name = name
+        self.data = data
+        self.mtime = mtime
+        self.variants = variants  # encoding -> bytes
+        self.etag = '"%s"' % (hashlib.sha1(data).hexdigest()[:16],)
+        self.last_modified = formatdate(mtime, usegmt=True)
+        ext = os.path.splitext(name)[1].lower()
+        self.content_type = CONTENT_TYPES.get(ext, "application/octet-stream")
+        self.cache_control = (HTML_CACHE_CONTROL if ext == ".html"
+                              else ASSET_CACHE_CONTROL)
+
+    def select(self, accept_encoding):
+        """Return (encoding, body) for the client's Accept-Encoding"""
+        accepted = [part.split(";")[0].strip()
+                    for part in accept_encoding.lower().split(",")]
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.variants:
+                return encoding, self.variants[encoding]
+        return None, self.data
+
+
+class AssetCache:
+    """
+    In-memory copy of the dashboard directory
+    Files are read once and re-read only when their mtime changes
     """
-    Runs a simple Python http.server in the background.
 
-    Args:
-        port (int): The port number for the server.
-        directory (str): The directory to serve files from.
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.assets = {}
+        self.signature = None
+        self.last_scan = 0.
+        self.rescan(force=True)
+
+    def _scan_signature(self):
+        signature = {}
+        for name in os.listdir(self.directory):
+            ext = os.path.splitext(name)[1].lower()
+            if ext not in CONTENT_TYPES:
+                continue
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                signature[name] = (stat.st_mtime, stat.st_size)
+        return signature
+
+    def _read_variant(self, name, suffix, mtime):
+        """Pre-compressed file next to the original, if not stale"""
+        path = os.path.join(self.directory, name + suffix)
+        try:
+            if os.stat(path).st_mtime >= mtime:
+                with open(path, "rb") as f:
+                    return f.read()
+        except OSError:
+            pass
+        return None
+
+    def _variants(self, name, data, mtime, precompressed=True):
+        variants = {}
+        if not name.endswith(COMPRESSIBLE):
+            return variants
+        gz = self._read_variant(name, ".gz", mtime) if precompressed else None
+        variants["gzip"] = gz if gz is not None else gzip.compress(data, 9, mtime=0)
+        br = self._read_variant(name, ".br", mtime) if precompressed else None
+        if br is None and brotli is not None:
+            br = brotli.compress(data)
+        if br is not None:
+            variants["br"] = br
+        return variants
+
+    def rescan(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_scan < RESCAN_INTERVAL:
+            return
+        self.last_scan = now
+        signature = self._scan_signature()
+        if signature == self.signature:
+            return
+        files = {}
+        for name, (mtime, size) in signature.items():
+            with open(os.path.join(self.directory, name), "rb") as f:
+                files[name] = (f.read(), mtime)
+        assets = {}
+        for name, (data, mtime) in files.items():
+            if not name.endswith(".html"):
+                assets[name] = Asset(name, data, mtime,
+                                     self._variants(name, data, mtime))
+        # HTML is rewritten, so pre-compressed copies of it cannot be used
+        for name, (data, mtime) in files.items():
+            if name.endswith(".html"):
+                data = self._version_refs(data, assets)
+                assets[name] = Asset(name, data, mtime,
+                                     self._variants(name, data, mtime, False))
+        with self.lock:
+            self.assets = assets
+            self.signature = signature
+
+    @staticmethod
+    def _version_refs(data, assets):
+        """Append ?v=<etag> to local asset references in HTML"""
+        def replace(match):
+            asset = assets.get(match.group(2))
+            if asset is None:
+                return match.group(0)
+            return '%s="%s?v=%s"' % (match.group(1), match.group(2),
+                                     asset.etag.strip('"'))
+        return _ASSET_REF.sub(replace, data.decode("utf-8")).encode("utf-8")
+
+    def get(self, name):
+        self.rescan()
+        with self.lock:
+            return self.assets.get(name)
+
+    def __len__(self):
+        return len(self.assets)
+
+
+class DashboardHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "AceDashboard/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, code, headers, body=b"", head=False):
+        self.send_response(code)
+        for key, value in headers:
+            self.send_header(key, value)
+        if code != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and not head:
+            self.wfile.write(body)
+
+    def _health(self, head):
+        body = json.dumps({
+            "status": "ok",
+            "uptime": round(time.monotonic() - self.server.start_time, 1),
+            "assets": len(self.server.cache),
+            "brotli": brotli is not None,
+        }).encode("utf-8")
+        self._send(200, [("Content-Type", "application/json"),
+                         ("Cache-Control", "no-store")], body, head)
+
+    def _not_modified(self, asset):
+        etags = self.headers.get("If-None-Match")
+        if etags is not None:
+            return asset.etag in [tag.strip() for tag in etags.split(",")] or etags.strip() == "*"
+        since = self.headers.get("If-Modified-Since")
+        if since:
+            try:
+                return int(asset.mtime) <= parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _serve(self, head=False):
+        path = self.path.split("?", 1)[0].split("#", 1)[0]
+        if path == "/health":
+            self._health(head)
+            return
+        name = INDEX_FILE if path in ("", "/") else path.lstrip("/")
+        asset = None if "/" in name else self.server.cache.get(name)
+        if asset is None:
+            self._send(404, [("Content-Type", "text/plain")], b"Not found\n", head)
+            return
+
+        headers = [("ETag", asset.etag),
+                   ("Last-Modified", asset.last_modified),
+                   ("Cache-Control", asset.cache_control),
+                   ("Vary", "Accept-Encoding")]
+        if self._not_modified(asset):
+            self._send(304, headers, head=True)
+            return
+        encoding, body = asset.select(self.headers.get("Accept-Encoding", ""))
+        headers.append(("Content-Type", asset.content_type))
+        if encoding:
+            headers.append(("Content-Encoding", encoding))
+        self._send(200, headers, body, head)
+
+    def do_GET(self):
+        self._serve()
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+
+class DashboardServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, directory, verbose=False):
+        self.cache = AssetCache(directory)
+        self.verbose = verbose
+        self.start_time = time.monotonic()
+        super().__init__(address, DashboardHandler)
+
+
+def _running_pid(pidfile):
+    try:
+        with open(pidfile) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (OSError, ValueError):
+        return None
+
+
+def serve(port=DEFAULT_PORT, directory=DEFAULT_DIRECTORY, pidfile=None,
+          verbose=False):
+    """Serve the dashboard in this process until interrupted"""
+    server = DashboardServer(("0.0.0.0", port), directory, verbose)
+    if pidfile:
+        with open(pidfile, "w") as f:
+            f.write(str(os.getpid()))
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(
+        target=server.shutdown, daemon=True).start())
+    print(f"ACE dashboard on port {port}, serving {len(server.cache)} files from '{directory}'")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if pidfile and _running_pid(pidfile) == os.getpid():
+            os.unlink(pidfile)
+
+
+def run_http_server_in_background(port=DEFAULT_PORT, directory=DEFAULT_DIRECTORY,
+                                  pidfile=DEFAULT_PIDFILE):
+    """
+    Starts the dashboard server as a detached process
+
+    Does nothing if the process recorded in the pidfile is still running.
     """
-    # Change to the specified directory
-    os.chdir(directory)
-
-    # Command to run the http.server
-    # -m http.server starts the module
-    # port specifies the port
-    # --bind 0.0.0.0 makes it accessible from other devices on the network
-    command = ["python3", "-m", "http.server", str(port), "--bind", "0.0.0.0"]
-
-    # Use subprocess.Popen to run the command
-    # creationflags for Windows to detach the process (DETACHED_PROCESS)
-    # close_fds=True to close file descriptors in the child process
-    # stdout and stderr are redirected to DEVNULL to suppress output
+    pid = _running_pid(pidfile)
+    if pid is not None:
+        print(f"ACE dashboard already running (pid {pid}) on port {port}")
+        return
+
+    command = [sys.executable, os.path.abspath(__file__), "--foreground",
+               "--port", str(port), "--directory", directory,
+               "--pidfile", pidfile]
     if os.name == 'nt':  # For Windows
-        creationflags = subprocess.DETACHED_PROCESS
-        subprocess.Popen(command, creationflags=creationflags, close_fds=True,
-                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.Popen(command, creationflags=subprocess.DETACHED_PROCESS,
+                         close_fds=True, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
     else:  # For Unix-like systems (Linux, macOS)
-        # Use preexec_fn to set the process group ID, effectively detaching
-        # This is a common pattern for background processes on Unix-like systems
-        subprocess.Popen(command, preexec_fn=os.setsid, close_fds=True,
+        subprocess.Popen(command, start_new_session=True, close_fds=True,
                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
     print(f"HTTP server started in the background on port {port}, serving from '{directory}'")
 
-if __name__ == "__main__":
-    # Example usage: run server on port 8000 serving current directory
-    run_http_server_in_background(port=4410, directory="/usr/data/ace-dashboard")
 
-    # You can then continue with other operations in your script or close the terminal.
-    # The server will continue running.
-    # To stop it, you would need to find its process ID and terminate it manually.
+def main():
+    parser = argparse.ArgumentParser(description="ACE dashboard static server")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY)
+    parser.add_argument("--pidfile", default=DEFAULT_PIDFILE)
+    parser.add_argument("--foreground", action="store_true",
+                        help="serve in this process instead of detaching")
+    parser.add_argument("--verbose", action="store_true",
+                        help="log every request")
+    args = parser.parse_args()
+    if args.foreground:
+        serve(args.port, args.directory, args.pidfile, args.verbose)
+    else:
+        run_http_server_in_background(args.port, args.directory, args.pidfile)
+
+
+if __name__ == "__main__":
+    main()
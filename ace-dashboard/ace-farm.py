@@ -0,0 +1,752 @@
+"""
+Fleet view of the ACE units of many printers
+
+Keeps one websocket to the Moonraker of every printer, loads the
+ace_status snapshot once and then applies the notify_ace_status_update
+patches, the same way ace-dashboard.js does. Every loaded slot is filed
+by printer state, material, color name and remaining length, so a
+question like "which idle printer has black PETG loaded" is one dict
+lookup instead of a scan over the farm.
+
+    python3 ace-farm.py --printer k1-a=192.168.1.20 --printer k1-b=192.168.1.21:7125
+    python3 ace-farm.py --config farm.json --port 4411
+
+farm.json: {"printers": [{"name": "k1-a", "host": "192.168.1.20",
+                          "port": 7125, "api_key": "..."}]}
+
+Queries are answered over HTTP:
+
+    GET /farm/find?material=PETG&color=black&state=idle&min_remaining=50
+    GET /farm/printers?state=idle&dryer=drying
+    GET /farm/printers/<name>
+    GET /health
+
+Every printer needs the ace_status Moonraker component. Only the standard
+library is used.
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import functools
+import hashlib
+import json
+import logging
+import os
+import signal
+import struct
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DEFAULT_PORT = 4411
+DEFAULT_MOONRAKER_PORT = 7125
+# Printers connecting and loading their snapshot at the same time
+DEFAULT_MAX_CONNECTING = 16
+CONNECT_TIMEOUT = 10.
+RPC_TIMEOUT = 10.
+RECONNECT_MIN = 1.
+RECONNECT_MAX = 30.
+MAX_MESSAGE_SIZE = 4 * 1024 * 1024
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# print_stats state -> farm state, anything else is "unknown"
+PRINT_STATES = {
+    "standby": "idle",
+    "complete": "idle",
+    "cancelled": "idle",
+    "printing": "printing",
+    "paused": "paused",
+    "error": "error",
+}
+# Slots are also filed under every step their RFID length reaches (meters),
+# min_remaining queries then only filter the slots of the nearest step
+REMAINING_STEPS = (10, 50, 100, 200)
+ANY = "*"
+
+# Color names for the slot RGB values, matched to the nearest entry
+COLOR_NAMES = (
+    ("black", (0, 0, 0)),
+    ("white", (255, 255, 255)),
+    ("grey", (128, 128, 128)),
+    ("red", (220, 30, 30)),
+    ("orange", (250, 130, 20)),
+    ("yellow", (250, 220, 30)),
+    ("green", (40, 170, 60)),
+    ("blue", (30, 80, 220)),
+    ("purple", (130, 50, 180)),
+    ("pink", (245, 130, 190)),
+    ("brown", (120, 70, 30)),
+)
+
+
+class WebSocketError(Exception):
+    pass
+
+
+class RpcError(Exception):
+    pass
+
+
+# Websocket (RFC 6455), the part Moonraker needs ---------------------------
+
+def _mask(payload, key):
+    # XOR as one big integer, far faster than per byte in Python
+    n = len(payload)
+    stream = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(stream, "big")).to_bytes(n, "big")
+
+
+def encode_frame(opcode, payload, mask=True):
+    """One final frame; clients mask, servers do not"""
+    header = bytearray([0x80 | opcode])
+    mask_bit = 0x80 if mask else 0
+    length = len(payload)
+    if length < 126:
+        header.append(mask_bit | length)
+    elif length < 65536:
+        header.append(mask_bit | 126)
+        header += struct.pack("!H", length)
+    else:
+        header.append(mask_bit | 127)
+        header += struct.pack("!Q", length)
+    if not mask:
+        return bytes(header) + payload
+    key = os.urandom(4)
+    return bytes(header) + key + _mask(payload, key)
+
+
+async def read_frame(reader):
+    """(fin, opcode, payload) of the next frame"""
+    head = await reader.readexactly(2)
+    length = head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise WebSocketError("frame of %d bytes" % (length,))
+    key = await reader.readexactly(4) if head[1] & 0x80 else None
+    payload = await reader.readexactly(length)
+    if key is not None:
+        payload = _mask(payload, key)
+    return bool(head[0] & 0x80), head[0] & 0x0F, payload
+
+
+async def read_message(reader, writer, mask=True):
+    """Next data message, pings are answered; None once the peer closes"""
+    parts = []
+    while True:
+        fin, opcode, payload = await read_frame(reader)
+        if opcode == OP_PING:
+            writer.write(encode_frame(OP_PONG, payload, mask))
+            continue
+        if opcode == OP_PONG:
+            continue
+        if opcode == OP_CLOSE:
+            return None
+        if opcode != OP_CONTINUATION:
+            parts = []
+        parts.append(payload)
+        if fin:
+            return b"".join(parts)
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+
+
+async def ws_connect(host, port, path="/websocket", headers=None, timeout=CONNECT_TIMEOUT):
+    """Open a websocket, returns the (reader, writer) streams"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        key = base64.b64encode(os.urandom(16)).decode()
+        lines = ["GET %s HTTP/1.1" % (path,),
+                 "Host: %s:%d" % (host, port),
+                 "Upgrade: websocket",
+                 "Connection: Upgrade",
+                 "Sec-WebSocket-Key: %s" % (key,),
+                 "Sec-WebSocket-Version: 13"]
+        lines += ["%s: %s" % item for item in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        response = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        status, *fields = response.decode("latin-1").split("\r\n")
+        if status.split()[1:2] != ["101"]:
+            raise WebSocketError("upgrade refused: %s" % (status,))
+        received = dict((name.strip().lower(), value.strip())
+                        for name, _, value in (f.partition(":") for f in fields if f))
+        if received.get("sec-websocket-accept") != accept_key(key):
+            raise WebSocketError("bad Sec-WebSocket-Accept")
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+# Status mirror -------------------------------------------------------------
+
+def _unescape_pointer(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def apply_patch(doc, patch):
+    """Apply a json_diff() patch of ace_status.py in place, returns the new root"""
+    for op in patch:
+        if op["path"] == "":
+            doc = op.get("value")
+            continue
+        tokens = [_unescape_pointer(t) for t in op["path"].split("/")[1:]]
+        target = doc
+        for token in tokens[:-1]:
+            target = target[int(token)] if isinstance(target, list) else target[token]
+        last = tokens[-1]
+        if isinstance(target, list):
+            index = len(target) if last == "-" else int(last)
+            if op["op"] == "remove":
+                del target[index]
+            elif op["op"] == "add":
+                target.insert(index, op["value"])
+            else:
+                target[index] = op["value"]
+        elif op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = op["value"]
+    return doc
+
+
+@functools.lru_cache(maxsize=4096)
+def color_name(rgb):
+    """Nearest entry of COLOR_NAMES, weighted for perceived difference"""
+    r, g, b = rgb
+    best, best_distance = None, None
+    for name, (cr, cg, cb) in COLOR_NAMES:
+        mean_r = (r + cr) / 2.
+        distance = ((2 + mean_r / 256) * (r - cr) ** 2 + 4 * (g - cg) ** 2
+                    + (2 + (255 - mean_r) / 256) * (b - cb) ** 2)
+        if best_distance is None or distance < best_distance:
+            best, best_distance = name, distance
+    return best
+
+
+def color_key(value):
+    """Color name from a name, #rrggbb or r,g,b"""
+    text = str(value).strip().lower()
+    if text.startswith("#") and len(text) == 7:
+        return color_name(tuple(int(text[i:i + 2], 16) for i in (1, 3, 5)))
+    if "," in text:
+        return color_name(tuple(int(v) for v in text.split(",")))
+    return "grey" if text == "gray" else text
+
+
+def material_key(value):
+    return str(value or "").strip().upper() or "UNKNOWN"
+
+
+SlotInfo = collections.namedtuple(
+    "SlotInfo", "printer slot material color rgb remaining")
+
+
+def slot_infos(name, status):
+    """SlotInfo of every loaded slot in an ace_status dashboard view"""
+    infos = []
+    for entry in (status or {}).get("slots") or ():
+        if not isinstance(entry, dict) or entry.get("status") != "ready":
+            continue
+        rgb = entry.get("color")
+        if isinstance(rgb, list) and len(rgb) == 3:
+            rgb = tuple(int(v) for v in rgb)
+            color = color_name(rgb)
+        else:
+            rgb, color = None, "unknown"
+        remaining = entry.get("current")
+        if not isinstance(remaining, (int, float)) or remaining <= 0:
+            remaining = None
+        infos.append(SlotInfo(name, entry.get("index"), material_key(entry.get("type")),
+                              color, rgb, remaining))
+    return infos
+
+
+class FarmIndex:
+    """
+    Loaded slots of all printers by state, material, color and length
+
+    Each slot is filed under every combination of its values and ANY, so
+    any query is one dict lookup. A printer is refiled as a whole (at most
+    four slots) whenever anything about it changes.
+    """
+
+    def __init__(self):
+        self.slots = {}           # (printer, slot) -> SlotInfo
+        self.printers = {}        # printer -> (state, dryer)
+        self._by_slot = {}        # (state, material, color, step) -> {(printer, slot)}
+        self._by_printer = {}     # ("state" | "dryer", value) -> {printer}
+        self._slot_keys = {}      # printer -> [(key, member)] to unfile
+
+    def update(self, name, state, dryer, infos):
+        self.remove(name)
+        keys = []
+        for info in infos:
+            member = (name, info.slot)
+            self.slots[member] = info
+            steps = [0]
+            if info.remaining is not None:
+                steps += [step for step in REMAINING_STEPS if info.remaining >= step]
+            for s in (state, ANY):
+                for m in (info.material, ANY):
+                    for c in (info.color, ANY):
+                        for step in steps:
+                            key = (s, m, c, step)
+                            self._by_slot.setdefault(key, set()).add(member)
+                            keys.append((key, member))
+        self._slot_keys[name] = keys
+        self.printers[name] = (state, dryer)
+        self._by_printer.setdefault(("state", state), set()).add(name)
+        self._by_printer.setdefault(("dryer", dryer), set()).add(name)
+
+    def remove(self, name):
+        for key, member in self._slot_keys.pop(name, ()):
+            members = self._by_slot[key]
+            members.discard(member)
+            if not members:
+                del self._by_slot[key]
+            self.slots.pop(member, None)
+        old = self.printers.pop(name, None)
+        if old is not None:
+            for key in (("state", old[0]), ("dryer", old[1])):
+                members = self._by_printer[key]
+                members.discard(name)
+                if not members:
+                    del self._by_printer[key]
+
+    def find(self, material=None, color=None, state=None, min_remaining=None):
+        """SlotInfo of the loaded slots matching every given value"""
+        step = 0
+        if min_remaining:
+            step = max([0] + [s for s in REMAINING_STEPS if s <= min_remaining])
+        key = (state or ANY,
+               material_key(material) if material else ANY,
+               color_key(color) if color else ANY,
+               step)
+        infos = [self.slots[member] for member in self._by_slot.get(key, ())]
+        if min_remaining and min_remaining > step:
+            # Slots of the step with less than asked, or no RFID length at all
+            infos = [info for info in infos
+                     if info.remaining is not None and info.remaining >= min_remaining]
+        return infos
+
+    def find_printers(self, state=None, dryer=None):
+        """Names of the printers in this state with the dryer in this state"""
+        if state is None and dryer is None:
+            return set(self.printers)
+        if dryer is None:
+            return set(self._by_printer.get(("state", state), ()))
+        by_dryer = self._by_printer.get(("dryer", dryer), set())
+        if state is None:
+            return set(by_dryer)
+        return by_dryer & self._by_printer.get(("state", state), set())
+
+
+# Printers ------------------------------------------------------------------
+
+class PrinterLink:
+    """
+    One printer: its websocket, the JSON-RPC calls on it and the ACE state
+    mirrored from it. Reconnects with backoff until the farm stops.
+    """
+
+    def __init__(self, farm, name, host, port=DEFAULT_MOONRAKER_PORT, api_key=None):
+        self.farm = farm
+        self.name = name
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.connected = False
+        self.klippy_state = "disconnected"
+        self.print_state = "unknown"
+        self.status = None
+        self.version = None
+        self.seq = 0
+        self.error = None
+        self.updates = 0
+        self.resyncs = 0
+        self.reconnects = 0
+        self.last_update = None
+        self._writer = None
+        self._pending = {}
+        self._next_id = 0
+        self._task = None
+        self._sync_task = None
+
+    @property
+    def state(self):
+        if not self.connected or self.klippy_state != "ready" or self.status is None:
+            return "offline"
+        return PRINT_STATES.get(self.print_state, "unknown")
+
+    @property
+    def dryer(self):
+        dryer = (self.status or {}).get("dryer")
+        return dryer.get("status", "unknown") if isinstance(dryer, dict) else "unknown"
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                await self._session()
+                delay = RECONNECT_MIN
+            except (OSError, EOFError, ValueError, KeyError, asyncio.TimeoutError,
+                    WebSocketError, RpcError) as e:
+                self.error = str(e) or type(e).__name__
+                logging.info("%s: %s", self.name, self.error)
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    async def _session(self):
+        headers = {"X-Api-Key": self.api_key} if self.api_key else None
+        reader_task = None
+        try:
+            async with self.farm.connect_limit:
+                reader, self._writer = await ws_connect(self.host, self.port, headers=headers)
+                reader_task = asyncio.ensure_future(self._read_loop(reader))
+                self.connected = True
+                await self._sync()
+                self.error = None
+            await reader_task
+        finally:
+            if reader_task is not None:
+                reader_task.cancel()
+            if self._sync_task is not None:
+                self._sync_task.cancel()
+                self._sync_task = None
+            self._fail_pending()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            self.connected = False
+            self.farm.refile(self)
+
+    async def call(self, method, params=None):
+        """JSON-RPC request on this printer's websocket"""
+        if self._writer is None:
+            raise EOFError("not connected")
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        message = {"jsonrpc": "2.0", "method": method, "id": request_id}
+        if params is not None:
+            message["params"] = params
+        self._writer.write(encode_frame(OP_TEXT, json.dumps(message).encode()))
+        try:
+            return await asyncio.wait_for(future, RPC_TIMEOUT)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def _fail_pending(self):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(EOFError("connection closed"))
+        self._pending.clear()
+
+    async def _read_loop(self, reader):
+        try:
+            await self._read_messages(reader)
+        finally:
+            # Calls still waiting would otherwise run into RPC_TIMEOUT
+            self._fail_pending()
+
+    async def _read_messages(self, reader):
+        while True:
+            data = await read_message(reader, self._writer)
+            if data is None:
+                return
+            message = json.loads(data)
+            if "id" in message:
+                future = self._pending.get(message["id"])
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    error = message["error"]
+                    future.set_exception(RpcError(error.get("message", str(error))
+                                                  if isinstance(error, dict) else str(error)))
+                else:
+                    future.set_result(message.get("result"))
+            elif "method" in message:
+                self._notify(message["method"], message.get("params") or [])
+
+    async def _sync(self):
+        """Klippy state, print state and the ACE snapshot, from scratch"""
+        info = await self.call("server.info")
+        self.klippy_state = info.get("klippy_state", "disconnected")
+        if self.klippy_state == "ready":
+            result = await self.call("printer.objects.subscribe",
+                                     {"objects": {"print_stats": ["state"]}})
+            self._set_print_state(result.get("status", {}))
+            snapshot = await self.call("server.ace.snapshot")
+            if "error" in snapshot:
+                raise RpcError(snapshot["error"])
+            self.status = snapshot["status"]
+            self.version = snapshot["version"]
+            self.seq = snapshot["seq"]
+        self.farm.refile(self)
+
+    def _resync(self):
+        if self._sync_task is not None and not self._sync_task.done():
+            return
+        self.resyncs += 1
+        self.status = None
+        self._sync_task = asyncio.ensure_future(self._run_resync())
+
+    async def _run_resync(self):
+        try:
+            await self._sync()
+        except (EOFError, asyncio.TimeoutError, RpcError) as e:
+            self.error = str(e) or type(e).__name__
+            if self._writer is not None:
+                # Start over with a new connection
+                self._writer.close()
+
+    def _set_print_state(self, status):
+        state = (status.get("print_stats") or {}).get("state")
+        if state is not None:
+            self.print_state = state
+
+    def _notify(self, method, params):
+        if method == "notify_ace_status_update":
+            self._apply(params[0] if params else None)
+        elif method == "notify_status_update":
+            old = self.print_state
+            self._set_print_state(params[0] if params else {})
+            if self.print_state != old:
+                self.farm.refile(self)
+        elif method == "notify_klippy_ready":
+            self._resync()
+        elif method in ("notify_klippy_shutdown", "notify_klippy_disconnected"):
+            self.klippy_state = method[len("notify_klippy_"):]
+            self.farm.refile(self)
+
+    def _apply(self, message):
+        """Same rules as handleStatusPatch() in ace-dashboard.js"""
+        if not message or self.status is None:
+            return
+        if message.get("version") != self.version:
+            self._resync()
+            return
+        seq = message.get("seq", 0)
+        if seq <= self.seq:
+            return
+        if seq != self.seq + 1:
+            # A patch was missed
+            self._resync()
+            return
+        try:
+            self.status = apply_patch(self.status, message.get("patch") or [])
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            logging.info("%s: bad patch %s", self.name, e)
+            self._resync()
+            return
+        self.seq = seq
+        self.updates += 1
+        self.last_update = time.time()
+        self.farm.refile(self)
+
+    def summary(self):
+        status = self.status or {}
+        return {
+            "name": self.name,
+            "host": "%s:%d" % (self.host, self.port),
+            "state": self.state,
+            "klippy_state": self.klippy_state,
+            "print_state": self.print_state,
+            "ace_status": status.get("status", "unknown"),
+            "dryer": self.dryer,
+            "current_index": status.get("current_index", -1),
+            "filament_pos": status.get("filament_pos", "unknown"),
+            "slots": [info._asdict() for info in slot_infos(self.name, self.status)],
+            "updates": self.updates,
+            "resyncs": self.resyncs,
+            "reconnects": self.reconnects,
+            "last_update": self.last_update,
+            "error": self.error,
+        }
+
+
+class Farm:
+    """The printers and the index built from their mirrored state"""
+
+    def __init__(self, max_connecting=DEFAULT_MAX_CONNECTING):
+        self.printers = collections.OrderedDict()
+        self.index = FarmIndex()
+        self.connect_limit = asyncio.Semaphore(max_connecting)
+        # Called with the PrinterLink after it was refiled
+        self.listeners = []
+        self.start_time = time.monotonic()
+
+    def add_printer(self, name, host, port=DEFAULT_MOONRAKER_PORT, api_key=None):
+        if name in self.printers:
+            raise ValueError("duplicate printer %s" % (name,))
+        link = PrinterLink(self, name, host, port, api_key)
+        self.printers[name] = link
+        return link
+
+    def start(self):
+        for link in self.printers.values():
+            link.start()
+
+    async def stop(self):
+        await asyncio.gather(*(link.stop() for link in self.printers.values()))
+
+    def refile(self, link):
+        self.index.update(link.name, link.state, link.dryer,
+                          slot_infos(link.name, link.status))
+        for listener in self.listeners:
+            listener(link)
+
+    def find(self, material=None, color=None, state=None, min_remaining=None):
+        return self.index.find(material, color, state, min_remaining)
+
+    def summary(self):
+        states = collections.Counter(link.state for link in self.printers.values())
+        return {
+            "printers": len(self.printers),
+            "states": dict(states),
+            "loaded_slots": len(self.index.slots),
+            "uptime": round(time.monotonic() - self.start_time, 1),
+        }
+
+
+# HTTP queries --------------------------------------------------------------
+
+def _query_float(query, name):
+    value = query.get(name)
+    return float(value) if value not in (None, "") else None
+
+
+def handle_query(farm, path, query):
+    """(status code, JSON body) of a GET request"""
+    if path == "/health":
+        return 200, dict(farm.summary(), status="ok")
+    if path == "/farm/find":
+        infos = farm.find(query.get("material"), query.get("color"),
+                          query.get("state"), _query_float(query, "min_remaining"))
+        # Fullest spools first, unknown lengths last
+        infos.sort(key=lambda i: (i.remaining is None, -(i.remaining or 0), i.printer, i.slot))
+        limit = _query_float(query, "limit")
+        if limit is not None:
+            infos = infos[:int(limit)]
+        return 200, {"count": len(infos), "matches": [info._asdict() for info in infos]}
+    if path == "/farm/printers":
+        names = farm.index.find_printers(query.get("state"), query.get("dryer"))
+        return 200, {"printers": [farm.printers[name].summary()
+                                  for name in farm.printers if name in names]}
+    if path.startswith("/farm/printers/"):
+        link = farm.printers.get(unquote(path[len("/farm/printers/"):]))
+        if link is None:
+            return 404, {"error": "unknown printer"}
+        return 200, link.summary()
+    return 404, {"error": "not found"}
+
+
+async def _http_client(farm, reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), CONNECT_TIMEOUT)
+        method, target = request.decode("latin-1").split("\r\n", 1)[0].split()[:2]
+        if method not in ("GET", "HEAD"):
+            code, body = 405, {"error": "method not allowed"}
+        else:
+            url = urlsplit(target)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                code, body = handle_query(farm, url.path, query)
+            except ValueError as e:
+                code, body = 400, {"error": str(e)}
+        data = json.dumps(body).encode()
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                      "Content-Length: %d\r\nCache-Control: no-store\r\n"
+                      "Connection: close\r\n\r\n"
+                      % (code, "OK" if code == 200 else "Error", len(data))).encode())
+        if method != "HEAD":
+            writer.write(data)
+        await writer.drain()
+    except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+def load_printers(args):
+    """(name, host, port, api_key) from --config and --printer"""
+    printers = []
+    if args.config:
+        with open(args.config) as f:
+            for entry in json.load(f).get("printers", []):
+                printers.append((entry["name"], entry["host"],
+                                 int(entry.get("port", DEFAULT_MOONRAKER_PORT)),
+                                 entry.get("api_key")))
+    for spec in args.printer or ():
+        name, _, address = spec.partition("=")
+        host, _, port = address.partition(":")
+        if not name or not host:
+            raise SystemExit("invalid --printer %r, expected NAME=HOST[:PORT]" % (spec,))
+        printers.append((name, host, int(port or DEFAULT_MOONRAKER_PORT), args.api_key))
+    return printers
+
+
+async def serve(printers, port=DEFAULT_PORT, max_connecting=DEFAULT_MAX_CONNECTING):
+    farm = Farm(max_connecting)
+    for name, host, printer_port, api_key in printers:
+        farm.add_printer(name, host, printer_port, api_key)
+    farm.start()
+    server = await asyncio.start_server(
+        functools.partial(_http_client, farm), "0.0.0.0", port)
+    print("ACE farm on port %d, following %d printers" % (port, len(farm.printers)))
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await farm.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ACE status of a printer farm")
+    parser.add_argument("--printer", action="append", metavar="NAME=HOST[:PORT]")
+    parser.add_argument("--config", help="JSON file with a printers list")
+    parser.add_argument("--api-key", help="Moonraker API key of the --printer entries")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-connecting", type=int, default=DEFAULT_MAX_CONNECTING,
+                        help="printers connecting at the same time")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    printers = load_printers(args)
+    if not printers:
+        parser.error("no printers, use --printer or --config")
+    asyncio.run(serve(printers, args.port, args.max_connecting))
+
+
+if __name__ == "__main__":
+    main()
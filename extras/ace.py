@@ -1,6 +1,9 @@
-import serial, threading, time, logging, json, struct, queue, traceback, re
+import serial, threading, time, logging, json, struct, queue, traceback, re, os, collections, bisect, itertools, math
 from serial import SerialException
-import serial.tools.list_ports
+
+# Seconds of extruder motion per queued move, and queued ahead, in a synchronized unload
+SYNC_UNLOAD_CHUNK = 0.5
+SYNC_UNLOAD_LEAD = 1.
 
 class BunnyAce:
     def __init__(self, config):
@@ -22,6 +25,10 @@ class BunnyAce:
 
         self.serial_name = config.get('serial', '/dev/ttyACM0')
         self.baud = config.getint('baud', 115200)
+        # Retry interval while the ACE is absent, device nodes are also watched with inotify
+        self.connect_interval = config.getfloat('connect_interval', 1., minval=0.1)
+        # Toolchanges wait this long for the startup handshake after a (re)connect
+        self.startup_timeout = config.getfloat('startup_timeout', 10., minval=0.)
         splitter_sensor_pin = config.get('splitter_sensor_pin', None)
         extruder_sensor_pin = config.get('extruder_sensor_pin', None)
         toolhead_sensor_pin = config.get('toolhead_sensor_pin', None)
@@ -33,8 +40,26 @@ class BunnyAce:
         self.toolhead_sensor_to_nozzle_length = config.getint('toolhead_sensor_to_nozzle', 50)
         # self.extruder_to_blade_length = config.getint('extruder_to_blade', None)
         self.bowden_tube_length = config.getint('bowden_tube_length', 2000)
+        # Look-ahead staging: mm the next tool is fed from its parked position
+        # while the current one prints, must stop short of the splitter
+        self.prestage_length = config.getint('prestage_length', 0, minval=0,
+                                             maxval=self.toolchange_load_length)
+        self.prestage_speed = config.getint('prestage_speed', self.feed_speed, minval=1)
+        self.prestage_auto = config.getboolean('prestage_auto', True)
+        # Sensor-terminated feeds slow down this far before the expected trigger (0 disables)
+        self.sensor_slow_length = config.getint('sensor_slow_length', 0, minval=0)
+        self.sensor_slow_speed = config.getint('sensor_slow_speed', 10, minval=1)
+        # Unload with extruder and ACE pulling together until the extruder sensor clears
+        self.sync_unload = config.getboolean('sync_unload', False)
+        self.sync_unload_speed = config.getint('sync_unload_speed', 10, minval=1)
+        self.sync_unload_length = config.getint('sync_unload_length', 150, minval=1)
+        # (sensor, slot) -> mm the last sensor-terminated feed took
+        self._sensor_distances = {}
 
         self.max_dryer_temperature = config.getint('max_dryer_temperature', 55)
+        self.profiler = AceProfiler(self, config)
+        self.metrics = AceMetrics(self)
+        self.dryer = AceDryer(self, config)
 
         # Endless spool configuration - load from persistent variables if available
         saved_endless_spool_enabled = self.variables.get('ace_endless_spool_enabled', False)
@@ -45,23 +70,35 @@ class BunnyAce:
         self.model = 'Unknown'
         self.firmware = 'Unknown'
         self.boot_firmware = 'Unknown'
-        self.printer.register_event_handler(
-            "klippy:ready",
-            self._load_device_info
-        )
+        # Set once get_info, get_status and the RFID slots' info arrived after a connect
+        self._device_ready = False
+        self._ready_waiters = []
+        self._startup_begin = None
+        self._handshake_pending = None
+        self._handshake_timer = None
+        self._device_watcher = None
         self._callback_map = {}
         self._request_id = 0
         self.park_hit_count = 5
         self._feed_assist_index = -1
         self._request_id = 0
+        # Feed assist counter baseline and consecutive alert hits (AceAssistMonitor)
         self._last_assist_count = 0
         self._assist_hit_count = 0
         self._park_in_progress = False
         self._park_is_toolchange = False
         self._park_previous_tool = -1
         self._park_index = -1
+        # Per-phase timing of the running and the last finished toolchange
+        self._toolchange_timing = None
+        self._toolchange_stats = None
+        # Last ACE_BATCH_MARK of a Moonraker command batch
+        self._batch_mark = None
         self.endstops = {}
-        self._queue = queue.Queue(maxsize=self._max_queue_size)
+        self._queue = AceRequestQueue(self._max_queue_size)
+        self.assist_monitor = AceAssistMonitor(self, config)
+        self.assist_sync = AceAssistSync(self, config)
+        self.capture = AceCapture(self, config)
 
         # Default data to prevent exceptions
         self._info = {
@@ -89,19 +126,26 @@ class BunnyAce:
                 } for i in range(4)]
         }
 
-        # Add inventory for 4 slots - load from persistent variables if available
-        saved_inventory = self.variables.get('ace_inventory', None)
-        if saved_inventory:
-            self.inventory = saved_inventory
-        else:
-            self.inventory = [
-                {"index": i, "status": "empty", "color": [0, 0, 0], "type": "", "temp": 0, "sku": "", "rfid": "0"} for i in range(4)
-            ]
+        # Inventory and polled state of the 4 slots - load from persistent variables if available
+        self.slots = [AceSlot(i) for i in range(4)]
+        load_inventory(self.slots, self.variables.get('ace_inventory', None),
+                       self.variables.get('ace_inventory_version', 1))
+        self._inventory_save_pending = False
+        self.filament_cache = AceFilamentCache(self)
+        # slot -> mm fed ahead of its toolchange, survives restarts
+        self._staged = {int(k): v for k, v in (self.variables.get('ace_staged') or {}).items()}
+        self.printer.register_event_handler('ace:status_update', self._check_staged_slots)
+        self.planner = AceJobPlanner(self)
+        self.costs = AceToolchangeCosts(self, config)
         # Register inventory commands
         self.gcode.register_command(
             'ACE_SET_SLOT', self.cmd_ACE_SET_SLOT,
             desc="Set slot inventory: INDEX= COLOR= TYPE= TEMP= SKU= RFID= | Set status to empty with EMPTY=1"
         )
+        self.gcode.register_command(
+            'ACE_UPDATE_SLOT', self.cmd_ACE_UPDATE_SLOT,
+            desc=self.cmd_ACE_UPDATE_SLOT_help
+        )
         self.gcode.register_command(
             'ACE_QUERY_SLOTS', self.cmd_ACE_QUERY_SLOTS,
             desc="Query all slot inventory as JSON"
@@ -110,8 +154,11 @@ class BunnyAce:
         self._create_mmu_sensor(config, splitter_sensor_pin, "splitter_sensor")
         self._create_mmu_sensor(config, extruder_sensor_pin, "extruder_sensor")
         self._create_mmu_sensor(config, toolhead_sensor_pin, "toolhead_sensor")
+        self.sensors = AceSensorManager(self)
         self.printer.register_event_handler('klippy:ready', self._handle_ready)
         self.printer.register_event_handler('klippy:disconnect', self._handle_disconnect)
+        # After _handle_ready, recovery queries the sensors through the toolhead
+        self.journal = AceJournal(self, config)
         self.gcode.register_command(
             'ACE_DEBUG', self.cmd_ACE_DEBUG,
             desc='self.cmd_ACE_DEBUG_help')
@@ -164,7 +211,17 @@ class BunnyAce:
             'ACE_STATUS', self.cmd_ACE_STATUS,
             desc=self.cmd_ACE_STATUS_help)
         self.gcode.register_command(
-            'ACE_FILAMENT_INFO', self.cmd_ACE_FILAMENT_INFO),
+            'ACE_FEED_TO_SENSOR', self.cmd_ACE_FEED_TO_SENSOR,
+            desc=self.cmd_ACE_FEED_TO_SENSOR_help)
+        self.gcode.register_command(
+            'ACE_PREPARE_TOOL', self.cmd_ACE_PREPARE_TOOL,
+            desc=self.cmd_ACE_PREPARE_TOOL_help)
+        self.gcode.register_command(
+            'ACE_FILAMENT_INFO', self.cmd_ACE_FILAMENT_INFO,
+            desc='Show RFID filament info of a slot: INDEX= [REFRESH=1]'),
+        self.gcode.register_command(
+            'ACE_BATCH_MARK', self.cmd_ACE_BATCH_MARK,
+            desc=self.cmd_ACE_BATCH_MARK_help)
 
     def _calc_crc(self, buffer):
         _crc = 0xffff
@@ -188,6 +245,8 @@ class BunnyAce:
         data += payload
         data += struct.pack('@H', self._calc_crc(payload))
         data += bytes([0xFE])
+        self.capture.record(CAPTURE_TX, data)
+        self.metrics.request_sent(request, len(data))
         self._serial.write(data)
 
     def _reader(self, eventtime):
@@ -195,6 +254,7 @@ class BunnyAce:
         if self.lock and (self.reactor.monotonic() - self.send_time) > 2:
             self.lock = False
             self.read_buffer = bytearray()
+            self.metrics.frame_error('timeout')
             self.gcode.respond_info(f"timeout {self.reactor.monotonic()}")
 
         buffer = bytearray()
@@ -205,10 +265,12 @@ class BunnyAce:
             self.lock = False
             self.gcode.respond_info('Try reconnecting')
             self._serial_disconnect()
-            self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
+            self.connect_timer = self.profiler.register_timer('connect', self._connect, self.reactor.NOW)
             return self.reactor.NEVER
 
         if len(raw_bytes):
+            self.capture.record(CAPTURE_RX, raw_bytes)
+            self.metrics.bytes_in += len(raw_bytes)
             text_buffer = self.read_buffer + raw_bytes
             i = text_buffer.find(b'\xfe')
             if i >= 0:
@@ -226,12 +288,12 @@ class BunnyAce:
 
         if buffer[0:2] != bytes([0xFF, 0xAA]):
             self.lock = False
+            self.metrics.frame_error('header')
             self.gcode.respond_info("Invalid data from ACE PRO (head bytes)")
             self.gcode.respond_info(str(buffer))
             return eventtime + 0.1
 
         payload_len = struct.unpack('<H', buffer[2:4])[0]
-#        logging.info(str(buffer))
         payload = buffer[4:4 + payload_len]
 
         crc_data = buffer[4 + payload_len:4 + payload_len + 2]
@@ -239,28 +301,40 @@ class BunnyAce:
 
         if len(buffer) < (4 + payload_len + 2 + 1):
             self.lock = False
+            self.metrics.frame_error('length')
             self.gcode.respond_info(f"Invalid data from ACE PRO (len) {payload_len} {len(buffer)} {crc}")
             self.gcode.respond_info(str(buffer))
             return eventtime + 0.1
 
         if crc_data != crc:
             self.lock = False
+            self.metrics.frame_error('crc')
             self.gcode.respond_info('Invalid data from ACE PRO (CRC)')
 
-        ret = json.loads(payload.decode('utf-8'))
+        try:
+            ret = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            self.lock = False
+            self.metrics.frame_error('json')
+            self.gcode.respond_info('Invalid data from ACE PRO (JSON)')
+            return eventtime + 0.1
         id = ret['id']
+        self.metrics.response_received(id)
         if id in self._callback_map:
             callback = self._callback_map.pop(id)
-            callback(self=self, response=ret)
+            callback(self, ret)
             self.lock = False
+            if not self._queue.empty():
+                self.reactor.update_timer(self.writer_timer, self.reactor.NOW)
+        else:
+            self.metrics.frame_error('unknown_id')
         return eventtime + 0.1
 
     def _writer(self, eventtime):
 
         try:
             def callback(self, response):
-                if response is not None:
-                    self._info = response['result']
+                self._handle_status_response(response)
 
             if not self.lock:
                 if not self._queue.empty():
@@ -286,31 +360,48 @@ class BunnyAce:
             self.lock = False
             self.gcode.respond_info('Try reconnecting')
             self._serial_disconnect()
-            self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
+            self.connect_timer = self.profiler.register_timer('connect', self._connect, self.reactor.NOW)
             return self.reactor.NEVER
         except Exception as e:
             self.gcode.respond_info(str(e))
             logging.info('ACE: Write error ' + str(e))
         return eventtime + 0.5
 
+    def _handle_status_response(self, response):
+        if response is not None:
+            self._info = response['result']
+            for slot in self._info.get('slots', ()):
+                index = slot.get('index')
+                if isinstance(index, int) and 0 <= index < 4:
+                    self.slots[index].update_from_poll(slot)
+            # Wake listeners (temperature_ace sensor hub) with the new snapshot
+            self.printer.send_event("ace:status_update", self._info)
+
     def _handle_ready(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         logging.info('ACE: Connecting to ' + self.serial_name)
+        self._startup_begin = self.reactor.monotonic()
         # We can catch timing where ACE reboots itself when no data is available from host. We're avoiding it with this hack
         self._connected = False
-        self._queue = queue.Queue()
+        self._queue = AceRequestQueue(self._max_queue_size)
         self._main_queue = queue.Queue()
-        self.connect_timer = self.reactor.register_timer(self._connect, self.reactor.NOW)
+        self.connect_timer = self.profiler.register_timer('connect', self._connect, self.reactor.NOW)
         # Start endless spool monitoring timer
         if hasattr(self, 'endless_spool_enabled'):
-            self.endless_spool_timer = self.reactor.register_timer(self._endless_spool_monitor, self.reactor.NOW)
+            self.endless_spool_timer = self.profiler.register_timer(
+                'endless_spool', self._endless_spool_monitor, self.reactor.NOW)
             # Hook into gcode move events for broader extruder monitoring
             self.printer.register_event_handler('toolhead:move', self._on_toolhead_move)
 
 
     def _handle_disconnect(self):
         logging.info('ACE: Closing connection to ' + self.serial_name)
-        self._serial.close()
+        self._stop_device_watch()
+        if self._handshake_timer is not None:
+            self.reactor.unregister_timer(self._handshake_timer)
+            self._handshake_timer = None
+        if self._serial is not None:
+            self._serial.close()
         self._connected = False
         self.reactor.unregister_timer(self.writer_timer)
         self.reactor.unregister_timer(self.reader_timer)
@@ -325,9 +416,36 @@ class BunnyAce:
         currTs = self.reactor.monotonic()
         self.reactor.pause(currTs + delay)
 
-    def send_request(self, request, callback):
+    def send_request(self, request, callback, merge=True):
+        """
+        Queue a request for the writer, False if the queue is full
+
+        With merge=False the request is neither merged into an identical
+        queued one nor allowed to drop queued requests it supersedes.
+        """
+        result = self._queue.put(request, callback, merge)
+        if result == QUEUE_FULL:
+            self.metrics.queue_rejected += 1
+            logging.warning('ACE: Request queue full, dropped ' + str(request.get('method')))
+            self.gcode.respond_info('ACE: Request queue full (%d), dropped %s'
+                                    % (self._queue.maxsize, request.get('method')))
+            return False
         self._info['status'] = 'busy'
-        self._queue.put([request, callback])
+        if result == QUEUE_ADDED and self._connected and not self.lock:
+            # Send now instead of on the next writer tick
+            self.reactor.update_timer(self.writer_timer, self.reactor.NOW)
+        return True
+
+    def _send_required(self, request, callback, merge=True):
+        """
+        send_request for a step the caller depends on
+
+        A dropped feed never makes the ACE busy, so wait_ace_ready() would
+        return at once as if it had run; raise instead to abort the caller.
+        """
+        if not self.send_request(request, callback, merge):
+            raise self.printer.command_error(
+                'ACE: Request queue full, %s not sent' % (request.get('method'),))
 
     def wait_ace_ready(self):
         while self._info['status'] != 'ready':
@@ -425,15 +543,14 @@ class BunnyAce:
         query_endstops.register_endstop(mcu_endstop, share_name)
         self.endstops[name] = mcu_endstop
 
-    def _check_endstop_state(self, name):
-        print_time = self.toolhead.get_last_move_time()
-        return bool(self.endstops[name].query_endstop(print_time))
-
     def _serial_disconnect(self):
 
         if self._serial is not None and self._serial.isOpen():
             self._serial.close()
             self._connected = False
+        # Toolchanges wait for the handshake of the next connection
+        self._device_ready = False
+        self._startup_begin = self.reactor.monotonic()
 
         self.reactor.unregister_timer(self.reader_timer)
         self.reactor.unregister_timer(self.writer_timer)
@@ -442,41 +559,23 @@ class BunnyAce:
 
         try:
             port = self.find_com_port('ACE')
+            if port is None and self._is_virtual_port(self.serial_name):
+                # PTYs (tools/ace_emulator.py) are not listed by list_ports
+                port = self.serial_name
             if port is None:
-                return eventtime + 1
+                return eventtime + self._watch_device()
             self.gcode.respond_info('Try connecting')
-            self._serial = serial.Serial(
-                port=port,
-                baudrate=self.baud,
-                timeout=0,
-                write_timeout=0)
+            self._serial = self._open_serial(port)
 
             if self._serial.isOpen():
                 self._connected = True
+                self.metrics.connected(eventtime - self._startup_begin)
                 logging.info('ACE: Connected to ' + port)
                 self.gcode.respond_info(f'ACE: Connected to {port} {eventtime}')
-                self.writer_timer = self.reactor.register_timer(self._writer, self.reactor.NOW)
-                self.reader_timer = self.reactor.register_timer(self._reader, self.reactor.NOW)
-                self.send_request(request={"method": "get_info"},
-                                  callback=lambda self, response: self.gcode.respond_info(str(response)))
-                def info_callback(self, response):
-                    try:
-                        res = response.get('result', {})
-
-                        self.model = res.get('model', "unknown")
-                        self.firmware = res.get('firmware', "unknown")
-                        self.boot_firmware = res.get('boot_firmware', "unknown")
-
-                        logging.info(f"Device info: {self.model} {self.firmware}")
-                        self.gcode.respond_info(
-                            f"Connected {self.model} {self.firmware}"
-                        )
-
-                    except Exception as e:
-                        logging.error(f"Error parsing get_info response: {e}")
-
-                    # Send request once
-                self.send_request({"method": "get_info"}, info_callback)
+                self._stop_device_watch()
+                self.writer_timer = self.profiler.register_timer('writer', self._writer, self.reactor.NOW)
+                self.reader_timer = self.profiler.register_timer('reader', self._reader, self.reactor.NOW)
+                self._start_handshake()
 
                 # --- Added: Check ace_current_index and enable feed assist if needed ---
                 ace_current_index = self.variables.get('ace_current_index', -1)
@@ -487,29 +586,119 @@ class BunnyAce:
                 self.reactor.unregister_timer(self.connect_timer)
                 return self.reactor.NEVER
         except serial.serialutil.SerialException:
+            # Usually udev has not set the permissions of a new node yet
             self._serial = None
-        return eventtime + 1
-
-    def _load_device_info(self):
-        def info_callback(response):
-            try:
-                res = response.get('result', {})
+        return eventtime + self._watch_device()
+
+    def _watch_device(self):
+        """Start waiting for device nodes, seconds until the next connect attempt"""
+        if self._device_watcher is None:
+            self._device_watcher = AceDeviceWatcher.open(self.reactor, self._device_appeared)
+        if self._device_watcher is None:
+            return self.connect_interval
+        return max(self.connect_interval, DEVICE_WATCH_POLL)
+
+    def _stop_device_watch(self):
+        if self._device_watcher is not None:
+            self._device_watcher.close()
+            self._device_watcher = None
+
+    def _device_appeared(self, eventtime):
+        if not self._connected:
+            self.reactor.update_timer(self.connect_timer, self.reactor.NOW)
+
+    def _open_serial(self, port):
+        return serial.Serial(
+            port=port,
+            baudrate=self.baud,
+            timeout=0,
+            write_timeout=0)
+
+    def _handle_device_info(self, response):
+        try:
+            res = response.get('result', {})
 
-                self.model = res.get('model', "unknown")
-                self.firmware = res.get('firmware', "unknown")
-                self.boot_firmware = res.get('boot_firmware', "unknown")
+            self.model = res.get('model', "unknown")
+            self.firmware = res.get('firmware', "unknown")
+            self.boot_firmware = res.get('boot_firmware', "unknown")
 
-                logging.info(
-                    f"ACE Device: {self.model} {self.firmware}"
-                )
+            logging.info(f"Device info: {self.model} {self.firmware}")
+            self.gcode.respond_info(
+                f"Connected {self.model} {self.firmware}"
+            )
 
-            except Exception as e:
-                logging.error(f"ACE get_info parse error: {e}")
-
-        self.send_request(
-            request={"method": "get_info"},
-            callback=info_callback
-        )
+        except Exception as e:
+            logging.error(f"Error parsing get_info response: {e}")
+
+    def _start_handshake(self):
+        """
+        Queue get_info and get_status back to back, then get_filament_info
+        of the identified slots without a cached entry. The reader sends
+        each request as soon as the previous answer arrived; the ACE is
+        ready when all of them were answered.
+        """
+        self._device_ready = False
+        pending = self._handshake_pending = set(('get_info', 'get_status'))
+
+        def step(name):
+            pending.discard(name)
+            if not pending and pending is self._handshake_pending:
+                self._handshake_done()
+
+        def info_callback(self, response):
+            self._handle_device_info(response)
+            step('get_info')
+
+        def status_callback(self, response):
+            self._handle_status_response(response)
+            cache = self.filament_cache
+            for slot in self.slots:
+                entry = cache.entries[slot.index]
+                if slot.ace_rfid == RFID_IDENTIFIED and slot.ace_status != 'empty' \
+                        and (entry is None or entry.get('sku') != slot.ace_sku):
+                    name = 'get_filament_info %d' % (slot.index,)
+                    pending.add(name)
+                    cache.fetch(slot.index, lambda response, name=name: step(name))
+            step('get_status')
+
+        self.send_request({"method": "get_info"}, info_callback)
+        self.send_request({"method": "get_status"}, status_callback)
+        if self._handshake_timer is None:
+            self._handshake_timer = self.profiler.register_timer(
+                'handshake', self._handshake_timeout)
+        self.reactor.update_timer(self._handshake_timer,
+                                  self.reactor.monotonic() + HANDSHAKE_TIMEOUT)
+
+    def _handshake_timeout(self, eventtime):
+        if self._connected and not self._device_ready:
+            # A request was lost to a timeout or a full queue
+            logging.info('ACE: Startup handshake incomplete (%s), retrying'
+                         % (', '.join(sorted(self._handshake_pending)),))
+            self._start_handshake()
+            return eventtime + HANDSHAKE_TIMEOUT
+        return self.reactor.NEVER
+
+    def _handshake_done(self):
+        self._device_ready = True
+        self.reactor.update_timer(self._handshake_timer, self.reactor.NEVER)
+        elapsed = self.reactor.monotonic() - self._startup_begin
+        self.metrics.device_ready(elapsed)
+        logging.info('ACE: Ready %.3fs after start' % (elapsed,))
+        waiters, self._ready_waiters = self._ready_waiters, []
+        for completion in waiters:
+            completion.complete(True)
+
+    def wait_device_ready(self, timeout):
+        """Wait for the startup handshake, False if it did not finish in timeout seconds"""
+        if self._device_ready:
+            return True
+        completion = self.reactor.completion()
+        self._ready_waiters.append(completion)
+        if completion.wait(self.reactor.monotonic() + timeout, False):
+            return True
+        if completion in self._ready_waiters:
+            self._ready_waiters.remove(completion)
+        return False
 
     cmd_ACE_START_DRYING_help = 'Starts ACE Pro dryer'
 
@@ -522,6 +711,8 @@ class BunnyAce:
         if temperature <= 0 or temperature > self.max_dryer_temperature:
             raise gcmd.error('Wrong temperature')
 
+        self.dryer.cancel(stop_dryer=False)
+
         def callback(self, response):
             if 'code' in response and response['code'] != 0:
                 raise gcmd.error("ACE Error: " + response['msg'])
@@ -535,6 +726,8 @@ class BunnyAce:
     cmd_ACE_STOP_DRYING_help = 'Stops ACE Pro dryer'
 
     def cmd_ACE_STOP_DRYING(self, gcmd):
+        self.dryer.cancel(stop_dryer=False)
+
         def callback(self, response):
             if 'code' in response and response['code'] != 0:
                 raise gcmd.error("ACE Error: " + response['msg'])
@@ -551,7 +744,7 @@ class BunnyAce:
                 self._feed_assist_index = index
                 self.gcode.respond_info(str(response))
 
-        self.send_request(request={"method": "start_feed_assist", "params": {"index": index}}, callback=callback)
+        self._send_required(request={"method": "start_feed_assist", "params": {"index": index}}, callback=callback)
         self.dwell(delay=0.7)
 
     cmd_ACE_ENABLE_FEED_ASSIST_help = 'Enables ACE feed assist'
@@ -572,7 +765,7 @@ class BunnyAce:
             self._feed_assist_index = -1
             self.gcode.respond_info('Disabled ACE feed assist')
 
-        self.send_request(request={"method": "stop_feed_assist", "params": {"index": index}}, callback=callback)
+        self._send_required(request={"method": "stop_feed_assist", "params": {"index": index}}, callback=callback)
 #        self.dwell(0.3)
 
     cmd_ACE_DISABLE_FEED_ASSIST_help = 'Disables ACE feed assist'
@@ -593,7 +786,7 @@ class BunnyAce:
             if 'code' in response and response['code'] != 0:
                 raise ValueError("ACE Error: " + response['msg'])
 
-        self.send_request(
+        self._send_required(
             request={"method": "feed_filament", "params": {"index": index, "length": length, "speed": speed}},
             callback=callback)
         self.dwell(delay=(length / speed) + 0.1)
@@ -619,11 +812,145 @@ class BunnyAce:
             if 'code' in response and response['code'] != 0:
                 raise ValueError("ACE Error: " + response['msg'])
 
-        self.send_request(
+        self._send_required(
             request={"method": "unwind_filament", "params": {"index": index, "length": length, "speed": speed}},
             callback=callback)
         self.dwell(delay=(length / speed) + 0.1)
 
+    def _feed_until_sensor(self, index, sensor, max_length, speed, expected=None):
+        """
+        Feed slot index until the named sensor triggers, at most max_length mm
+
+        The feed is stopped with stop_feed_filament as soon as the sensor
+        reports filament. With sensor_slow_length set, the speed drops to
+        sensor_slow_speed that far before the expected distance (by default
+        the last measured one). Returns the mm fed, None if the sensor was
+        not reached.
+        """
+        if self.sensors.present(sensor):
+            return 0.
+        if expected is None:
+            expected = self._sensor_distances.get((sensor, index))
+
+        def callback(self, response):
+            if 'code' in response and response['code'] != 0:
+                raise ValueError("ACE Error: " + response['msg'])
+
+        # Wake up on the sensor's own state change instead of the next poll
+        triggered = self.sensors.watch(sensor, True)
+        slow_speed = min(speed, self.sensor_slow_speed)
+        slow_from = None
+        if self.sensor_slow_length and expected and slow_speed < speed:
+            slow_from = max(0., expected - self.sensor_slow_length)
+        try:
+            self._send_required(
+                request={"method": "feed_filament", "params": {"index": index, "length": max_length, "speed": speed}},
+                callback=callback)
+        except Exception:
+            self.sensors.unwatch(sensor, triggered)
+            raise
+        start = self.reactor.monotonic()
+        slowed_at = None
+        fast_time = (slow_from if slow_from is not None else max_length) / speed
+        deadline = start + fast_time + (max_length - speed * fast_time) / slow_speed + 1.
+        fed = None
+        try:
+            while True:
+                now = self.reactor.monotonic()
+                if triggered.test() or self.sensors.present(sensor):
+                    if slowed_at is None:
+                        fed = (now - start) * speed
+                    else:
+                        fed = (slowed_at - start) * speed + (now - slowed_at) * slow_speed
+                    break
+                if now >= deadline:
+                    break
+                if slow_from is not None and slowed_at is None and now >= start + fast_time:
+                    self._send_required(
+                        request={"method": "update_feeding_speed", "params": {"index": index, "speed": slow_speed}},
+                        callback=callback, merge=False)
+                    slowed_at = now
+                    deadline = now + (max_length - slow_from) / slow_speed + 1.
+                wake = now + 0.05
+                if slow_from is not None and slowed_at is None:
+                    wake = min(wake, start + fast_time)
+                triggered.wait(min(wake, deadline))
+        finally:
+            self.sensors.unwatch(sensor, triggered)
+        if fed is not None:
+            self._send_required(
+                request={"method": "stop_feed_filament", "params": {"index": index}},
+                callback=callback, merge=False)
+            fed = min(fed, max_length)
+            self._sensor_distances[(sensor, index)] = fed
+            logging.info('ACE: Slot %d reached %s after %.0fmm' % (index, sensor, fed))
+        self.wait_ace_ready()
+        return fed
+
+    def _sync_unload(self, index):
+        """
+        Pull the filament out of the extruder with extruder and ACE together
+
+        One unwind_filament runs while the extruder retract is queued in
+        short moves at the same speed, both stop once the extruder sensor
+        clears. Returns False if it did not clear within sync_unload_length.
+        """
+        if not self.sensors.present('extruder_sensor'):
+            return True
+        speed = self.sync_unload_speed
+        length = self.sync_unload_length
+
+        def callback(self, response):
+            if 'code' in response and response['code'] != 0:
+                raise ValueError("ACE Error: " + response['msg'])
+
+        cleared = self.sensors.watch('extruder_sensor', False)
+        try:
+            self._send_required(
+                request={"method": "unwind_filament", "params": {"index": index, "length": length, "speed": speed}},
+                callback=callback)
+        except Exception:
+            self.sensors.unwatch('extruder_sensor', cleared)
+            raise
+        now = self.reactor.monotonic()
+        deadline = now + length / speed + 1.
+        queued_until = now
+        retracted = 0.
+        try:
+            while self.sensors.present('extruder_sensor') and now < deadline:
+                while queued_until - now < SYNC_UNLOAD_LEAD and retracted < length:
+                    chunk = min(speed * SYNC_UNLOAD_CHUNK, length - retracted)
+                    self._extruder_move(-chunk, speed)
+                    retracted += chunk
+                    queued_until = max(queued_until, now) + chunk / speed
+                cleared.wait(min(now + 0.05, deadline))
+                now = self.reactor.monotonic()
+        finally:
+            self.sensors.unwatch('extruder_sensor', cleared)
+        self._send_required(
+            request={"method": "stop_unwind_filament", "params": {"index": index}},
+            callback=callback, merge=False)
+        self.wait_ace_ready()
+        return not self.sensors.present('extruder_sensor')
+
+    cmd_ACE_FEED_TO_SENSOR_help = ('Feed a slot until a sensor triggers: INDEX= '
+                                   'SENSOR=splitter|extruder|toolhead [LENGTH=<max mm>] [SPEED=]')
+
+    def cmd_ACE_FEED_TO_SENSOR(self, gcmd):
+        index = gcmd.get_int('INDEX', minval=0, maxval=3)
+        sensor = gcmd.get('SENSOR', 'splitter').lower()
+        if sensor not in ('splitter', 'extruder', 'toolhead'):
+            raise gcmd.error('Wrong sensor')
+        sensor += '_sensor'
+        if self.sensors.present(sensor) is None:
+            raise gcmd.error('ACE: No %s configured' % (sensor,))
+        length = gcmd.get_int('LENGTH', self.bowden_tube_length, minval=1)
+        speed = gcmd.get_int('SPEED', self.feed_speed, minval=1)
+        fed = self._feed_until_sensor(index, sensor, length, speed)
+        if fed is None:
+            raise gcmd.error('ACE: Slot %d did not reach %s within %dmm' % (index, sensor, length))
+        gcmd.respond_info('ACE: Slot %d reached %s after %.0fmm' % (index, sensor, fed))
+
     cmd_ACE_RETRACT_help = 'Retracts filament back to ACE'
 
     def cmd_ACE_RETRACT(self, gcmd):
@@ -640,54 +967,231 @@ class BunnyAce:
 
         self._retract(index, length, speed)
 
-    def _park_to_toolhead(self, tool):
+    def _timing_begin(self, kind, was, tool):
+        """Start timing a toolchange, phases are marked with _timing_phase"""
+        self._toolchange_timing = {
+            'kind': kind,
+            'from': was,
+            'to': tool,
+            'start': self.reactor.monotonic(),
+            'wall_start': time.perf_counter(),
+            'phase': None,
+            'phases': {},
+        }
+        self.journal.begin(kind, was, tool)
 
-        sensor_extruder = self.printer.lookup_object("filament_switch_sensor %s" % "extruder_sensor", None)
+    def _timing_phase(self, name):
+        """Close the running phase and start the next one (None just closes)"""
+        timing = self._toolchange_timing
+        if timing is None:
+            return
+        now = self.reactor.monotonic()
+        wall = time.perf_counter()
+        if timing['phase'] is not None:
+            prev, start, wall_start = timing['phase']
+            phase = timing['phases'].setdefault(prev, {'time': 0., 'wall': 0.})
+            phase['time'] += now - start
+            phase['wall'] += wall - wall_start
+        timing['phase'] = (name, now, wall) if name is not None else None
+        if name is not None:
+            self.journal.phase(name)
+
+    def _timing_end(self, result='ok'):
+        timing = self._toolchange_timing
+        if timing is None:
+            return
+        self._timing_phase(None)
+        self._toolchange_timing = None
+        self.journal.end(result)
+        self._toolchange_stats = {
+            'kind': timing['kind'],
+            'from': timing['from'],
+            'to': timing['to'],
+            'result': result,
+            'time': round(self.reactor.monotonic() - timing['start'], 3),
+            'wall': round(time.perf_counter() - timing['wall_start'], 4),
+            'phases': {
+                name: {'time': round(phase['time'], 3),
+                       'wall': round(phase['wall'], 4)}
+                for name, phase in timing['phases'].items()},
+        }
 
+    def _set_filament_pos(self, pos):
+        self.variables['ace_filament_pos'] = pos
+        self.journal.position(pos)
+        self.gcode.respond_info(f"ace_filament_pos set to {pos}")
+
+    def _park_to_toolhead(self, tool):
+
+        self._timing_phase('feed_bowden')
         self.wait_ace_ready()
 
-        self._feed(tool, self.toolchange_load_length, self.retract_speed)
-        self.variables['ace_filament_pos'] = "bowden"
-        self.gcode.respond_info(f"ace_filament_pos set to bowden")
+        load_length = self.toolchange_load_length - self._take_staged(tool)
+        if load_length > 0:
+            self._feed(tool, load_length, self.retract_speed)
+        self._set_filament_pos("bowden")
         self.wait_ace_ready()
 
+        self._timing_phase('wait_extruder_sensor')
         self._enable_feed_assist(tool)
 
-        while not bool(sensor_extruder.runout_helper.filament_present):
+        while not self.sensors.present('extruder_sensor'):
             self.dwell(delay=0.1)
 
-        if not bool(sensor_extruder.runout_helper.filament_present):
-            raise ValueError("Filament stuck " + str(bool(sensor_extruder.runout_helper.filament_present)))
+        if not self.sensors.present('extruder_sensor'):
+            raise ValueError("Filament stuck " + str(self.sensors.present('extruder_sensor')))
         else:
             self.variables['ace_filament_pos'] = "splitter"
-        
-        while not self._check_endstop_state('toolhead_sensor'):
+            self.journal.position("splitter")
+
+        self._timing_phase('load_toolhead')
+        # Each step must see the sensor after the queued move, so query the MCU
+        while not self.sensors.query('toolhead_sensor'):
             self._extruder_move(1, 5)
             self.dwell(delay=0.01)
 
-        self.variables['ace_filament_pos'] = "toolhead"
-        self.gcode.respond_info(f"ace_filament_pos set to toolhead")
+        self._set_filament_pos("toolhead")
+        self._timing_phase('load_nozzle')
         self._extruder_move(self.toolhead_sensor_to_nozzle_length, 5)
-        self.variables['ace_filament_pos'] = "nozzle"
-        self.gcode.respond_info(f"ace_filament_pos set to nozzle")
+        self._set_filament_pos("nozzle")
+
+    def _save_staged(self, deferred=False):
+        script = "SAVE_VARIABLE VARIABLE=ace_staged VALUE='%s'" % (
+            json.dumps({str(k): v for k, v in self._staged.items()}),)
+        if not deferred:
+            self.gcode.run_script_from_command(script)
+            return
+
+        # From the serial reader: run the gcode outside of the timer
+        def save(eventtime):
+            try:
+                self.gcode.run_script(script)
+            except Exception as e:
+                logging.info('ACE: Saving staged slots failed: %s' % (e,))
+        self.reactor.register_callback(save)
+
+    def _take_staged(self, tool):
+        """mm already fed for tool, clears its staged state"""
+        length = self._staged.pop(tool, 0)
+        if length:
+            self._save_staged()
+        return length
+
+    def _check_staged_slots(self, info):
+        """A staged slot that ran empty has nothing staged any more"""
+        if not self._staged:
+            return
+        emptied = [tool for tool in self._staged
+                   if tool < 4 and self.slots[tool].ace_status == 'empty']
+        for tool in emptied:
+            del self._staged[tool]
+        if emptied:
+            self._save_staged(deferred=True)
+
+    def _stage_tool(self, tool, length):
+        """Feed tool ahead of its toolchange, returns a message for the user"""
+        if length <= 0:
+            return 'ACE: Staging is off, set prestage_length or LENGTH'
+        if self._park_in_progress or self.endless_spool_in_progress:
+            return 'ACE: Not staging T%d during a toolchange' % (tool,)
+        current = self.variables.get('ace_current_index', -1)
+        if tool == current:
+            return 'ACE: T%d is loaded, nothing to stage' % (tool,)
+        if tool in self._staged:
+            return 'ACE: T%d already staged (%dmm)' % (tool, self._staged[tool])
+        if self.slots[tool].ace_status != 'ready':
+            return 'ACE: Not staging T%d, slot is %s' % (tool, self.slots[tool].ace_status)
+        # Interlock: the shared path must hold exactly what we think it does
+        present = self.sensors.present('splitter_sensor')
+        if present is not None and present != (current != -1):
+            return 'ACE: Not staging T%d, splitter sensor %s filament' % (
+                tool, 'reports' if present else 'does not report')
+
+        def callback(self, response):
+            if response.get('code', 0) != 0:
+                self._staged.pop(tool, None)
+                self._save_staged(deferred=True)
+                self.gcode.respond_info('ACE: Staging T%d failed: %s' % (tool, response.get('msg')))
+
+        if not self.send_request(
+                {"method": "feed_filament",
+                 "params": {"index": tool, "length": length, "speed": self.prestage_speed}},
+                callback):
+            return 'ACE: Not staging T%d, request queue full' % (tool,)
+        self._staged[tool] = length
+        self._save_staged()
+        if current == -1 and present is not None:
+            # With an empty path the splitter sensor shows an overshoot
+            self.reactor.register_callback(
+                lambda eventtime: self._check_stage_overshoot(tool, length),
+                self.reactor.monotonic() + length / self.prestage_speed + 1.)
+        return 'ACE: Staging T%d, %dmm ahead' % (tool, length)
+
+    def _check_stage_overshoot(self, tool, length):
+        if self._staged.get(tool) != length or self.variables.get('ace_current_index', -1) != -1:
+            return
+        if self._info.get('status') != 'ready':
+            # Still feeding, the gear may have had to shift first
+            self.reactor.register_callback(
+                lambda eventtime: self._check_stage_overshoot(tool, length),
+                self.reactor.monotonic() + 1.)
+            return
+        if self.sensors.present('splitter_sensor'):
+            self.gcode.respond_info(
+                'ACE: Staged T%d reached the splitter, retracting; lower prestage_length' % (tool,))
+            self._unstage(tool)
+            self._save_staged(deferred=True)
+
+    def _unstage(self, tool):
+        length = self._staged.pop(tool, 0)
+        if length:
+            self.send_request(
+                {"method": "unwind_filament",
+                 "params": {"index": tool, "length": length, "speed": self.prestage_speed}},
+                lambda self, response: None)
+
+    cmd_ACE_PREPARE_TOOL_help = ('Feed the next tool up to the splitter while printing: '
+                                 'TOOL=<0-3> [LENGTH=<mm>] | TOOL=-1 retracts staged tools')
+
+    def cmd_ACE_PREPARE_TOOL(self, gcmd):
+        tool = gcmd.get_int('TOOL', minval=-1, maxval=3)
+        if tool == -1:
+            staged = sorted(self._staged)
+            for index in staged:
+                self._unstage(index)
+            self._save_staged()
+            gcmd.respond_info('ACE: Retracting staged tools %s' % (
+                ', '.join('T%d' % (t,) for t in staged) or 'none',))
+            return
+        length = gcmd.get_int('LENGTH', self.prestage_length, minval=0,
+                              maxval=self.toolchange_load_length)
+        gcmd.respond_info(self._stage_tool(tool, length))
 
     cmd_ACE_CHANGE_TOOL_help = 'Changes tool'
 
     def cmd_ACE_CHANGE_TOOL(self, gcmd):
         tool = gcmd.get_int('TOOL')
-        sensor_extruder = self.printer.lookup_object("filament_switch_sensor %s" % "extruder_sensor", None)
 
         if tool < -1 or tool >= 4:
             raise gcmd.error('Wrong tool')
 
         was = self.variables.get('ace_current_index', -1)
-        if was == tool:
+        if tool != -1:
+            self.planner.tool_changed(tool)
+        if was == tool and tool != -1 and self.variables.get('ace_filament_pos') != 'nozzle':
+            # A load was interrupted (AceJournal recovery), unload and load it again
+            gcmd.respond_info('ACE: Tool %d is not loaded to the nozzle, reloading' % (tool,))
+        elif was == tool:
             gcmd.respond_info('ACE: Not changing tool, current index already ' + str(tool))
-            self._enable_feed_assist(tool)
+            if tool != -1:
+                self._enable_feed_assist(tool)
             return
 
         if tool != -1:
-            status = self._info['slots'][tool]['status']
+            # Right after a (re)connect the slot states are not known yet
+            if not self.wait_device_ready(self.startup_timeout):
+                raise gcmd.error('ACE: Not ready, no status received from the ACE')
+            status = self.slots[tool].ace_status
             if status != 'ready':
                 self.gcode.run_script_from_command('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
                 return
@@ -698,32 +1202,37 @@ class BunnyAce:
             self.endless_spool_enabled = False
             self.endless_spool_runout_detected = False
         self._park_in_progress = True
+        self._timing_begin('toolchange', was, tool)
+        self._timing_phase('pre_toolchange')
         self.gcode.run_script_from_command('_ACE_PRE_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
 
         logging.info('ACE: Toolchange ' + str(was) + ' => ' + str(tool))
         if was == -1:
+            self._timing_phase('cut_tip')
             self.gcode.run_script_from_command('CUT_TIP')
         if was != -1:
             self._disable_feed_assist(was)
+            self._timing_phase('cut_tip')
             self.gcode.run_script_from_command('CUT_TIP')
+            self._timing_phase('unload_extruder')
             self.wait_ace_ready()
             if self.variables.get('ace_filament_pos', "splitter") == "nozzle":
-                self.variables['ace_filament_pos'] = "toolhead"
-                self.gcode.respond_info(f"ace_filament_pos set to toolhead")
+                self._set_filament_pos("toolhead")
             if self.variables.get('ace_filament_pos', "splitter") == "toolhead":
-                while bool(sensor_extruder.runout_helper.filament_present):
+                if self.sync_unload and not self._sync_unload(was):
+                    self.gcode.respond_info("ACE: Synchronized unload did not clear the extruder sensor, unloading in steps")
+                while self.sensors.present('extruder_sensor'):
                     self._extruder_move(-50, 10)
                     self._retract(was, 100, self.retract_speed)
                     self.wait_ace_ready()
-                self.variables['ace_filament_pos'] = "bowden"
-                self.gcode.respond_info(f"ace_filament_pos set to bowden")
+                self._set_filament_pos("bowden")
 
             self.wait_ace_ready()
 
+            self._timing_phase('retract')
             self._retract(was, self.toolchange_retract_length, self.retract_speed)
             self.wait_ace_ready()
-            self.variables['ace_filament_pos'] = "splitter"
-            self.gcode.respond_info(f"ace_filament_pos set to splitter")
+            self._set_filament_pos("splitter")
             if tool != -1:
                 self._park_to_toolhead(tool)
         else:
@@ -731,7 +1240,9 @@ class BunnyAce:
         gcode_move = self.printer.lookup_object('gcode_move')
         gcode_move.reset_last_position()
 
-        self.gcode.run_script_from_command('_ACE_POST_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
+        self._timing_phase('post_toolchange')
+        self.gcode.run_script_from_command('_ACE_POST_TOOLCHANGE FROM=%d TO=%d PURGE_LENGTH=%.1f' % (
+            was, tool, self.costs.toolchange_purge(was, tool)))
         self.variables['ace_current_index'] = tool
         gcode_move.reset_last_position()
         # Force save to disk
@@ -743,18 +1254,25 @@ class BunnyAce:
         # Re-enable endless spool if it was enabled before
         if endless_spool_was_enabled:
             self.endless_spool_enabled = True
-    
+
+        self._timing_end()
+        self.costs.record(self._toolchange_stats)
         gcmd.respond_info(f"Tool {tool} load")
 
+        if self.prestage_auto and self.prestage_length and tool != -1:
+            next_tool = self.planner.next_tool()
+            if next_tool is not None and next_tool != tool:
+                gcmd.respond_info(self._stage_tool(next_tool, self.prestage_length))
+
     def _find_next_available_slot(self, current_slot):
         """Find the next available slot with matching type and optional color"""
         # Safety Check: If current_slot is invalid, we can't match anything
         if current_slot < 0 or current_slot > 3:
             return -1
         # 1. Capture current filament data
-        current_filament = self.inventory[current_slot]
-        target_type = current_filament.get("type")
-        target_color = current_filament.get("color")
+        current_filament = self.slots[current_slot]
+        target_type = current_filament.type
+        target_color = current_filament.color
 
         possible_slots = []
 
@@ -765,20 +1283,26 @@ class BunnyAce:
                 continue
             
             # Check physical (ACE) and logical (Inventory) status
-            is_ready = (self.inventory[next_slot]["status"] == "ready" and 
-                        self._info['slots'][next_slot]['status'] == 'ready')
-        
+            is_ready = self.slots[next_slot].ready
+
             # Match against 'type' (e.g., PLA, PETG)
-            if is_ready and self.inventory[next_slot].get("type") == target_type:
+            if is_ready and self.slots[next_slot].type == target_type:
                 possible_slots.append(next_slot)
 
         # 3. Decision Logic
         if not possible_slots:
             return -1  # No compatible filament found
 
+        # The same product (RFID SKU) is the best match
+        target_sku = current_filament.sku
+        if target_sku:
+            for slot_index in possible_slots:
+                if self.slots[slot_index].sku == target_sku:
+                    return slot_index
+
         # Optional: Try to find a perfect color match among the possible slots
         for slot_index in possible_slots:
-            if self.inventory[slot_index].get("color") == target_color:
+            if self.slots[slot_index].color == target_color:
                 return slot_index
 
         # Fallback: If no color match, return the first available slot of the same type
@@ -794,21 +1318,15 @@ class BunnyAce:
             return
 
         try:
-            sensor_splitter = self.printer.lookup_object("filament_switch_sensor splitter_sensor", None)
-            if sensor_splitter:
-                # Check both runout helper and direct endstop state
-                runout_helper_present = bool(sensor_splitter.runout_helper.filament_present)
-                endstop_triggered = self._check_endstop_state('splitter_sensor')
-                
-                # Log sensor states for debugging (remove after testing)
-                # logging.info(f"ACE Debug: runout_helper={runout_helper_present}, endstop={endstop_triggered}")
-                
+            # Cached state only, an endstop query here would flush the toolhead on every tick
+            present = self.sensors.present('splitter_sensor')
+            if present is not None:
                 # Runout detected if filament is not present
-                if not runout_helper_present or not endstop_triggered:
+                if not present:
                     if not self.endless_spool_runout_detected:  # Only trigger once
                         self.endless_spool_runout_detected = True
                         self.gcode.respond_info("ACE: Endless spool runout detected, switching immediately")
-                        logging.info(f"ACE: Runout detected - runout_helper={runout_helper_present}, endstop={endstop_triggered}")
+                        logging.info("ACE: Runout detected on the splitter sensor")
                         # Execute endless spool change immediately
                         self._execute_endless_spool_change()
         except Exception as e:
@@ -830,39 +1348,39 @@ class BunnyAce:
 
         self.endless_spool_in_progress = True
         self.endless_spool_runout_detected = False
-        
+        self._timing_begin('endless_spool', current_tool, next_tool)
+
         self.gcode.respond_info(f"ACE: Endless spool changing from slot {current_tool} to slot {next_tool}")
         
         # Mark current slot as empty in inventory
         if current_tool >= 0:
-            self.inventory[current_tool] = {"index": current_tool, "status": "empty", "color": [0, 0, 0], "type": "", "temp": 0, "sku": "", "rfid": 0}
+            self.slots[current_tool].clear()
             # Save updated inventory to persistent variables
-            self.variables['ace_inventory'] = self.inventory
-            self.gcode.run_script_from_command(f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE=\'{json.dumps(self.inventory)}\'')
+            self._save_inventory()
         
         try:
             # Direct endless spool change - no toolchange macros needed for runout response
             
             # Step 1: Disable feed assist on empty slot
+            self._timing_phase('disable_assist')
             if current_tool != -1:
                 self._disable_feed_assist(current_tool)
                 self.wait_ace_ready()
 
             # Step 2: Feed filament from next slot until it reaches splitter sensor
-            sensor_splitter = self.printer.lookup_object("filament_switch_sensor splitter_sensor", None)
-            
+            self._timing_phase('feed_splitter')
+
             max_retries = 3
             load_success = False
 
+            # The feed stops at the sensor, a staged tool just gets there sooner
+            self._take_staged(next_tool)
             for attempt in range(max_retries + 1):
                 self.gcode.respond_info(f"ACE: Feeding from slot {next_tool} (Attempt {attempt + 1})")
-                
-                # Feed the programmed length
-                self._feed(next_tool, self.toolchange_load_length_runout, self.retract_speed)
-                self.wait_ace_ready()
-                
-                # Check the sensor
-                if bool(sensor_splitter.runout_helper.filament_present):
+
+                fed = self._feed_until_sensor(next_tool, 'splitter_sensor',
+                                              self.toolchange_load_length_runout, self.retract_speed)
+                if fed is not None:
                     load_success = True
                     break
                 
@@ -875,20 +1393,12 @@ class BunnyAce:
             if not load_success:
                 raise ValueError("Filament failed to reach splitter sensor after retries")
 
-
-
-            # Feed filament from new slot until splitter sensor triggers
-            self._feed(next_tool, self.toolchange_load_length_runout, self.retract_speed)
-            self.wait_ace_ready()
-
-            # Wait for filament to reach splitter sensor
-#            while not bool(sensor_splitter.runout_helper.filament_present):
-#                self.dwell(delay=0.1)
-
-            if not bool(sensor_splitter.runout_helper.filament_present):
+            # The feed stopped at the sensor, no padded full-length feed after it
+            if not self.sensors.present('splitter_sensor'):
                 raise ValueError("Filament stuck during endless spool change")
 
             # Step 3: Enable feed assist for new slot
+            self._timing_phase('enable_assist')
             self._enable_feed_assist(next_tool)
 
             # Step 4: Update current index and save state
@@ -896,10 +1406,12 @@ class BunnyAce:
             self.gcode.run_script_from_command('SAVE_VARIABLE VARIABLE=ace_current_index VALUE=' + str(next_tool))
             
             self.endless_spool_in_progress = False
-            
+            self._timing_end()
+
             self.gcode.respond_info(f"ACE: Endless spool completed, now using slot {next_tool}")
             
         except Exception as e:
+            self._timing_end('failed')
             self.gcode.respond_info(f"ACE: Endless spool change failed: {str(e)}")
             self.gcode.run_script_from_command('PAUSE')
             self.endless_spool_in_progress = False
@@ -949,12 +1461,17 @@ class BunnyAce:
             gcmd.respond_info(f"  - In progress: {status_progress}")
 
     def find_com_port(self, device_name):
+        # Only needed while connecting, keep it out of the module import
+        import serial.tools.list_ports
         com_ports = serial.tools.list_ports.comports()
         for port, desc, hwid in com_ports:
             if device_name in desc:
                 return port
         return None
 
+    def _is_virtual_port(self, path):
+        return os.path.realpath(path).startswith('/dev/pts/')
+
     def cmd_ACE_DEBUG(self, gcmd):
         method = gcmd.get('METHOD')
         params = gcmd.get('PARAMS', '{}')
@@ -992,6 +1509,10 @@ class BunnyAce:
         
         return {
             'status': self._info.get('status', 'unknown'),
+            'device_ready': self._device_ready,
+            # Saved variables too, so UIs need not subscribe to all of save_variables
+            'current_index': self.variables.get('ace_current_index', -1),
+            'filament_pos': self.variables.get('ace_filament_pos', 'unknown'),
             'model': self.model,
             'firmware': self.firmware,
             'boot_firmware': self.boot_firmware,
@@ -1001,9 +1522,21 @@ class BunnyAce:
             'feed_assist_count': self._info.get('feed_assist_count', 0),
             'cont_assist_time': self._info.get('cont_assist_time', 0.0),
             'feed_assist_slot': self._feed_assist_index,  # Индекс слота с активным feed assist (-1 = выключен)
+            'feed_assist_monitor': self.assist_monitor.get_status(eventtime),
+            'feed_assist_sync': self.assist_sync.get_status(eventtime),
+            'sensors': self.sensors.get_status(eventtime),
+            'journal': self.journal.get_status(eventtime),
             'dryer': dryer_normalized,
             'dryer_status': dryer_normalized,
-            'slots': self._info.get('slots', []),
+            'dryer_job': self.dryer.get_status(eventtime),
+            'last_toolchange': self._toolchange_stats,
+            'batch_mark': self._batch_mark,
+            'job_plan': self.planner.get_status(eventtime),
+            'staged': {str(k): v for k, v in self._staged.items()},
+            'toolchange_costs': self.costs.get_status(eventtime),
+            'profile': self.profiler.get_status(eventtime),
+            'slots': [slot.to_status() for slot in self.slots],
+            'inventory': [slot.to_dict() for slot in self.slots],
 #            'filament_sensor': filament_sensor_status
         }
 
@@ -1012,55 +1545,97 @@ class BunnyAce:
         if idx < 0 or idx >= 4:
             raise gcmd.error('Invalid slot index')
         if gcmd.get_int('EMPTY', 0):
-            self.inventory[idx] = {"index": idx, "status": "empty", "color": [0, 0, 0], "type": "", "temp": 0, "sku": "", "rfid": "0"}
+            self.slots[idx].clear()
             # Save to persistent variables
-            self.variables['ace_inventory'] = self.inventory
-            self.gcode.run_script_from_command(f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE=\'{json.dumps(self.inventory)}\'')
+            self._save_inventory()
             gcmd.respond_info(f"Slot {idx} set to empty")
             return
         color_str = gcmd.get('COLOR', None)
         type = gcmd.get('TYPE', "")
         temp = gcmd.get_int('TEMP', 0)
-        sku = gcmd.get('SKU', None)
+        sku = gcmd.get('SKU', '')
         rfid = gcmd.get_int('RFID', 0)
         if not color_str or not type or temp <= 0:
             raise gcmd.error('COLOR, TYPE, and TEMP must be set unless EMPTY=1')
-        color = [int(x) for x in color_str.split(',')]
-        if len(color) != 3:
-            raise gcmd.error('COLOR must be R,G,B')
-        self.inventory[idx] = {
-            "index": idx,
-            "status": "ready",
-            "color": color,
-            "type": type,
-            "temp": temp,
-            "sku": sku,
-            "rfid": rfid
-        }
+        fields = dict(status='ready', color=color_str, type=type, temp=temp, sku=sku, rfid=rfid)
+        # Validate everything before the slot is cleared
+        try:
+            check = AceSlot(idx)
+            check.set(**fields)
+        except (ValueError, TypeError) as e:
+            raise gcmd.error('ACE: %s' % (e,))
+        slot = self.slots[idx]
+        slot.clear()
+        slot.set(**fields)
         # Save to persistent variables
-        self.variables['ace_inventory'] = self.inventory
-        self.gcode.run_script_from_command(f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE=\'{json.dumps(self.inventory)}\'')
-        gcmd.respond_info(f"Slot {idx} set: color={color}, type={type}, temp={temp}, sku={sku}, rfid={rfid}")
+        self._save_inventory()
+        gcmd.respond_info(f"Slot {idx} set: color={slot.color}, type={type}, temp={temp}, sku={sku}, rfid={rfid}")
+
+    cmd_ACE_UPDATE_SLOT_help = ('Change fields of a slot inventory entry: INDEX= '
+                                '[COLOR=R,G,B] [TYPE=] [TEMP=] [SKU=] [STATUS=ready|empty]')
+
+    def cmd_ACE_UPDATE_SLOT(self, gcmd):
+        idx = gcmd.get_int('INDEX', minval=0, maxval=3)
+        fields = {}
+        for param, field in (('COLOR', 'color'), ('TYPE', 'type'), ('TEMP', 'temp'),
+                             ('SKU', 'sku'), ('STATUS', 'status')):
+            value = gcmd.get(param, None)
+            if value is not None:
+                fields[field] = value
+        if not fields:
+            raise gcmd.error('ACE: Nothing to update')
+        slot = self.slots[idx]
+        # Validate everything before changing anything
+        try:
+            check = AceSlot(idx)
+            check.set(**fields)
+        except (ValueError, TypeError) as e:
+            raise gcmd.error('ACE: %s' % (e,))
+        if slot.set(**fields):
+            self._save_inventory()
+        gcmd.respond_info("Slot %d: %s" % (idx, json.dumps(slot.to_dict())))
 
     def cmd_ACE_QUERY_SLOTS(self, gcmd):
-        import json
-        gcmd.respond_info(f"ace: {self.inventory}")
+        gcmd.respond_info(f"ace: {[slot.to_dict() for slot in self.slots]}")
 
     cmd_ACE_SAVE_INVENTORY_help = 'Manually save current inventory to persistent storage'
 
+    def _save_inventory(self, deferred=False):
+        """Save the inventory (schema SLOT_SCHEMA_VERSION) to the persistent variables"""
+        if deferred:
+            if self._inventory_save_pending:
+                return
+            self._inventory_save_pending = True
+
+            # From the serial reader: run the gcode outside of the timer
+            def save(eventtime):
+                self._inventory_save_pending = False
+                try:
+                    self.gcode.run_script(self._inventory_script())
+                except Exception as e:
+                    logging.info('ACE: Saving inventory failed: %s' % (e,))
+            self.reactor.register_callback(save)
+            return
+        self.gcode.run_script_from_command(self._inventory_script())
+
+    def _inventory_script(self):
+        inventory = [slot.to_dict() for slot in self.slots]
+        self.variables['ace_inventory'] = inventory
+        return ("SAVE_VARIABLE VARIABLE=ace_inventory VALUE='%s'\n"
+                "SAVE_VARIABLE VARIABLE=ace_inventory_version VALUE=%d"
+                % (json.dumps(inventory), SLOT_SCHEMA_VERSION))
+
     def cmd_ACE_SAVE_INVENTORY(self, gcmd):
-        self.variables['ace_inventory'] = self.inventory
-        self.gcode.run_script_from_command(f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE=\'{json.dumps(self.inventory)}\'')
+        self._save_inventory()
         gcmd.respond_info("ACE: Inventory saved to persistent storage")
 
     cmd_ACE_TEST_RUNOUT_SENSOR_help = 'Test and display runout sensor states'
 
     def cmd_ACE_TEST_RUNOUT_SENSOR(self, gcmd):
         try:
-            sensor_splitter = self.printer.lookup_object("filament_switch_sensor splitter_sensor", None)
-            if sensor_splitter:
-                runout_helper_present = bool(sensor_splitter.runout_helper.filament_present)
-                endstop_triggered = self._check_endstop_state('splitter_sensor')
+            if self.sensors.present('splitter_sensor') is not None:
+                runout_helper_present = self.sensors.present('splitter_sensor')
+                endstop_triggered = self.sensors.query('splitter_sensor')
                 
                 gcmd.respond_info(f"ACE: Splitter sensor states:")
                 gcmd.respond_info(f"  - Runout helper filament present: {runout_helper_present}")
@@ -1070,13 +1645,18 @@ class BunnyAce:
                 gcmd.respond_info(f"  - Runout detected: {self.endless_spool_runout_detected}")
                 
                 # Test runout detection logic
-                would_trigger = not runout_helper_present or not endstop_triggered
+                would_trigger = not runout_helper_present
                 gcmd.respond_info(f"  - Would trigger runout: {would_trigger}")
             else:
                 gcmd.respond_info("ACE: Splitter sensor not found")
         except Exception as e:
             gcmd.respond_info(f"ACE: Error testing sensor: {str(e)}")
 
+    cmd_ACE_BATCH_MARK_help = 'Record progress of a command batch (ID= SEQ=), used by /server/ace/commands'
+
+    def cmd_ACE_BATCH_MARK(self, gcmd):
+        self._batch_mark = {'id': gcmd.get('ID'), 'seq': gcmd.get_int('SEQ', minval=0)}
+
     cmd_ACE_GET_CURRENT_INDEX_help = 'Get the currently loaded slot index'
 
     def cmd_ACE_GET_CURRENT_INDEX(self, gcmd):
@@ -1125,11 +1705,8 @@ class BunnyAce:
             gcmd.respond_info("ACE: Tool unloaded")
         
         # Check if slot is not empty (has filament loaded in the system)
-        slot_status = None
-        if hasattr(self, '_info') and self._info and 'slots' in self._info:
-            slot_status = self._info['slots'][index]['status']
-        
-        inventory_status = self.inventory[index]['status']
+        slot_status = self.slots[index].ace_status
+        inventory_status = self.slots[index].status
         
         # If slot is not empty or has filament in the system, retract it
         if (slot_status and slot_status != 'empty') or (inventory_status and inventory_status != 'empty'):
@@ -1296,17 +1873,2206 @@ class BunnyAce:
 
     def cmd_ACE_FILAMENT_INFO(self, gcmd):
         index = gcmd.get_int('INDEX', minval=0, maxval=3)
+        entry = self.filament_cache.entries[index]
+        if entry is not None and not gcmd.get_int('REFRESH', 0):
+            gcmd.respond_info(str(entry))
+            return
         try:
-            def callback(self, response):
+            def callback(response):
                 if 'result' in response:
                     slot_info = response['result']
                     self.gcode.respond_info(str(slot_info))
                 else:
                     self.gcode.respond_info('Error: No result in response')
-            self.send_request({"method": "get_filament_info", "params": {"index": index}}, callback)
+            self.filament_cache.fetch(index, callback)
         except Exception as e:
             self.logger.info(f"Filament info error: {str(e)}")
             self.gcode.respond_info('Error: ' + str(e))
 
+# Built-in drying profiles: comma separated "TEMP:MINUTES" stages, where
+# "START-END:MINUTES" ramps between two temperatures in dryer_ramp_step steps.
+# Temperatures are always capped by max_dryer_temperature.
+DRYER_PRESETS = {
+    'PLA': '40:15, 45:225',
+    'PLA+': '40:15, 45:225',
+    'TPU': '40-50:20, 50:220',
+    'PETG': '40-55:30, 55:210',
+    'ABS': '40-55:30, 55:210',
+    'ASA': '40-55:30, 55:210',
+    'PA': '40-55:30, 55:330',
+}
+
+DRYER_CHECK_INTERVAL = 5.
+
+def parse_dryer_profile(text, max_temp, ramp_step=5):
+    """Parse a profile string into a list of (temperature, minutes) stages"""
+    stages = []
+    for token in text.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        temps, sep, minutes = token.partition(':')
+        if not sep:
+            raise ValueError("Dryer stage '%s' must be TEMP:MINUTES" % (token,))
+        minutes = float(minutes)
+        if minutes <= 0:
+            raise ValueError("Dryer stage '%s' has no duration" % (token,))
+        if '-' in temps:
+            start, end = [int(t) for t in temps.split('-', 1)]
+            steps = max(1, abs(end - start) // ramp_step)
+            for i in range(steps + 1):
+                temp = start + (end - start) * i // steps
+                stages.append((min(temp, max_temp), minutes / (steps + 1)))
+        else:
+            stages.append((min(int(temps), max_temp), minutes))
+    if not stages:
+        raise ValueError("Empty dryer profile")
+    return stages
+
+class AceDryer:
+    """Closed-loop dryer scheduler running staged profiles on the ACE dryer"""
+
+    def __init__(self, ace, config):
+        self.ace = ace
+        self.printer = ace.printer
+        self.reactor = ace.reactor
+        self.gcode = ace.gcode
+        self.max_temp = ace.max_dryer_temperature
+        self.fan_speed = config.getint('dryer_fan_speed', 7000)
+        ramp_step = config.getint('dryer_ramp_step', 5, minval=1)
+        self.stall_time = config.getfloat('dryer_stall_time', 600., above=0.)
+        self.stall_tolerance = config.getfloat('dryer_stall_tolerance', 5., minval=0.)
+        self.idle_delay = config.getfloat('dryer_idle_delay', 60., minval=0.)
+
+        # Material presets, overridable with dryer_profile_<name> options
+        self.profiles = {}
+        for name, text in DRYER_PRESETS.items():
+            self.profiles[name] = parse_dryer_profile(text, self.max_temp, ramp_step)
+        for option in config.get_prefix_options('dryer_profile_'):
+            name = option[len('dryer_profile_'):].upper()
+            try:
+                self.profiles[name] = parse_dryer_profile(
+                    config.get(option), self.max_temp, ramp_step)
+            except ValueError as e:
+                raise config.error("Option '%s' in section '%s': %s"
+                                   % (option, config.get_name(), e))
+
+        self.job = None
+        self.check_timer = None
+        self.temp_sensor = None
+        self.printer.register_event_handler('klippy:ready', self._handle_ready)
+
+        self.gcode.register_command(
+            'ACE_DRY', self.cmd_ACE_DRY,
+            desc=self.cmd_ACE_DRY_help)
+        self.gcode.register_command(
+            'ACE_DRY_STATUS', self.cmd_ACE_DRY_STATUS,
+            desc=self.cmd_ACE_DRY_STATUS_help)
+        self.gcode.register_command(
+            'ACE_DRY_CANCEL', self.cmd_ACE_DRY_CANCEL,
+            desc=self.cmd_ACE_DRY_CANCEL_help)
+
+    def _handle_ready(self):
+        self.check_timer = self.ace.profiler.register_timer('dryer', self._check_job)
+        # Prefer a configured temperature_ace sensor for stall detection
+        for name, obj in self.printer.lookup_objects('temperature_ace'):
+            if getattr(obj, 'channel', 'temperature') == 'temperature':
+                self.temp_sensor = obj
+                break
+
+    def _current_temp(self, eventtime):
+        if self.temp_sensor is not None:
+            return self.temp_sensor.get_temp(eventtime)[0]
+        return float(self.ace._info.get('temp', 0) or 0)
+
+    def _is_printing(self, eventtime):
+        print_stats = self.printer.lookup_object('print_stats', None)
+        if print_stats is None:
+            return False
+        return print_stats.get_status(eventtime).get('state') in ('printing', 'paused')
+
+    def resolve_profile(self, name):
+        """Return (profile name, stages) for a preset name or 'AUTO'"""
+        name = name.upper()
+        if name != 'AUTO':
+            if name not in self.profiles:
+                raise self.printer.command_error(
+                    "Unknown dryer profile '%s' (known: %s)"
+                    % (name, ', '.join(sorted(self.profiles))))
+            return name, self.profiles[name]
+        # The most heat sensitive loaded material decides the profile
+        best = None
+        for slot in self.ace.slots:
+            material = slot.type.upper()
+            if slot.status != 'ready' or not material:
+                material = slot.ace_type.upper()
+            if material not in self.profiles:
+                continue
+            peak = max(temp for temp, minutes in self.profiles[material])
+            if best is None or peak < best[0]:
+                best = (peak, material)
+        if best is None:
+            raise self.printer.command_error(
+                "No loaded slot matches a dryer profile, use PROFILE=<name>")
+        return best[1], self.profiles[best[1]]
+
+    def start(self, name, stages, when='now'):
+        self.job = {
+            'profile': name,
+            'stages': stages,
+            'when': when,
+            'state': 'waiting',
+            'stage': -1,
+            'stage_start': 0.,
+            'idle_since': None,
+            'progress_temp': 0.,
+            'progress_time': 0.,
+            'resent': False,
+        }
+        self.reactor.update_timer(self.check_timer, self.reactor.NOW)
+
+    def cancel(self, stop_dryer=True):
+        job = self.job
+        self.job = None
+        if job is not None and job['state'] == 'running' and stop_dryer:
+            self.ace.send_request({"method": "drying_stop"}, self._on_response)
+
+    def _on_response(self, ace, response):
+        if 'code' in response and response['code'] != 0:
+            self.gcode.respond_info("ACE: Dryer error: " + str(response.get('msg')))
+
+    def _send_stage(self, job):
+        temp, minutes = job['stages'][job['stage']]
+        # Give the ACE a little slack so it does not stop before the next stage
+        duration = int(minutes) + 2
+        self.ace.send_request(
+            request={"method": "drying", "params": {
+                "temp": temp, "fan_speed": self.fan_speed, "duration": duration}},
+            callback=self._on_response)
+
+    def _start_stage(self, job, index, eventtime):
+        job['stage'] = index
+        job['stage_start'] = eventtime
+        job['progress_temp'] = self._current_temp(eventtime)
+        job['progress_time'] = eventtime
+        job['resent'] = False
+        self._send_stage(job)
+        temp, minutes = job['stages'][index]
+        self.gcode.respond_info(
+            "ACE: Dryer profile %s stage %d/%d: %d°C for %.0f min"
+            % (job['profile'], index + 1, len(job['stages']), temp, minutes))
+
+    def _finish(self, job, state, message):
+        job['state'] = state
+        self.ace.send_request({"method": "drying_stop"}, self._on_response)
+        self.gcode.respond_info(message)
+
+    def _check_job(self, eventtime):
+        job = self.job
+        if job is None or job['state'] in ('done', 'stalled'):
+            return self.reactor.NEVER
+
+        if job['state'] == 'waiting':
+            if job['when'] == 'idle':
+                if self._is_printing(eventtime):
+                    job['idle_since'] = None
+                    return eventtime + DRYER_CHECK_INTERVAL
+                if job['idle_since'] is None:
+                    job['idle_since'] = eventtime
+                if eventtime - job['idle_since'] < self.idle_delay:
+                    return eventtime + DRYER_CHECK_INTERVAL
+            job['state'] = 'running'
+            self._start_stage(job, 0, eventtime)
+            return eventtime + DRYER_CHECK_INTERVAL
+
+        temp, minutes = job['stages'][job['stage']]
+        if eventtime - job['stage_start'] >= minutes * 60.:
+            if job['stage'] + 1 >= len(job['stages']):
+                self._finish(job, 'done', "ACE: Dryer profile %s complete" % (job['profile'],))
+                return self.reactor.NEVER
+            self._start_stage(job, job['stage'] + 1, eventtime)
+            return eventtime + DRYER_CHECK_INTERVAL
+
+        # The ACE stops drying on its own after a reconnect or error
+        dryer = self.ace._info.get('dryer_status') or self.ace._info.get('dryer') or {}
+        if isinstance(dryer, dict) and dryer.get('status') == 'drying':
+            # The resend worked, a later dropout gets its own retry
+            job['resent'] = False
+        elif isinstance(dryer, dict) and eventtime - job['stage_start'] > 30.:
+            if job['resent']:
+                self._finish(job, 'stalled',
+                             "ACE: Dryer is not running, profile %s aborted" % (job['profile'],))
+                return self.reactor.NEVER
+            job['resent'] = True
+            self._send_stage(job)
+
+        # Stall detection: below target and no progress for dryer_stall_time
+        current = self._current_temp(eventtime)
+        if current >= temp - self.stall_tolerance or current >= job['progress_temp'] + 1.:
+            job['progress_temp'] = current
+            job['progress_time'] = eventtime
+        elif eventtime - job['progress_time'] > self.stall_time:
+            self._finish(job, 'stalled',
+                         "ACE: Dryer stalled at %.1f°C (target %d°C), profile %s aborted"
+                         % (current, temp, job['profile']))
+            return self.reactor.NEVER
+        return eventtime + DRYER_CHECK_INTERVAL
+
+    def get_status(self, eventtime=None):
+        job = self.job
+        if job is None:
+            return {'state': 'idle'}
+        status = {
+            'state': job['state'],
+            'profile': job['profile'],
+            'when': job['when'],
+            'stage': job['stage'],
+            'stages': [list(stage) for stage in job['stages']],
+        }
+        if job['state'] == 'running':
+            temp, minutes = job['stages'][job['stage']]
+            now = self.reactor.monotonic()
+            status['target_temp'] = temp
+            status['stage_remaining'] = max(0., minutes - (now - job['stage_start']) / 60.)
+        return status
+
+    cmd_ACE_DRY_help = 'Run a staged drying profile: PROFILE=<name|AUTO> [WHEN=NOW|IDLE]'
+
+    def cmd_ACE_DRY(self, gcmd):
+        name, stages = self.resolve_profile(gcmd.get('PROFILE', 'AUTO'))
+        when = gcmd.get('WHEN', 'NOW').lower()
+        if when not in ('now', 'idle'):
+            raise gcmd.error('WHEN must be NOW or IDLE')
+        self.cancel(stop_dryer=False)
+        self.start(name, stages, when)
+        total = sum(minutes for temp, minutes in stages)
+        gcmd.respond_info("ACE: Dryer profile %s scheduled (%s), %d stages, %.0f min"
+                          % (name, when, len(stages), total))
+
+    cmd_ACE_DRY_STATUS_help = 'Show the dryer profile job'
+
+    def cmd_ACE_DRY_STATUS(self, gcmd):
+        status = self.get_status()
+        if status['state'] == 'idle':
+            gcmd.respond_info("ACE: No dryer profile job")
+            return
+        msg = "ACE: Dryer profile %s %s" % (status['profile'], status['state'])
+        if status['state'] == 'running':
+            msg += ", stage %d/%d at %d°C, %.1f min left (current %.1f°C)" % (
+                status['stage'] + 1, len(status['stages']), status['target_temp'],
+                status['stage_remaining'], self._current_temp(self.reactor.monotonic()))
+        gcmd.respond_info(msg)
+
+    cmd_ACE_DRY_CANCEL_help = 'Cancel the dryer profile job and stop the dryer'
+
+    def cmd_ACE_DRY_CANCEL(self, gcmd):
+        self.cancel()
+        gcmd.respond_info("ACE: Dryer profile cancelled")
+
+class AceAssistMonitor:
+    """Compares ACE feed assist activity with extruder consumption per slot"""
+
+    def __init__(self, ace, config):
+        self.ace = ace
+        self.printer = ace.printer
+        self.reactor = ace.reactor
+        self.gcode = ace.gcode
+        self.enabled = config.getboolean('feed_assist_monitor', False)
+        # Filament (mm) the extruder may consume beyond the learned spacing
+        # between two assist pushes before the slot is flagged
+        self.max_lag = config.getfloat('feed_assist_max_lag', 30., above=0.)
+        # Continuous assist push time (ms) that indicates slip or a tangle
+        self.max_continuous = config.getfloat('feed_assist_max_continuous', 5000., above=0.)
+        self.action = config.getchoice('feed_assist_action', {
+            'warn': 'warn', 'pause': 'pause', 'retry': 'retry'}, 'warn')
+        self.retry_window = config.getfloat('feed_assist_retry_window', 300., above=0.)
+        # Consecutive bad polls needed before acting
+        self.confirm_count = config.getint('feed_assist_confirm', 2, minval=1)
+
+        self._slot = -1
+        self._last_used = 0.
+        self._since_push = 0.
+        self._retry_level = 0
+        self._last_alert_time = -self.retry_window
+        self.stats = [self._new_stats() for i in range(4)]
+
+        self.printer.register_event_handler('ace:status_update', self._handle_status)
+        self.gcode.register_command(
+            'ACE_ASSIST_STATS', self.cmd_ACE_ASSIST_STATS,
+            desc=self.cmd_ACE_ASSIST_STATS_help)
+        self.gcode.register_command(
+            'ACE_ASSIST_MONITOR', self.cmd_ACE_ASSIST_MONITOR,
+            desc=self.cmd_ACE_ASSIST_MONITOR_help)
+
+    def _new_stats(self):
+        return {'pushes': 0, 'consumed': 0., 'mm_per_push': 0.,
+                'lag': 0., 'max_lag': 0., 'max_continuous': 0., 'alerts': 0}
+
+    def _reset_baseline(self, slot, used, count):
+        self._slot = slot
+        self._last_used = used
+        self._since_push = 0.
+        self.ace._last_assist_count = count
+        self.ace._assist_hit_count = 0
+
+    def _handle_status(self, info):
+        if not self.enabled:
+            return
+        ace = self.ace
+        eventtime = self.reactor.monotonic()
+        count = info.get('feed_assist_count', 0) or 0
+        slot = ace._feed_assist_index
+        print_stats = self.printer.lookup_object('print_stats', None)
+        if print_stats is None:
+            return
+        stats = print_stats.get_status(eventtime)
+        used = stats.get('filament_used', 0.)
+        if (slot < 0 or stats.get('state') != 'printing' or ace._park_in_progress
+                or ace.endless_spool_in_progress):
+            self._reset_baseline(-1, used, count)
+            return
+        delta_used = used - self._last_used
+        delta_count = count - ace._last_assist_count
+        if slot != self._slot or delta_used < 0. or delta_count < 0:
+            # New slot, new print or ACE counter reset
+            self._reset_baseline(slot, used, count)
+            return
+        self._last_used = used
+        ace._last_assist_count = count
+
+        slot_stats = self.stats[slot]
+        slot_stats['consumed'] += delta_used
+        self._since_push += delta_used
+        if delta_count > 0:
+            slot_stats['pushes'] += delta_count
+            spacing = self._since_push / delta_count
+            if slot_stats['mm_per_push'] <= 0.:
+                slot_stats['mm_per_push'] = spacing
+            elif spacing <= slot_stats['mm_per_push'] + self.max_lag:
+                # Learn only from normal spacing, not from recovered stalls
+                slot_stats['mm_per_push'] += 0.2 * (spacing - slot_stats['mm_per_push'])
+            self._since_push = 0.
+
+        lag = 0.
+        if slot_stats['mm_per_push'] > 0.:
+            # No starvation check until the push spacing has been learned
+            lag = max(0., self._since_push - slot_stats['mm_per_push'])
+        continuous = info.get('cont_assist_time', 0.) or 0.
+        slot_stats['lag'] = lag
+        slot_stats['max_lag'] = max(slot_stats['max_lag'], lag)
+        slot_stats['max_continuous'] = max(slot_stats['max_continuous'], continuous)
+
+        problem = None
+        if continuous > self.max_continuous:
+            problem = 'slip'
+        elif lag > self.max_lag:
+            problem = 'starvation'
+        if problem is None:
+            ace._assist_hit_count = 0
+            return
+        ace._assist_hit_count += 1
+        if ace._assist_hit_count >= self.confirm_count:
+            # Start a new episode so a persisting problem escalates
+            ace._assist_hit_count = 0
+            self._since_push = 0.
+            self._alert(problem, slot, lag, continuous, eventtime)
+
+    def _alert(self, problem, slot, lag, continuous, eventtime):
+        self.stats[slot]['alerts'] += 1
+        self.gcode.respond_info(
+            "ACE: Feed assist %s on slot %d: lag %.1f mm, continuous assist %.0f ms"
+            % (problem, slot, lag, continuous))
+        if self.action == 'warn':
+            return
+        if self.action == 'pause':
+            self._run_script('PAUSE')
+            return
+        # Retry ladder: restart feed assist, then swap to a matching spool, then pause
+        if eventtime - self._last_alert_time > self.retry_window:
+            self._retry_level = 0
+        self._last_alert_time = eventtime
+        self._retry_level += 1
+        if self._retry_level == 1:
+            self.gcode.respond_info("ACE: Restarting feed assist on slot %d" % (slot,))
+            # merge=False: the start must not cancel the stop it follows
+            self.ace.send_request({"method": "stop_feed_assist", "params": {"index": slot}},
+                                  self._on_response, merge=False)
+            self.ace.send_request({"method": "start_feed_assist", "params": {"index": slot}},
+                                  self._on_response, merge=False)
+            return
+        spare = self.ace._find_next_available_slot(slot) if self._retry_level == 2 else -1
+        if spare != -1:
+            self.gcode.respond_info("ACE: Switching from slot %d to matching slot %d" % (slot, spare))
+            self._run_script('ACE_CHANGE_TOOL TOOL=%d' % (spare,))
+        else:
+            self._run_script('PAUSE')
+
+    def _on_response(self, ace, response):
+        if 'code' in response and response['code'] != 0:
+            self.gcode.respond_info("ACE: Feed assist error: " + str(response.get('msg')))
+
+    def _run_script(self, script):
+        # Status events arrive inside the serial reader timer, so run gcode
+        # from a separate reactor callback to keep the reader responsive
+        def run(eventtime):
+            try:
+                self.gcode.run_script(script)
+            except Exception as e:
+                logging.info('ACE: Feed assist action %s failed: %s' % (script, e))
+        self.reactor.register_callback(run)
+
+    def get_status(self, eventtime=None):
+        return {
+            'enabled': self.enabled,
+            'slot': self._slot,
+            # _sample() changes the entries in place, the status diff needs copies
+            'slots': [dict(stats) for stats in self.stats],
+        }
+
+    cmd_ACE_ASSIST_STATS_help = 'Show feed assist monitor statistics [RESET=1]'
+
+    def cmd_ACE_ASSIST_STATS(self, gcmd):
+        if gcmd.get_int('RESET', 0):
+            self.stats = [self._new_stats() for i in range(4)]
+            self._reset_baseline(-1, self._last_used, self.ace._last_assist_count)
+            gcmd.respond_info("ACE: Feed assist statistics reset")
+            return
+        output = ["ACE: Feed assist monitor %s (action: %s)"
+                  % ('enabled' if self.enabled else 'disabled', self.action)]
+        for i, stats in enumerate(self.stats):
+            output.append(
+                "Slot %d: %d pushes, %.1f mm consumed, %.1f mm/push, lag %.1f mm (max %.1f), "
+                "max continuous %.0f ms, %d alerts"
+                % (i, stats['pushes'], stats['consumed'], stats['mm_per_push'], stats['lag'],
+                   stats['max_lag'], stats['max_continuous'], stats['alerts']))
+        gcmd.respond_info("\n".join(output))
+
+    cmd_ACE_ASSIST_MONITOR_help = 'Enable or disable the feed assist monitor: ENABLE=0|1'
+
+    def cmd_ACE_ASSIST_MONITOR(self, gcmd):
+        self.enabled = bool(gcmd.get_int('ENABLE', 1))
+        self._reset_baseline(-1, self._last_used, self.ace._last_assist_count)
+        gcmd.respond_info("ACE: Feed assist monitor %s" % ('enabled' if self.enabled else 'disabled'))
+
+class AceAssistSync:
+    """
+    Feed assist speed following the extruder
+
+    Samples the filament consumption a few times per second and sets the
+    ACE feeding speed of the assisted slot with update_feeding_speed.
+    Updates need a speed change beyond the hysteresis and are rate
+    limited, so the serial link only sees a handful per minute.
+    """
+
+    def __init__(self, ace, config):
+        self.ace = ace
+        self.printer = ace.printer
+        self.reactor = ace.reactor
+        self.gcode = ace.gcode
+        self.enabled = config.getboolean('feed_assist_sync', False)
+        self.interval = config.getfloat('feed_assist_sync_interval', 0.5, minval=0.1)
+        # ACE speed per mm/s consumed, above 1 keeps the buffer ahead of the extruder
+        self.gain = config.getfloat('feed_assist_sync_gain', 1.2, above=0.)
+        self.min_speed = config.getint('feed_assist_sync_min_speed', 10, minval=1)
+        self.max_speed = config.getint('feed_assist_sync_max_speed', 25, minval=self.min_speed)
+        self.hysteresis = config.getfloat('feed_assist_sync_hysteresis', 2., minval=0.)
+        # Minimum seconds between two speed updates
+        self.min_update_interval = config.getfloat('feed_assist_sync_update_interval', 2., minval=0.)
+
+        self._slot = -1
+        self._last_used = None
+        self._last_time = 0.
+        self.velocity = 0.
+        self.speed = None
+        self._sent_time = -self.min_update_interval
+        self.updates = 0
+        self.timer = None
+
+        self.printer.register_event_handler('klippy:ready', self._handle_ready)
+        self.gcode.register_command(
+            'ACE_ASSIST_SYNC', self.cmd_ACE_ASSIST_SYNC,
+            desc=self.cmd_ACE_ASSIST_SYNC_help)
+
+    def _handle_ready(self):
+        self.timer = self.ace.profiler.register_timer(
+            'assist_sync', self._sample,
+            self.reactor.NOW if self.enabled else self.reactor.NEVER)
+
+    def _reset(self, slot):
+        self._slot = slot
+        self._last_used = None
+        self.velocity = 0.
+        # The ACE starts assisting at its own speed
+        self.speed = None
+
+    def _sample(self, eventtime):
+        if not self.enabled:
+            return self.reactor.NEVER
+        ace = self.ace
+        slot = ace._feed_assist_index
+        print_stats = self.printer.lookup_object('print_stats', None)
+        if (print_stats is None or slot < 0 or ace._park_in_progress
+                or ace.endless_spool_in_progress):
+            self._reset(-1)
+            return eventtime + self.interval
+        stats = print_stats.get_status(eventtime)
+        used = stats.get('filament_used', 0.)
+        if stats.get('state') != 'printing':
+            self._reset(-1)
+            return eventtime + self.interval
+        if slot != self._slot:
+            self._reset(slot)
+        if self._last_used is None or used < self._last_used:
+            self._last_used = used
+            self._last_time = eventtime
+            return eventtime + self.interval
+        rate = (used - self._last_used) / max(eventtime - self._last_time, 1e-3)
+        self._last_used = used
+        self._last_time = eventtime
+        # Smooth over a few samples, retractions and short stops are not a speed change
+        self.velocity += 0.5 * (rate - self.velocity)
+
+        target = int(round(min(self.max_speed, max(self.min_speed, self.velocity * self.gain))))
+        if self.speed is not None and abs(target - self.speed) < self.hysteresis:
+            return eventtime + self.interval
+        if eventtime - self._sent_time < self.min_update_interval:
+            return eventtime + self.interval
+        if ace.send_request({"method": "update_feeding_speed",
+                             "params": {"index": slot, "speed": target}}, self._on_response):
+            self.speed = target
+            self._sent_time = eventtime
+            self.updates += 1
+        return eventtime + self.interval
+
+    def _on_response(self, ace, response):
+        if 'code' in response and response['code'] != 0:
+            logging.info('ACE: Feed assist speed update failed: %s' % (response.get('msg'),))
+
+    def get_status(self, eventtime=None):
+        return {
+            'enabled': self.enabled,
+            'slot': self._slot,
+            'velocity': round(self.velocity, 2),
+            'speed': self.speed,
+            'updates': self.updates,
+        }
+
+    cmd_ACE_ASSIST_SYNC_help = 'Feed assist speed following the extruder: [ENABLE=0|1], no arguments shows the state'
+
+    def cmd_ACE_ASSIST_SYNC(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if enable is not None:
+            self.enabled = bool(enable)
+            self._reset(-1)
+            if self.timer is not None:
+                self.reactor.update_timer(
+                    self.timer, self.reactor.NOW if self.enabled else self.reactor.NEVER)
+        gcmd.respond_info("ACE: Feed assist sync %s, slot %d, extruder %.1f mm/s, ACE speed %s, %d updates" % (
+            'enabled' if self.enabled else 'disabled', self._slot, self.velocity,
+            self.speed if self.speed is not None else '-', self.updates))
+
+_PLAN_TOOL = re.compile(r'^(?:T([0-9]+)|ACE_CHANGE_TOOL\s+TOOL=(-?[0-9]+))\s*$', re.IGNORECASE)
+_PLAN_NUMBER = re.compile(r'-?[0-9]*\.?[0-9]+')
+_PLAN_TYPES = re.compile(r'^;\s*filament_type\s*=\s*(.+)$')
+_PLAN_COLORS = re.compile(r'^;\s*filament_colou?r\s*=\s*(.+)$')
+# Lines after which the scanner thread briefly yields the GIL to klippy
+PLAN_YIELD_LINES = 20000
+# Remaining length must cover the usage by this factor
+PLAN_REMAINING_MARGIN = 1.05
+
+def _plan_e_value(line):
+    """E parameter of a G-code line without comment, None if absent"""
+    i = line.find('E')
+    if i < 0:
+        i = line.find('e')
+        if i < 0:
+            return None
+    comment = line.find(';')
+    if 0 <= comment < i:
+        return None
+    match = _PLAN_NUMBER.match(line, i + 1)
+    return float(match.group(0)) if match else None
+
+def scan_gcode(path):
+    """
+    Tool sequence and per-tool extrusion of a gcode file
+
+    Reads the file line by line; T<n> and ACE_CHANGE_TOOL lines switch the
+    tool, extrusion is summed from G0-G3 E values honoring G90/G91, M82/M83
+    and G92. As in gcode_move, E is relative if either G91 or M83 is active.
+    """
+    sequence = []
+    usage = {}
+    types = None
+    colors = None
+    tool = None
+    absolute_coord = absolute_extrude = True
+    relative = False
+    e_pos = 0.
+    moves = ('G1 ', 'G0 ', 'G2 ', 'G3 ')
+    count = 0
+    with open(path, 'r', errors='replace') as f:
+        for raw in f:
+            count += 1
+            if count == PLAN_YIELD_LINES:
+                count = 0
+                time.sleep(0.001)
+            if raw[:1].isspace():
+                raw = raw.lstrip()
+            if raw.startswith(moves):
+                value = _plan_e_value(raw)
+                if value is None:
+                    continue
+                delta = value if relative else value - e_pos
+                e_pos += delta
+                # Net extrusion, retractions are given back on unretract
+                if tool is not None:
+                    usage[tool] = usage.get(tool, 0.) + delta
+                continue
+            first = raw[:1]
+            if first == ';':
+                match = _PLAN_TYPES.match(raw)
+                if match:
+                    types = [t.strip() for t in match.group(1).split(';')]
+                    continue
+                match = _PLAN_COLORS.match(raw)
+                if match:
+                    colors = [c.strip() for c in match.group(1).split(';')]
+                continue
+            if first not in 'GMTAgmta' or not first:
+                continue
+            line = raw.split(';', 1)[0].strip()
+            word = line.split(None, 1)[0].upper() if line else ''
+            if word == 'G92':
+                value = _plan_e_value(line.upper())
+                if value is not None:
+                    e_pos = value
+            elif word in ('G0', 'G1', 'G2', 'G3'):
+                value = _plan_e_value(line.upper())
+                if value is not None:
+                    delta = value if relative else value - e_pos
+                    e_pos += delta
+                    if tool is not None:
+                        usage[tool] = usage.get(tool, 0.) + delta
+            elif word in ('G90', 'G91', 'M82', 'M83'):
+                if word[0] == 'G':
+                    absolute_coord = word == 'G90'
+                else:
+                    absolute_extrude = word == 'M82'
+                relative = not (absolute_coord and absolute_extrude)
+            else:
+                match = _PLAN_TOOL.match(line)
+                if match is None:
+                    continue
+                tool = int(match.group(1) if match.group(1) is not None else match.group(2))
+                if tool == -1:
+                    tool = None
+                elif not sequence or sequence[-1] != tool:
+                    sequence.append(tool)
+    usage = {t: max(0., mm) for t, mm in usage.items()}
+    return {'sequence': sequence, 'usage': usage, 'types': types, 'colors': colors}
+
+class AceJobPlanner:
+    """
+    Toolchange plan of a print job
+
+    ACE_PLAN_JOB scans the gcode file in a background thread, then checks
+    the tools it uses against the inventory so that a job that cannot
+    finish fails before it starts. While printing the plan position follows
+    ACE_CHANGE_TOOL, which gives the next tool to stage.
+    """
+
+    def __init__(self, ace):
+        self.ace = ace
+        self.printer = ace.printer
+        self.reactor = ace.reactor
+        self.plan = None
+        self.position = 0
+        self._scanning = False
+        ace.gcode.register_command(
+            'ACE_PLAN_JOB', self.cmd_ACE_PLAN_JOB,
+            desc=self.cmd_ACE_PLAN_JOB_help)
+
+    def _resolve(self, filename):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if filename is None:
+            return sdcard.file_path() if sdcard is not None else None
+        filename = os.path.expanduser(filename)
+        if not os.path.isabs(filename) and sdcard is not None:
+            filename = os.path.join(sdcard.sdcard_dirname, filename.lstrip('/'))
+        return filename
+
+    def _scan(self, path):
+        """Run scan_gcode in a thread, wait without blocking the reactor"""
+        completion = self.reactor.completion()
+
+        def run():
+            try:
+                result = scan_gcode(path)
+            except Exception as e:
+                logging.exception('ACE: Gcode scan of %s failed' % (path,))
+                result = {'error': str(e)}
+            self.reactor.register_async_callback(lambda e: completion.complete(result))
+        thread = threading.Thread(target=run, name='ace-plan')
+        thread.daemon = True
+        thread.start()
+        return completion.wait()
+
+    def check(self, scan):
+        """Errors and warnings for running the scanned job with this inventory"""
+        ace = self.ace
+        errors = []
+        warnings = []
+        for tool in sorted(set(scan['sequence'])):
+            if not 0 <= tool < 4:
+                errors.append('T%d has no ACE slot' % (tool,))
+                continue
+            slot = ace.slots[tool]
+            if slot.ace_status != 'ready':
+                errors.append('T%d: slot is %s' % (tool, slot.ace_status))
+                continue
+            types = scan['types']
+            wanted = types[tool] if types and tool < len(types) else None
+            if wanted and slot.type and wanted.upper() != slot.type.upper():
+                errors.append('T%d: job expects %s, slot has %s' % (tool, wanted, slot.type))
+            elif wanted and not slot.type:
+                warnings.append('T%d: job expects %s, slot type not set' % (tool, wanted))
+            needed = scan['usage'].get(tool, 0.) / 1000.
+            remaining = slot.current
+            if isinstance(remaining, (int, float)) and remaining > 0 \
+                    and remaining < needed * PLAN_REMAINING_MARGIN:
+                message = 'T%d: needs %.1fm, spool has %.1fm' % (tool, needed, remaining)
+                spare = ace._find_next_available_slot(tool)
+                if ace.endless_spool_enabled and spare != -1:
+                    warnings.append(message + ', endless spool continues on slot %d' % (spare,))
+                else:
+                    errors.append(message)
+        return errors, warnings
+
+    cmd_ACE_PLAN_JOB_help = ('Check a job against the ACE inventory: '
+                             '[FILE=<gcode>] [STRICT=0|1] [CLEAR=1], defaults to the loaded file')
+
+    def cmd_ACE_PLAN_JOB(self, gcmd):
+        if gcmd.get_int('CLEAR', 0):
+            self.clear()
+            gcmd.respond_info('ACE: Job plan cleared')
+            return
+        if self._scanning:
+            raise gcmd.error('ACE: A job scan is already running')
+        path = self._resolve(gcmd.get('FILE', None))
+        if not path:
+            raise gcmd.error('ACE: FILE is required when no print file is loaded')
+        if not os.path.isfile(path):
+            raise gcmd.error('ACE: File not found: %s' % (path,))
+        strict = gcmd.get_int('STRICT', 1, minval=0, maxval=1)
+        self._scanning = True
+        start = self.reactor.monotonic()
+        try:
+            scan = self._scan(path)
+        finally:
+            self._scanning = False
+        if 'error' in scan:
+            raise gcmd.error('ACE: Unable to read %s: %s' % (path, scan['error']))
+        errors, warnings = self.check(scan)
+        self.plan = {
+            'file': os.path.basename(path),
+            'sequence': scan['sequence'],
+            'usage': {tool: round(mm / 1000., 2) for tool, mm in scan['usage'].items()},
+            'types': scan['types'],
+            'colors': scan['colors'],
+            'errors': errors,
+            'warnings': warnings,
+        }
+        self.position = 0
+
+        lines = ["ACE: Plan for %s (%.1fs): %d toolchanges, tools %s" % (
+            self.plan['file'], self.reactor.monotonic() - start,
+            max(0, len(scan['sequence']) - 1),
+            ', '.join('T%d' % (t,) for t in sorted(set(scan['sequence']))) or 'none')]
+        for tool, meters in sorted(self.plan['usage'].items()):
+            lines.append("  T%d: %.2fm" % (tool, meters))
+        lines.extend("  Warning: " + w for w in warnings)
+        lines.extend("  Error: " + e for e in errors)
+        gcmd.respond_info("\n".join(lines))
+        if errors and strict:
+            raise gcmd.error('ACE: Job cannot be completed with the loaded spools')
+
+    def tool_changed(self, tool):
+        """Advance the plan when ACE_CHANGE_TOOL loads a tool"""
+        if self.plan is None:
+            return
+        sequence = self.plan['sequence']
+        try:
+            self.position = sequence.index(tool, self.position) + 1
+        except ValueError:
+            pass
+
+    def next_tool(self):
+        """Tool after the loaded one, None when unknown"""
+        if self.plan is None or self.position >= len(self.plan['sequence']):
+            return None
+        return self.plan['sequence'][self.position]
+
+    def clear(self):
+        self.plan = None
+        self.position = 0
+
+    def get_status(self, eventtime=None):
+        plan = self.plan
+        if plan is None:
+            return {'file': None}
+        return {
+            'file': plan['file'],
+            'toolchanges': max(0, len(plan['sequence']) - 1),
+            'position': self.position,
+            'next_tool': self.next_tool(),
+            'usage': plan['usage'],
+            'errors': plan['errors'],
+            'warnings': plan['warnings'],
+        }
+
+# Weight of the newest measurement in the learned transition times
+COST_SMOOTHING = 0.3
+# Color distance at which the full purge length is used
+COST_FULL_PURGE_DISTANCE = 150.
+# Lightness gained weighs this much more, light after dark needs more flushing
+COST_LIGHTEN_FACTOR = 1.5
+
+def _parse_color(color):
+    """[r, g, b] from an inventory list or a slicer '#RRGGBB', None if unknown"""
+    if isinstance(color, str):
+        color = color.strip().lstrip('#')
+        if len(color) < 6:
+            return None
+        try:
+            return [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+        except ValueError:
+            return None
+    if isinstance(color, (list, tuple)) and len(color) >= 3:
+        return list(color[:3])
+    return None
+
+def _color_lab(rgb):
+    """CIELAB (D65) of an sRGB color"""
+    def linear(c):
+        c = max(0., min(255., float(c))) / 255.
+        return c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4
+
+    def f(t):
+        return t ** (1. / 3.) if t > 0.008856 else 7.787 * t + 16. / 116.
+    r, g, b = [linear(c) for c in rgb]
+    x = f((0.4124 * r + 0.3576 * g + 0.1805 * b) / 0.95047)
+    y = f(0.2126 * r + 0.7152 * g + 0.0722 * b)
+    z = f((0.0193 * r + 0.1192 * g + 0.9505 * b) / 1.08883)
+    return 116. * y - 16., 500. * (x - y), 200. * (y - z)
+
+def color_distance(src, dst):
+    """Delta E (CIE76) from src to dst, lightness gains weighted up"""
+    l1, a1, b1 = _color_lab(src)
+    l2, a2, b2 = _color_lab(dst)
+    dl = l2 - l1
+    if dl > 0:
+        dl *= COST_LIGHTEN_FACTOR
+    return math.sqrt(dl * dl + (a2 - a1) ** 2 + (b2 - b1) ** 2)
+
+class AceToolchangeCosts:
+    """
+    Cost of each slot to slot toolchange
+
+    Swap times are learned from the toolchange timing, excluding the
+    _ACE_POST_TOOLCHANGE purge. The purge length is computed from the color
+    distance of the two filaments and handed to _ACE_POST_TOOLCHANGE as
+    PURGE_LENGTH. ACE_ADVISE_SLOTS combines both for a job plan.
+    """
+
+    def __init__(self, ace, config):
+        self.ace = ace
+        self.gcode = ace.gcode
+        self.purge_min = config.getfloat('purge_min_length', 30., minval=0.)
+        self.purge_max = config.getfloat('purge_max_length', 100., minval=self.purge_min)
+        # Only used to estimate the purge time, the macro sets the real speed
+        self.purge_speed = config.getfloat('purge_speed', 8., above=0.)
+        # "from>to" -> {'time': seconds, 'count': toolchanges}
+        self.times = dict(ace.variables.get('ace_toolchange_costs') or {})
+        self.last_purge = None
+        self.gcode.register_command(
+            'ACE_TOOLCHANGE_COSTS', self.cmd_ACE_TOOLCHANGE_COSTS,
+            desc=self.cmd_ACE_TOOLCHANGE_COSTS_help)
+        self.gcode.register_command(
+            'ACE_ADVISE_SLOTS', self.cmd_ACE_ADVISE_SLOTS,
+            desc=self.cmd_ACE_ADVISE_SLOTS_help)
+
+    def purge_length(self, src, dst):
+        """Purge in mm after changing from filament src to dst (inventory slots or None)"""
+        if dst is None:
+            return 0.
+        if src is None:
+            return self.purge_max
+        # An empty or never set slot still has the default black color,
+        # it tells nothing about the filament
+        if src.get('status', 'ready') != 'ready' or dst.get('status', 'ready') != 'ready':
+            return self.purge_max
+        src_type = str(src.get('type') or '').upper()
+        dst_type = str(dst.get('type') or '').upper()
+        if not src_type or not dst_type or src_type != dst_type:
+            return self.purge_max
+        src_color = _parse_color(src.get('color'))
+        dst_color = _parse_color(dst.get('color'))
+        if src_color is None or dst_color is None:
+            return self.purge_max
+        share = min(1., color_distance(src_color, dst_color) / COST_FULL_PURGE_DISTANCE)
+        return round(self.purge_min + (self.purge_max - self.purge_min) * share, 1)
+
+    def toolchange_purge(self, was, tool):
+        """PURGE_LENGTH for ACE_CHANGE_TOOL from slot was to slot tool"""
+        slots = self.ace.slots
+        purge = self.purge_length(slots[was].to_dict() if was != -1 else None,
+                                  slots[tool].to_dict() if tool != -1 else None)
+        self.last_purge = {'from': was, 'to': tool, 'length': purge}
+        return purge
+
+    def record(self, stats):
+        """Learn the swap time of a finished toolchange (from _timing_end)"""
+        if not stats or stats['kind'] != 'toolchange' or stats['result'] != 'ok':
+            return
+        if stats['from'] == -1 or stats['to'] == -1:
+            return
+        post = stats['phases'].get('post_toolchange', {}).get('time', 0.)
+        swap = max(0., stats['time'] - post)
+        key = '%d>%d' % (stats['from'], stats['to'])
+        entry = self.times.get(key)
+        if entry is None:
+            entry = {'time': swap, 'count': 0}
+        else:
+            entry['time'] += COST_SMOOTHING * (swap - entry['time'])
+        entry['time'] = round(entry['time'], 2)
+        entry['count'] += 1
+        self.times[key] = entry
+        self._save()
+
+    def _save(self):
+        self.ace.variables['ace_toolchange_costs'] = self.times
+        self.gcode.run_script_from_command(
+            "SAVE_VARIABLE VARIABLE=ace_toolchange_costs VALUE='%s'" % (json.dumps(self.times),))
+
+    def swap_time(self, src, dst):
+        """Learned seconds from slot src to dst, estimated from similar pairs when unmeasured"""
+        entry = self.times.get('%d>%d' % (src, dst))
+        if entry is not None:
+            return entry['time']
+        for match in ('>%d' % (dst,), '%d>' % (src,), '>'):
+            times = [e['time'] for k, e in self.times.items() if match in k]
+            if times:
+                return sum(times) / len(times)
+        return None
+
+    def advise(self, sequence, filaments):
+        """
+        Cost of a tool sequence on the current slots and on the fastest
+        assignment of job tools to slots. filaments maps job tool to the
+        inventory-like filament it prints with.
+        """
+        transitions = collections.Counter(
+            (a, b) for a, b in zip(sequence, sequence[1:]) if a != b)
+        tools = sorted(set(t for t in sequence if 0 <= t < 4))
+        purge = sum(n * self.purge_length(filaments.get(a), filaments.get(b))
+                    for (a, b), n in transitions.items())
+        result = {
+            'toolchanges': sum(transitions.values()),
+            'purge': round(purge, 1),
+            'purge_fixed': round(sum(transitions.values()) * self.purge_max, 1),
+            'purge_time': round(purge / self.purge_speed, 1),
+            'current': None,
+            'best': None,
+            'assignment': None,
+        }
+        if not self.times or any(not 0 <= t < 4 for t in sequence):
+            return result
+
+        def total(mapping):
+            return sum(n * self.swap_time(mapping[a], mapping[b])
+                       for (a, b), n in transitions.items())
+        current = {t: t for t in tools}
+        result['current'] = round(total(current), 1)
+        best = (total(current), current)
+        for slots in itertools.permutations(range(4), len(tools)):
+            mapping = dict(zip(tools, slots))
+            cost = total(mapping)
+            if cost < best[0] - 0.05:
+                best = (cost, mapping)
+        result['best'] = round(best[0], 1)
+        result['assignment'] = best[1]
+        return result
+
+    cmd_ACE_TOOLCHANGE_COSTS_help = 'Show learned toolchange times and purge lengths: [RESET=1]'
+
+    def cmd_ACE_TOOLCHANGE_COSTS(self, gcmd):
+        if gcmd.get_int('RESET', 0):
+            self.times = {}
+            self._save()
+            gcmd.respond_info('ACE: Toolchange costs reset')
+            return
+        inventory = [slot.to_dict() for slot in self.ace.slots]
+        lines = ['ACE: Toolchange costs, swap time (s) / purge (mm)',
+                 '      ' + ''.join('%14s' % ('to %d' % (dst,)) for dst in range(4))]
+        for src in range(4):
+            cells = []
+            for dst in range(4):
+                if src == dst:
+                    cells.append('%14s' % ('-',))
+                    continue
+                entry = self.times.get('%d>%d' % (src, dst))
+                seconds = '%.1f' % (entry['time'],) if entry else '?'
+                cells.append('%14s' % ('%s / %.0f' % (
+                    seconds, self.purge_length(inventory[src], inventory[dst])),))
+            lines.append('from %d' % (src,) + ''.join(cells))
+        lines.append('%d transitions measured' % (len(self.times),))
+        gcmd.respond_info('\n'.join(lines))
+
+    cmd_ACE_ADVISE_SLOTS_help = ('Suggest the slots to load a job into for the shortest toolchanges: '
+                                 '[FILE=<gcode>], defaults to the ACE_PLAN_JOB plan')
+
+    def cmd_ACE_ADVISE_SLOTS(self, gcmd):
+        planner = self.ace.planner
+        filename = gcmd.get('FILE', None)
+        if filename is not None:
+            path = planner._resolve(filename)
+            if not path or not os.path.isfile(path):
+                raise gcmd.error('ACE: File not found: %s' % (filename,))
+            scan = planner._scan(path)
+            if 'error' in scan:
+                raise gcmd.error('ACE: Unable to read %s: %s' % (path, scan['error']))
+            name = os.path.basename(path)
+        elif planner.plan is not None:
+            scan = planner.plan
+            name = scan['file']
+        else:
+            raise gcmd.error('ACE: Run ACE_PLAN_JOB first or pass FILE')
+
+        # Job tools print with the slicer filament when known, else with the loaded spool
+        filaments = {}
+        for tool in set(scan['sequence']):
+            if not 0 <= tool < 4:
+                continue
+            filament = dict(self.ace.slots[tool].to_dict())
+            types, colors = scan.get('types'), scan.get('colors')
+            if types and tool < len(types) and types[tool]:
+                filament['type'] = types[tool]
+            if colors and tool < len(colors) and _parse_color(colors[tool]):
+                filament['color'] = _parse_color(colors[tool])
+                if types and tool < len(types) and types[tool]:
+                    # Fully described by the slicer, whatever the slot holds
+                    filament['status'] = 'ready'
+            filaments[tool] = filament
+        advice = self.advise(scan['sequence'], filaments)
+
+        lines = ['ACE: Slot advice for %s, %d toolchanges' % (name, advice['toolchanges']),
+                 '  Purge: %.0fmm (%.0fmm at purge_max_length), ~%.0fs' % (
+                     advice['purge'], advice['purge_fixed'], advice['purge_time'])]
+        if advice['current'] is None:
+            lines.append('  Swap time: no toolchange measurements yet')
+        else:
+            lines.append('  Swap time with the current slots: %.0fs' % (advice['current'],))
+            mapping = advice['assignment']
+            if advice['best'] < advice['current'] and any(t != s for t, s in mapping.items()):
+                lines.append('  Faster: %s: %.0fs (-%.0fs)' % (
+                    ', '.join('T%d in slot %d' % (t, s) for t, s in sorted(mapping.items())),
+                    advice['best'], advice['current'] - advice['best']))
+            else:
+                lines.append('  The current slots are the fastest')
+        gcmd.respond_info('\n'.join(lines))
+
+    def get_status(self, eventtime=None):
+        # record() changes the entries in place, a copy lets the status diff see it
+        return {
+            'times': {key: dict(entry) for key, entry in self.times.items()},
+            'last_purge': self.last_purge,
+        }
+
+MMU_SENSORS = ('splitter_sensor', 'extruder_sensor', 'toolhead_sensor')
+
+class AceSensorManager:
+    """
+    The MMU filament sensors created by _create_mmu_sensor, resolved once
+
+    present() returns the state the runout helper keeps from the sensor's
+    button events and never touches the toolhead. query() reads the endstop
+    from the MCU after the queued moves, which flushes the toolhead queue,
+    for the few places that need it. watch() gives a completion that the
+    sensor's next matching state change completes.
+    """
+
+    def __init__(self, ace):
+        self.ace = ace
+        self.reactor = ace.reactor
+        self.helpers = {}
+        self._watchers = {name: [] for name in MMU_SENSORS}
+        for name in MMU_SENSORS:
+            sensor = ace.printer.lookup_object('filament_switch_sensor %s' % (name,), None)
+            if sensor is not None:
+                self.helpers[name] = sensor.runout_helper
+                self._hook(name, sensor.runout_helper)
+
+    def _hook(self, name, helper):
+        note = getattr(helper, 'note_filament_present', None)
+        if note is None:
+            return
+
+        def hook(*args):
+            note(*args)
+            if self._watchers[name]:
+                self._notify(name, bool(helper.filament_present))
+        helper.note_filament_present = hook
+
+    def _notify(self, name, state):
+        watchers = self._watchers[name]
+        for watcher in [w for w in watchers if w[0] == state]:
+            watchers.remove(watcher)
+            watcher[1].complete(True)
+
+    def present(self, name):
+        """Cached filament state, None without that sensor"""
+        helper = self.helpers.get(name)
+        if helper is None:
+            return None
+        return bool(helper.filament_present)
+
+    def query(self, name):
+        """Endstop state read from the MCU, flushes the toolhead queue"""
+        endstop = self.ace.endstops.get(name)
+        if endstop is None:
+            return self.present(name)
+        print_time = self.ace.toolhead.get_last_move_time()
+        return bool(endstop.query_endstop(print_time))
+
+    def watch(self, name, present):
+        """Completion completed when the sensor changes to present"""
+        completion = self.reactor.completion()
+        if name in self.helpers:
+            self._watchers[name].append((present, completion))
+        return completion
+
+    def unwatch(self, name, completion):
+        watchers = self._watchers.get(name, [])
+        watchers[:] = [w for w in watchers if w[1] is not completion]
+
+    def get_status(self, eventtime=None):
+        return {name: self.present(name) for name in MMU_SENSORS}
+
+# Toolchange phases in which the new tool's filament is the one in the path
+JOURNAL_LOAD_PHASES = ('feed_bowden', 'wait_extruder_sensor', 'load_toolhead', 'load_nozzle')
+
+def resolve_journal(entry, present):
+    """
+    (ace_current_index, ace_filament_pos) after the interrupted transaction
+    entry given each MMU sensor's filament state, None when it cannot be
+    told which slot's filament is in the path
+    """
+    was, tool, phase = entry['from'], entry['to'], entry['phase']
+    if entry['kind'] == 'endless_spool':
+        # The old spool ran out, the new one counts once it reached the splitter
+        index = tool if present.get('splitter_sensor') else was
+        return index, entry['pos'] or 'nozzle'
+    if phase == 'post_toolchange':
+        # Only the macro and saving the state were cut short
+        return (tool, 'nozzle') if tool != -1 else (-1, 'splitter')
+    if present.get('toolhead_sensor') or present.get('extruder_sensor'):
+        # The unload in ACE_CHANGE_TOOL backs it out of the extruder first
+        pos = 'toolhead'
+    elif present.get('splitter_sensor'):
+        pos = 'bowden'
+    else:
+        return -1, 'splitter'
+    index = tool if phase in JOURNAL_LOAD_PHASES else was
+    if index == -1:
+        return None
+    return index, pos
+
+class AceJournal:
+    """
+    Append-only journal of the running toolchange or endless spool switch
+
+    begin() empties the file and writes the transaction; each phase is
+    written and fsynced, filament position changes within a phase are only
+    written. A successful end() empties the file again after the final
+    state was saved. At startup a transaction left in the file is resolved
+    against the MMU sensors (resolve_journal) and saved as ace_current_index
+    and ace_filament_pos.
+    """
+
+    def __init__(self, ace, config):
+        self.ace = ace
+        self.reactor = ace.reactor
+        path = config.get('journal_file', None)
+        if path is None:
+            # Next to the saved variables, on the same persistent storage
+            save_variables = ace.printer.lookup_object('save_variables', None)
+            filename = getattr(save_variables, 'filename', None)
+            if filename:
+                path = os.path.join(os.path.dirname(filename), 'ace_journal.jsonl')
+        self.path = os.path.expanduser(path) if path else None
+        self.recover_on_start = config.getboolean('journal_recover', True)
+        self.fd = None
+        self.active = False
+        self.syncs = 0
+        self.last_recovery = None
+        ace.printer.register_event_handler('klippy:ready', self._handle_ready)
+        ace.printer.register_event_handler('klippy:disconnect', self._close)
+        ace.gcode.register_command(
+            'ACE_RECOVER', self.cmd_ACE_RECOVER,
+            desc=self.cmd_ACE_RECOVER_help)
+
+    def _handle_ready(self):
+        if self.path and self.recover_on_start:
+            # The sensor queries need the toolhead and a running reactor
+            self.reactor.register_callback(self._recover_startup)
+
+    def _recover_startup(self, eventtime):
+        try:
+            message = self.recover(self.ace.gcode.run_script)
+        except Exception as e:
+            logging.exception('ACE: Journal recovery failed')
+            message = 'ACE: Journal recovery failed: %s' % (e,)
+        if message:
+            logging.info(message)
+            self.ace.gcode.respond_info(message)
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _write(self, record, sync=False):
+        if self.fd is None:
+            return
+        try:
+            os.write(self.fd, (json.dumps(record, separators=(',', ':')) + '\n').encode())
+            if sync:
+                os.fsync(self.fd)
+                self.syncs += 1
+        except OSError as e:
+            logging.info('ACE: Journal write failed: %s' % (e,))
+
+    def _truncate(self):
+        try:
+            os.ftruncate(self.fd, 0)
+            os.fsync(self.fd)
+            self.syncs += 1
+        except OSError as e:
+            logging.info('ACE: Journal truncate failed: %s' % (e,))
+
+    def begin(self, kind, was, tool):
+        if self.path is None:
+            return
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            except OSError as e:
+                logging.info('ACE: Cannot open journal %s: %s' % (self.path, e))
+                self.path = None
+                return
+        self._truncate()
+        self.active = True
+        variables = self.ace.variables
+        self._write({'op': 'begin', 'kind': kind, 'from': was, 'to': tool,
+                     'pos': variables.get('ace_filament_pos'), 'time': time.time()}, sync=True)
+
+    def phase(self, name):
+        if self.active:
+            self._write({'op': 'phase', 'name': name}, sync=True)
+
+    def position(self, pos):
+        if self.active:
+            self._write({'op': 'pos', 'pos': pos})
+
+    def end(self, result):
+        if not self.active:
+            return
+        self.active = False
+        if result == 'ok':
+            self._truncate()
+        else:
+            # Left for recovery, the saved state was not updated
+            self._write({'op': 'end', 'result': result}, sync=True)
+
+    def pending(self):
+        """The transaction left in the journal file, None if there is none"""
+        if self.path is None:
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError):
+            return None
+        entry = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn write of the last record
+                continue
+            op = record.get('op')
+            if op == 'begin':
+                entry = {'kind': record.get('kind'), 'from': record.get('from', -1),
+                         'to': record.get('to', -1), 'pos': record.get('pos'),
+                         'phase': None, 'result': None, 'time': record.get('time')}
+            elif entry is None:
+                continue
+            elif op == 'phase':
+                entry['phase'] = record.get('name')
+            elif op == 'pos':
+                entry['pos'] = record.get('pos')
+            elif op == 'end':
+                entry['result'] = record.get('result')
+        if entry is None or entry['result'] == 'ok':
+            return None
+        return entry
+
+    def recover(self, run_script):
+        """Resolve and save the state of a journaled transaction, a message or None"""
+        entry = self.pending()
+        if entry is None:
+            return None
+        self.active = False
+        start = self.reactor.monotonic()
+        describe = '%s %s => %s (%s)' % (entry['kind'], entry['from'], entry['to'],
+                                         entry['phase'] or 'not started')
+        present = {name: self.ace.sensors.query(name) for name in MMU_SENSORS}
+        resolved = resolve_journal(entry, present)
+        self.last_recovery = {'transaction': entry, 'sensors': present, 'index': None,
+                              'pos': None, 'time': None}
+        if resolved is None:
+            return ('ACE: Interrupted %s left filament of an unknown slot in the path, '
+                    'pull it back and run RESET_INDEX' % (describe,))
+        index, pos = resolved
+        variables = self.ace.variables
+        variables['ace_current_index'] = index
+        variables['ace_filament_pos'] = pos
+        run_script("SAVE_VARIABLE VARIABLE=ace_current_index VALUE=%d\n"
+                   "SAVE_VARIABLE VARIABLE=ace_filament_pos VALUE='\"%s\"'" % (index, pos))
+        if self.fd is not None:
+            self._truncate()
+        else:
+            try:
+                open(self.path, 'w').close()
+            except (IOError, OSError) as e:
+                logging.info('ACE: Journal truncate failed: %s' % (e,))
+        self.last_recovery.update(index=index, pos=pos,
+                                  time=round(self.reactor.monotonic() - start, 3))
+        return ('ACE: Recovered interrupted %s: current index %d, filament at %s'
+                % (describe, index, pos))
+
+    cmd_ACE_RECOVER_help = 'Resolve an interrupted toolchange from the journal and the sensors'
+
+    def cmd_ACE_RECOVER(self, gcmd):
+        if self.path is None:
+            raise gcmd.error('ACE: No journal_file and no save_variables filename')
+        message = self.recover(self.ace.gcode.run_script_from_command)
+        gcmd.respond_info(message or 'ACE: No interrupted toolchange in the journal')
+
+    def get_status(self, eventtime=None):
+        return {
+            'file': self.path,
+            'active': self.active,
+            'syncs': self.syncs,
+            'last_recovery': self.last_recovery,
+        }
+
+# get_filament_info fields kept per slot
+FILAMENT_INFO_FIELDS = ('sku', 'brand', 'type', 'color', 'diameter',
+                        'extruder_temp', 'hotbed_temp', 'total', 'current')
+# Fields that describe the spool but are not part of the user's inventory entry
+FILAMENT_META_FIELDS = ('brand', 'diameter', 'extruder_temp', 'hotbed_temp',
+                        'total', 'current')
+RFID_IDENTIFIED = 2
+# An unanswered fetch stops blocking new ones after this many seconds
+FILAMENT_FETCH_TIMEOUT = 5.
+
+# Version of the saved ace_inventory entries: 1 was free-form, 2 is AceSlot.to_dict()
+SLOT_SCHEMA_VERSION = 2
+SLOT_STATUSES = ('ready', 'empty')
+
+def _slot_color(value):
+    """[r, g, b] from a list, 'R,G,B' or '#RRGGBB'"""
+    if isinstance(value, str):
+        text = value.strip()
+        if text.startswith('#'):
+            value = _parse_color(text)
+        else:
+            value = [part for part in text.split(',')]
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise ValueError('color must be R,G,B')
+    return [max(0, min(255, int(c))) for c in value]
+
+def _slot_status(value):
+    if value not in SLOT_STATUSES:
+        raise ValueError('status must be ready or empty')
+    return value
+
+def _slot_temp(value):
+    temp = int(value)
+    if temp < 0:
+        raise ValueError('temp must not be negative')
+    return temp
+
+def _slot_text(value):
+    return '' if value is None else str(value)
+
+def _slot_rfid(value):
+    # Saved as "0", 0, True or 2 over time
+    return int(value) if value not in (None, '') else 0
+
+# field -> (default, coercion) of the saved inventory entry
+SLOT_SCHEMA = collections.OrderedDict([
+    ('status', ('empty', _slot_status)),
+    ('color', ([0, 0, 0], _slot_color)),
+    ('type', ('', _slot_text)),
+    ('temp', (0, _slot_temp)),
+    ('sku', ('', _slot_text)),
+    ('rfid', (0, _slot_rfid)),
+])
+# Last get_status poll of the slot, not saved
+SLOT_POLL_FIELDS = ('status', 'sku', 'type', 'color', 'rfid')
+
+class AceSlot:
+    """
+    One ACE slot: the inventory entry and the slot's last get_status poll
+
+    The inventory fields follow SLOT_SCHEMA and are validated on every
+    change; RFID metadata (FILAMENT_META_FIELDS) is kept while known.
+    Polls update the ace_* fields in place. to_dict() and to_status() are
+    rebuilt only after a change, so get_status hands out the same objects
+    while nothing happens.
+    """
+    __slots__ = (('index',) + tuple(SLOT_SCHEMA) + FILAMENT_META_FIELDS
+                 + tuple('ace_' + f for f in SLOT_POLL_FIELDS) + ('_saved', '_status'))
+
+    def __init__(self, index):
+        self.index = index
+        for field, (default, coerce) in SLOT_SCHEMA.items():
+            setattr(self, field, list(default) if isinstance(default, list) else default)
+        for field in FILAMENT_META_FIELDS:
+            setattr(self, field, None)
+        self.ace_status = 'empty'
+        self.ace_sku = ''
+        self.ace_type = ''
+        self.ace_color = [0, 0, 0]
+        self.ace_rfid = 0
+        self._saved = None
+        self._status = None
+
+    def set(self, **fields):
+        """Validated update of inventory and metadata fields, True if anything changed"""
+        values = {}
+        for field, value in fields.items():
+            if field in SLOT_SCHEMA:
+                value = SLOT_SCHEMA[field][1](value)
+            elif field not in FILAMENT_META_FIELDS:
+                raise ValueError('unknown slot field %s' % (field,))
+            values[field] = value
+        changed = False
+        for field, value in values.items():
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+        if changed:
+            self._saved = self._status = None
+        return changed
+
+    def clear(self):
+        """Empty inventory entry, the spool was removed"""
+        fields = {field: default for field, (default, coerce) in SLOT_SCHEMA.items()}
+        fields.update((field, None) for field in FILAMENT_META_FIELDS)
+        return self.set(**fields)
+
+    def load(self, data, version=SLOT_SCHEMA_VERSION):
+        """Restore a saved entry, invalid or unknown fields keep their defaults"""
+        if not isinstance(data, dict):
+            return
+        for field in tuple(SLOT_SCHEMA) + FILAMENT_META_FIELDS:
+            if data.get(field) is None:
+                continue
+            try:
+                self.set(**{field: data[field]})
+            except (ValueError, TypeError):
+                logging.info('ACE: Ignoring saved slot %d %s=%r (schema version %s)'
+                             % (self.index, field, data[field], version))
+
+    def update_from_poll(self, data):
+        """Take the slot's get_status entry, True if it changed"""
+        status = data.get('status', 'empty')
+        sku = data.get('sku') or ''
+        slot_type = data.get('type') or ''
+        color = data.get('color') or [0, 0, 0]
+        rfid = data.get('rfid') or 0
+        if (status == self.ace_status and sku == self.ace_sku and slot_type == self.ace_type
+                and color == self.ace_color and rfid == self.ace_rfid):
+            return False
+        self.ace_status = status
+        self.ace_sku = sku
+        self.ace_type = slot_type
+        self.ace_color = color
+        self.ace_rfid = rfid
+        self._status = None
+        return True
+
+    @property
+    def ready(self):
+        """Loaded according to both the inventory and the ACE"""
+        return self.status == 'ready' and self.ace_status == 'ready'
+
+    def to_dict(self):
+        """Saved inventory entry (schema SLOT_SCHEMA_VERSION)"""
+        if self._saved is None:
+            saved = {'index': self.index}
+            for field in SLOT_SCHEMA:
+                saved[field] = getattr(self, field)
+            for field in FILAMENT_META_FIELDS:
+                value = getattr(self, field)
+                if value is not None:
+                    saved[field] = value
+            self._saved = saved
+        return self._saved
+
+    def to_status(self):
+        """The ACE's view of the slot, with the RFID metadata of the same spool"""
+        if self._status is None:
+            status = {'index': self.index, 'status': self.ace_status, 'sku': self.ace_sku,
+                      'type': self.ace_type, 'color': self.ace_color, 'rfid': self.ace_rfid}
+            if self.ace_sku and self.ace_sku == self.sku:
+                for field in FILAMENT_META_FIELDS:
+                    value = getattr(self, field)
+                    if value is not None:
+                        status[field] = value
+            self._status = status
+        return self._status
+
+def load_inventory(slots, saved, version):
+    """Fill AceSlots from the saved ace_inventory list"""
+    if isinstance(saved, str):
+        try:
+            saved = json.loads(saved)
+        except ValueError:
+            saved = None
+    if not isinstance(saved, list):
+        return
+    if version > SLOT_SCHEMA_VERSION:
+        logging.warning('ACE: ace_inventory was saved with a newer schema (%s)' % (version,))
+    for position, data in enumerate(saved):
+        index = data.get('index', position) if isinstance(data, dict) else position
+        if isinstance(index, int) and 0 <= index < len(slots):
+            slots[index].load(data, version)
+
+class AceFilamentCache:
+    """
+    RFID filament metadata per slot
+
+    get_filament_info is sent once when a slot's get_status entry changes to
+    an identified tag with a new SKU, and the result is merged into the
+    inventory. Concurrent fetches for a slot share one request; emptying the
+    slot drops the entry.
+    """
+
+    def __init__(self, ace):
+        self.ace = ace
+        self.reactor = ace.reactor
+        self.entries = [None] * 4
+        self.fetches = 0
+        self._seen = [None] * 4
+        self._generation = [0] * 4
+        self._inflight = {}  # slot -> (send time, waiting callbacks)
+        # Entries merged into the saved inventory before the restart
+        for index, slot in enumerate(ace.slots):
+            if slot.sku and slot.brand is not None:
+                entry = {key: getattr(slot, key) for key in FILAMENT_INFO_FIELDS}
+                self.entries[index] = {k: v for k, v in entry.items() if v is not None}
+        ace.printer.register_event_handler('ace:status_update', self._handle_status)
+
+    def _handle_status(self, info):
+        for index, slot in enumerate(self.ace.slots):
+            key = (slot.ace_status, slot.ace_sku, slot.ace_rfid)
+            if key == self._seen[index]:
+                continue
+            self._seen[index] = key
+            if slot.ace_status == 'empty':
+                self.invalidate(index)
+            elif slot.ace_rfid == RFID_IDENTIFIED:
+                entry = self.entries[index]
+                if entry is None or entry.get('sku') != slot.ace_sku:
+                    self.fetch(index)
+
+    def invalidate(self, index):
+        self.entries[index] = None
+        # A response still in flight belongs to the old spool
+        self._generation[index] += 1
+
+    def fetch(self, index, callback=None):
+        """Request get_filament_info unless a request for the slot is pending"""
+        now = self.reactor.monotonic()
+        pending = self._inflight.get(index)
+        if pending is not None and now - pending[0] < FILAMENT_FETCH_TIMEOUT:
+            if callback is not None:
+                pending[1].append(callback)
+            return
+        waiters = [callback] if callback is not None else []
+        self._inflight[index] = (now, waiters)
+        generation = self._generation[index]
+
+        def on_response(ace, response):
+            if self._inflight.get(index, (None, None))[1] is waiters:
+                del self._inflight[index]
+            result = response.get('result')
+            if (isinstance(result, dict) and response.get('code', 0) == 0
+                    and result.get('rfid') == RFID_IDENTIFIED
+                    and generation == self._generation[index]):
+                self._store(index, result)
+            for waiter in waiters:
+                waiter(response)
+
+        if not self.ace.send_request(
+                {"method": "get_filament_info", "params": {"index": index}}, on_response):
+            del self._inflight[index]
+
+    def _store(self, index, result):
+        entry = {key: result[key] for key in FILAMENT_INFO_FIELDS if key in result}
+        self.entries[index] = entry
+        self.fetches += 1
+        slot = self.ace.slots[index]
+        fields = {key: entry[key] for key in FILAMENT_META_FIELDS if key in entry}
+        if slot.sku != entry.get('sku') or slot.status != 'ready':
+            # A new spool: the tag replaces what was entered for the old one
+            fields.update(status='ready', sku=entry.get('sku', ''),
+                          type=entry.get('type', slot.type),
+                          color=entry.get('color', slot.color),
+                          rfid=RFID_IDENTIFIED)
+            temps = entry.get('extruder_temp') or {}
+            if temps.get('min') and temps.get('max'):
+                fields['temp'] = (temps['min'] + temps['max']) // 2
+        try:
+            changed = slot.set(**fields)
+        except (ValueError, TypeError) as e:
+            logging.info('ACE: Ignoring filament info of slot %d: %s' % (index, e))
+            return
+        if changed:
+            # Responses arrive inside the serial reader timer
+            self.ace._save_inventory(deferred=True)
+
+# Requests whose effect depends only on method and params: an identical
+# request already waiting in the queue is answered together with the new one
+QUEUE_COALESCE_METHODS = ('get_status', 'get_info', 'get_filament_info',
+                          'start_feed_assist', 'stop_feed_assist', 'drying_stop')
+# method -> queued methods it makes obsolete, matched on the 'index' param
+QUEUE_SUPERSEDES = {
+    'start_feed_assist': ('stop_feed_assist',),
+    'stop_feed_assist': ('start_feed_assist',),
+    'drying': ('drying',),
+    'drying_stop': ('drying',),
+    'update_feeding_speed': ('update_feeding_speed',),
+}
+QUEUE_ADDED = 'added'
+QUEUE_COALESCED = 'coalesced'
+QUEUE_FULL = 'full'
+
+class AceRequestQueue:
+    """
+    Bounded queue of requests waiting to be sent to the ACE
+
+    Only one request is on the wire at a time, so a burst of UI clicks would
+    otherwise turn into seconds of serialized traffic. Identical idempotent
+    requests are merged and a request drops the queued ones it supersedes;
+    callbacks of dropped requests are not called.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self.coalesced = 0
+        self.superseded = 0
+
+    def put(self, request, callback, merge=True):
+        method = request.get('method')
+        params = request.get('params', {})
+        obsolete = QUEUE_SUPERSEDES.get(method) if merge else None
+        if merge and method in QUEUE_COALESCE_METHODS:
+            index = params.get('index')
+            match = None
+            for item in self._items:
+                if item[3] and item[0].get('method') == method \
+                        and item[0].get('params', {}) == params:
+                    match = item
+                elif match is not None and obsolete \
+                        and item[0].get('method') in obsolete \
+                        and item[0].get('params', {}).get('index') == index:
+                    # A later conflicting request would undo the merged one
+                    match = None
+            if match is not None:
+                match[2].append(callback)
+                self.coalesced += 1
+                return QUEUE_COALESCED
+        if obsolete:
+            index = params.get('index')
+            kept = collections.deque(
+                item for item in self._items
+                if not (item[3] and item[0].get('method') in obsolete
+                        and item[0].get('params', {}).get('index') == index))
+            self.superseded += len(self._items) - len(kept)
+            self._items = kept
+        if len(self._items) >= self.maxsize:
+            return QUEUE_FULL
+        callbacks = [callback]
+
+        def dispatch(ace, response):
+            for cb in callbacks:
+                cb(ace, response)
+        self._items.append([request, dispatch, callbacks, merge])
+        return QUEUE_ADDED
+
+    def get(self):
+        """[request, callback] of the oldest request"""
+        item = self._items.popleft()
+        return item[:2]
+
+    def empty(self):
+        return not self._items
+
+    def qsize(self):
+        return len(self._items)
+
+    def clear(self):
+        self._items.clear()
+
+# Directories watched for the ACE's device node while it is absent
+DEVICE_WATCH_DIRS = ('/dev', '/dev/serial/by-id')
+# inotify(7): node created, moved into place or its permissions set by udev
+DEVICE_WATCH_MASK = 0x100 | 0x080 | 0x004
+# Connect retry interval while inotify reports new nodes
+DEVICE_WATCH_POLL = 5.
+# Startup requests are sent again when not all were answered after this many seconds
+HANDSHAKE_TIMEOUT = 3.
+
+class AceDeviceWatcher:
+    """
+    Wakes the connect timer when a device node appears
+
+    inotify through libc on DEVICE_WATCH_DIRS, registered with the reactor
+    like any other fd. open() returns None where inotify is not available
+    and the connect timer keeps polling.
+    """
+
+    def __init__(self, reactor, fd, callback):
+        self.reactor = reactor
+        self.fd = fd
+        self.callback = callback
+        self.handle = reactor.register_fd(fd, self._handle_events)
+
+    @classmethod
+    def open(cls, reactor, callback):
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        watches = 0
+        for path in DEVICE_WATCH_DIRS:
+            if os.path.isdir(path) \
+                    and libc.inotify_add_watch(fd, path.encode(), DEVICE_WATCH_MASK) >= 0:
+                watches += 1
+        if not watches:
+            os.close(fd)
+            return None
+        return cls(reactor, fd, callback)
+
+    def _handle_events(self, eventtime):
+        # Which node changed does not matter, find_com_port looks again
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError:
+            pass
+        self.callback(eventtime)
+
+    def close(self):
+        self.reactor.unregister_fd(self.handle)
+        os.close(self.fd)
+
+# Capture file: CAPTURE_MAGIC, CAPTURE_HEADER (wall clock and reactor time
+# when the file was opened), then records of CAPTURE_RECORD (reactor time,
+# direction, length) followed by the raw bytes. Read by tools/ace_capture.py.
+CAPTURE_MAGIC = b'ACECAP1\n'
+CAPTURE_HEADER = struct.Struct('<dd')
+CAPTURE_RECORD = struct.Struct('<dBI')
+CAPTURE_TX = 0
+CAPTURE_RX = 1
+CAPTURE_FLUSH_INTERVAL = 0.25
+CAPTURE_MAX_PENDING = 10000
+# stop() waits this long for the writer on the reactor thread, a slower
+# writer finishes and closes its file on its own
+CAPTURE_STOP_TIMEOUT = 0.05
+
+class AceCapture:
+    """
+    Wire-level capture of the ACE serial traffic
+
+    The reactor thread only appends to a deque; a background thread writes
+    the records to a size-rotated file. Each capture has its own deque, file
+    and stop event, so a new capture can start while the last one drains.
+    Writers that are still draining are kept by path: a capture to the same
+    path waits for them, and klippy:disconnect waits for all of them.
+    """
+
+    def __init__(self, ace, config):
+        self.ace = ace
+        self.reactor = ace.reactor
+        self.path = config.get('capture_file', None)
+        self.max_size = config.getint('capture_max_size', 10, minval=1) * 1024 * 1024
+        self.backups = config.getint('capture_backups', 3, minval=0)
+        self.records = 0
+        self.dropped = 0
+        self._pending = collections.deque()
+        self._thread = None
+        self._stop_event = None
+        self._draining = {}
+
+        ace.printer.register_event_handler('klippy:ready', self._handle_ready)
+        ace.printer.register_event_handler('klippy:disconnect',
+                                           self._handle_disconnect)
+        ace.gcode.register_command(
+            'ACE_CAPTURE', self.cmd_ACE_CAPTURE,
+            desc=self.cmd_ACE_CAPTURE_help)
+
+    def _handle_ready(self):
+        if self.path:
+            self.start(self.path)
+
+    def _handle_disconnect(self):
+        # Klippy is exiting, let the writers finish so no record is lost
+        self.stop()
+        for thread in self._draining.values():
+            thread.join()
+        self._draining.clear()
+
+    def record(self, direction, data):
+        """Queue raw bytes for the capture file (reactor thread)"""
+        if self._thread is None:
+            return
+        if len(self._pending) >= CAPTURE_MAX_PENDING:
+            self.dropped += 1
+            return
+        self._pending.append((self.reactor.monotonic(), direction, bytes(data)))
+
+    def start(self, path):
+        self.stop()
+        # Reopening the file under a draining writer would truncate it
+        draining = self._draining.pop(path, None)
+        if draining is not None:
+            draining.join()
+        self.path = path
+        capture = self._open(path)
+        self._pending = collections.deque()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='ace-capture',
+            args=(path, capture, self._pending, self._stop_event))
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info('ACE: Capturing serial traffic to %s' % (path,))
+
+    def stop(self):
+        """Stop capturing without blocking the reactor on the writer's I/O"""
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(CAPTURE_STOP_TIMEOUT)
+        self._draining = {path: thread for path, thread
+                          in self._draining.items() if thread.is_alive()}
+        if self._thread.is_alive():
+            logging.info('ACE: Capture writer still flushing, it closes %s when done'
+                         % (self.path,))
+            self._draining[self.path] = self._thread
+        self._thread = None
+        self._stop_event = None
+
+    def _open(self, path):
+        capture = open(path, 'wb')
+        capture.write(CAPTURE_MAGIC)
+        capture.write(CAPTURE_HEADER.pack(time.time(), self.reactor.monotonic()))
+        return capture
+
+    def _rotate(self, path, capture):
+        capture.close()
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (path, i + 1))
+        if self.backups:
+            os.replace(path, path + '.1')
+        return self._open(path)
+
+    def _run(self, path, capture, pending, stop_event):
+        size = len(CAPTURE_MAGIC) + CAPTURE_HEADER.size
+        try:
+            while True:
+                stopping = stop_event.is_set()
+                while pending:
+                    eventtime, direction, data = pending.popleft()
+                    if size + CAPTURE_RECORD.size + len(data) > self.max_size:
+                        capture = self._rotate(path, capture)
+                        size = len(CAPTURE_MAGIC) + CAPTURE_HEADER.size
+                    capture.write(CAPTURE_RECORD.pack(eventtime, direction, len(data)))
+                    capture.write(data)
+                    size += CAPTURE_RECORD.size + len(data)
+                    self.records += 1
+                if stopping:
+                    break
+                capture.flush()
+                # Wakes at once on stop()
+                stop_event.wait(CAPTURE_FLUSH_INTERVAL)
+        except Exception:
+            logging.exception('ACE: Capture writer failed')
+        finally:
+            capture.close()
+
+    cmd_ACE_CAPTURE_help = 'Capture ACE serial traffic: ENABLE=0|1 [FILE=path]'
+
+    def cmd_ACE_CAPTURE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None)
+        if enable is None:
+            gcmd.respond_info(
+                "ACE: Capture %s, %d records written, %d dropped"
+                % ('to ' + self.path if self._thread is not None else 'off',
+                   self.records, self.dropped))
+            return
+        if not enable:
+            self.stop()
+            gcmd.respond_info("ACE: Capture stopped (%d records)" % (self.records,))
+            return
+        path = gcmd.get('FILE', self.path)
+        if not path:
+            raise gcmd.error('FILE is required when capture_file is not configured')
+        try:
+            self.start(os.path.expanduser(path))
+        except OSError as e:
+            raise gcmd.error('Unable to open capture file: %s' % (e,))
+        gcmd.respond_info("ACE: Capturing serial traffic to %s" % (self.path,))
+
+class AceProfiler:
+    """
+    Per-timer cost accounting for the ACE reactor callbacks
+
+    Timers registered through register_timer() are wrapped; while profiling
+    is disabled the wrapper only checks a flag and remembers the requested
+    wake time. Lateness is the time between that request and the actual call.
+    """
+
+    def __init__(self, ace, config):
+        self.reactor = ace.reactor
+        self.enabled = config.getboolean('profile', False)
+        self.stats = {}
+        self.started = None
+
+        ace.printer.register_event_handler('klippy:ready', self._handle_ready)
+        ace.gcode.register_command(
+            'ACE_PROFILE', self.cmd_ACE_PROFILE,
+            desc=self.cmd_ACE_PROFILE_help)
+
+    def _handle_ready(self):
+        if self.enabled:
+            self.reset()
+
+    def reset(self):
+        self.stats = {}
+        self.started = self.reactor.monotonic()
+
+    def register_timer(self, name, callback, waketime=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        return self.reactor.register_timer(self.wrap(name, callback), waketime)
+
+    def wrap(self, name, callback):
+        requested = [None]
+
+        def timer_callback(eventtime):
+            if not self.enabled:
+                requested[0] = callback(eventtime)
+                return requested[0]
+            now = self.reactor.monotonic()
+            start = time.perf_counter()
+            waketime = callback(eventtime)
+            self._account(name, time.perf_counter() - start, now, requested[0])
+            requested[0] = waketime
+            return waketime
+        return timer_callback
+
+    def _account(self, name, elapsed, now, requested):
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = {
+                'calls': 0, 'total': 0., 'max': 0., 'max_at': 0.,
+                'late_calls': 0, 'late_total': 0., 'late_max': 0.}
+        stat['calls'] += 1
+        stat['total'] += elapsed
+        if elapsed > stat['max']:
+            stat['max'] = elapsed
+            stat['max_at'] = now
+        # Timers woken early with update_timer() or registered with NOW have
+        # no meaningful request time
+        if requested is not None and self.reactor.NOW < requested < self.reactor.NEVER:
+            lateness = now - requested
+            if lateness >= 0.:
+                stat['late_calls'] += 1
+                stat['late_total'] += lateness
+                stat['late_max'] = max(stat['late_max'], lateness)
+
+    def get_status(self, eventtime=None):
+        timers = {}
+        for name, stat in self.stats.items():
+            timers[name] = {
+                'calls': stat['calls'],
+                'total_ms': round(stat['total'] * 1000., 3),
+                'avg_ms': round(stat['total'] * 1000. / stat['calls'], 3),
+                'max_ms': round(stat['max'] * 1000., 3),
+                'max_at': round(stat['max_at'], 3),
+                'late_avg_ms': round(stat['late_total'] * 1000. / stat['late_calls'], 3)
+                               if stat['late_calls'] else 0.,
+                'late_max_ms': round(stat['late_max'] * 1000., 3),
+            }
+        return {'enabled': self.enabled, 'timers': timers}
+
+    cmd_ACE_PROFILE_help = 'ACE reactor timer profiling: [ENABLE=0|1] [RESET=1]'
+
+    def cmd_ACE_PROFILE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None, minval=0, maxval=1)
+        if gcmd.get_int('RESET', 0):
+            self.reset()
+            gcmd.respond_info("ACE: Profile reset")
+        if enable is not None:
+            if enable and not self.enabled:
+                self.reset()
+            self.enabled = bool(enable)
+            gcmd.respond_info("ACE: Profiling %s" % ('enabled' if enable else 'disabled'))
+            return
+        if not self.stats:
+            gcmd.respond_info("ACE: No profile data%s" % (
+                '' if self.enabled else ', enable with ACE_PROFILE ENABLE=1'))
+            return
+        window = max(self.reactor.monotonic() - self.started, 1e-6)
+        lines = ["ACE: Timer profile over %.1fs" % (window,),
+                 "%-14s %7s %9s %8s %8s %9s %9s" % (
+                     'timer', 'calls', 'total ms', 'avg ms', 'max ms',
+                     'late avg', 'late max')]
+        for name, stat in sorted(self.get_status()['timers'].items(),
+                                 key=lambda item: -item[1]['total_ms']):
+            lines.append("%-14s %7d %9.1f %8.3f %8.3f %9.1f %9.1f" % (
+                name, stat['calls'], stat['total_ms'], stat['avg_ms'],
+                stat['max_ms'], stat['late_avg_ms'], stat['late_max_ms']))
+        total = sum(stat['total'] for stat in self.stats.values())
+        lines.append("Reactor time used: %.3f%%" % (total / window * 100.,))
+        gcmd.respond_info("\n".join(lines))
+
+# Upper bounds in seconds of the request latency histogram buckets, the last
+# bucket (+Inf) is implicit. Responses are stamped when the reader timer runs
+# (every 0.1 s), so finer buckets would only show the timer phase. The first
+# bucket holds the responses picked up by the first read after the request
+METRICS_LATENCY_BUCKETS = (0.15, 0.25, 0.5, 1., 2.5, 5.)
+METRICS_FRAME_ERRORS = ('timeout', 'header', 'length', 'crc', 'json', 'unknown_id')
+
+class AceMetrics:
+    """
+    Counters for the ACE serial protocol
+
+    Registered as the 'ace_metrics' printer object so it can be queried on
+    demand without being part of the 'ace' status subscription.
+    """
+
+    def __init__(self, ace):
+        self.ace = ace
+        self.reactor = ace.reactor
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.connects = 0
+        # Seconds from klippy:ready or a lost connection to the port being
+        # open, and to the startup handshake being complete
+        self.connect_time = None
+        self.startup_time = None
+        self.queue_rejected = 0
+        self.errors = dict.fromkeys(METRICS_FRAME_ERRORS, 0)
+        # method -> [bucket counts..., +Inf count], sum of seconds
+        self.latency = {}
+        self.latency_sum = {}
+        self._inflight = {}
+        ace.printer.add_object('ace_metrics', self)
+
+    def request_sent(self, request, size):
+        self.frames_out += 1
+        self.bytes_out += size
+        self._inflight[request.get('id')] = (request.get('method'), self.reactor.monotonic())
+
+    def response_received(self, request_id):
+        self.frames_in += 1
+        sent = self._inflight.pop(request_id, None)
+        if sent is None:
+            return
+        method, send_time = sent
+        elapsed = self.reactor.monotonic() - send_time
+        counts = self.latency.get(method)
+        if counts is None:
+            counts = self.latency[method] = [0] * (len(METRICS_LATENCY_BUCKETS) + 1)
+            self.latency_sum[method] = 0.
+        counts[bisect.bisect_left(METRICS_LATENCY_BUCKETS, elapsed)] += 1
+        self.latency_sum[method] += elapsed
+
+    def connected(self, elapsed=None):
+        self.connects += 1
+        self.connect_time = elapsed
+        # Requests sent before a reconnect are never answered
+        self._inflight.clear()
+
+    def device_ready(self, elapsed):
+        self.startup_time = elapsed
+
+    def frame_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        if kind == 'timeout':
+            # The ACE keeps one request in flight, it will not be answered
+            self._inflight.clear()
+
+    def get_status(self, eventtime=None):
+        requests = {}
+        for method, counts in self.latency.items():
+            cumulative = []
+            total = 0
+            for count in counts:
+                total += count
+                cumulative.append(total)
+            requests[method] = {
+                'count': total,
+                'sum': round(self.latency_sum[method], 6),
+                'buckets': cumulative,
+            }
+        queue = self.ace._queue
+        return {
+            'latency_buckets': list(METRICS_LATENCY_BUCKETS),
+            'requests': requests,
+            'errors': dict(self.errors),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'queue_depth': queue.qsize() if queue is not None else 0,
+            'queue_coalesced': queue.coalesced if queue is not None else 0,
+            'queue_superseded': queue.superseded if queue is not None else 0,
+            'queue_rejected': self.queue_rejected,
+            'inflight': len(self._inflight),
+            'connected': self.ace._connected,
+            'reconnects': max(0, self.connects - 1),
+            'connect_time': self.connect_time,
+            'startup_time': self.startup_time,
+        }
+
 def load_config(config):
     return BunnyAce(config)
@@ -4,151 +4,251 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 #
-# This module provides temperature sensor for Anycubic Color Engine (ACE)
-# Reads temperature from ACE device status
+# This module provides sensors for Anycubic Color Engine (ACE)
+# Reads temperature, fan speed, dryer and feed assist data from ACE device status
+#
+# All sensor instances share one AceSensorHub. The hub owns the only reactor
+# timer and is woken by the "ace:status_update" event sent by the ace module
+# whenever a fresh get_status response arrives.
 
 import logging
 
-ACE_REPORT_TIME = 1.0  # Report temperature every second
+ACE_REPORT_TIME = 1.0  # Fallback report interval when no ACE status arrives
+
+
+def _dryer_status(info):
+    dryer = info.get('dryer') or info.get('dryer_status') or {}
+    return dryer if isinstance(dryer, dict) else {}
+
+def _channel_temperature(info, hub):
+    return info.get('temp', 0.0)
+
+def _channel_fan_speed(info, hub):
+    return info.get('fan_speed', 0)
+
+def _channel_dryer_target(info, hub):
+    dryer = _dryer_status(info)
+    if dryer.get('status') != 'drying':
+        return 0.0
+    return dryer.get('target_temp', 0)
+
+def _channel_dryer_remaining(info, hub):
+    # Same scaling as BunnyAce.get_status: minutes with fractional seconds
+    remain_time = _dryer_status(info).get('remain_time', 0) or 0
+    return remain_time / 60 if remain_time > 0 else 0.0
+
+def _channel_feed_assist_count(info, hub):
+    # The ACE counter only grows, report the pushes of the last status
+    return hub.assist_pushes
+
+def _channel_assist_duty(info, hub):
+    return hub.assist_duty
+
+# Channel name -> extractor(ace status dict, hub)
+ACE_CHANNELS = {
+    'temperature': _channel_temperature,
+    'fan_speed': _channel_fan_speed,
+    'dryer_target': _channel_dryer_target,
+    'dryer_remaining': _channel_dryer_remaining,
+    'feed_assist_count': _channel_feed_assist_count,
+    'assist_duty': _channel_assist_duty,
+}
+
+
+class AceSensorHub:
+    """
+    Shared sampler for all temperature_ace sensors
+    Reads the ACE status once per update and fans it out to every sensor
+    """
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.sensors = []
+        self.ace = None
+        self.mcu = None
+        self.sample_timer = None
+
+        # Feed assist pushes since the previous status and duty (percent)
+        # of the time spent pushing. cont_assist_time is the length of the
+        # current push and drops to 0 between pushes
+        self.assist_pushes = 0
+        self.assist_duty = 0.0
+        self._last_assist_count = None
+        self._last_assist_eventtime = None
+
+        # Skip timer setup if in debug mode
+        if printer.get_start_args().get('debugoutput') is not None:
+            return
+
+        printer.register_event_handler("klippy:ready", self.handle_ready)
+        printer.register_event_handler("ace:status_update",
+                                       self.handle_ace_status)
+
+    def add_sensor(self, sensor):
+        self.sensors.append(sensor)
+
+    def handle_ready(self):
+        """Resolve ACE and MCU once and start the shared sampling timer"""
+        try:
+            self.ace = self.printer.lookup_object('ace')
+            logging.info("ACE sensors: ACE module found and linked")
+        except self.printer.config_error:
+            logging.warning("ACE sensors: ACE module not found, sensors will report 0")
+            self.ace = None
+        except Exception as e:
+            logging.error(f"ACE sensors: Error linking to ACE module: {e}")
+            self.ace = None
+
+        self.mcu = self.printer.lookup_object('mcu')
+        if self.ace is not None:
+            # Accounted for by ACE_PROFILE along with the ace module timers
+            self.sample_timer = self.ace.profiler.register_timer(
+                'sensor_hub', self._sample_ace_status, self.reactor.NOW)
+        else:
+            self.sample_timer = self.reactor.register_timer(
+                self._sample_ace_status, self.reactor.NOW)
+
+    def handle_ace_status(self, info):
+        """Called by the ace module after each get_status response"""
+        eventtime = self.reactor.monotonic()
+        count = info.get('feed_assist_count', 0) or 0
+        assist_time = info.get('cont_assist_time', 0.0) or 0.0
+        if self._last_assist_count is not None:
+            # A counter that went back means the ACE was reset
+            self.assist_pushes = max(0, count - self._last_assist_count)
+            elapsed = (eventtime - self._last_assist_eventtime) * 1000.
+            if elapsed > 0. and assist_time > 0.:
+                self.assist_duty = min(100., assist_time / elapsed * 100.)
+            else:
+                self.assist_duty = 0.0
+        self._last_assist_count = count
+        self._last_assist_eventtime = eventtime
+
+        if self.sample_timer is not None:
+            self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
+
+    def _sample_ace_status(self, eventtime):
+        """Sample every registered sensor from one ACE status snapshot"""
+        info = None
+        if self.ace is not None:
+            info = getattr(self.ace, '_info', None)
+        print_time = self.mcu.estimated_print_time(eventtime)
+        for sensor in self.sensors:
+            sensor.sample(info, print_time)
+        # Schedule fallback sample; ACE status updates wake the timer earlier
+        return eventtime + ACE_REPORT_TIME
+
+
+def _lookup_hub(printer):
+    hub = printer.lookup_object('ace_sensor_hub', None)
+    if hub is None:
+        hub = AceSensorHub(printer)
+        printer.add_object('ace_sensor_hub', hub)
+    return hub
+
 
 class TemperatureACE:
     """
-    Temperature sensor that reads temperature from ACE device
+    Sensor that reads one channel from ACE device status
     Integrates with Klipper's temperature monitoring system
     """
-    
+
     def __init__(self, config):
         self.printer = config.get_printer()
-        self.reactor = self.printer.get_reactor()
         self.name = config.get_name().split()[-1]
-        
-        # ACE module reference (will be set in handle_ready)
-        self.ace = None
-        
+
+        # ACE status channel reported by this sensor
+        self.channel = config.getchoice(
+            'channel', {name: name for name in ACE_CHANNELS}, 'temperature')
+        self._extract = ACE_CHANNELS[self.channel]
+
         # Temperature state
         self.temp = 0.0
         self.min_temp = 0.0
         self.max_temp = 70.0
         self.measured_min = 99999999.
         self.measured_max = 0.
-        
+
         # Callback for temperature updates
         self._callback = None
-        
+        self._sample_logged = False
+        self._warning_shown = False
+
         # Register object
         self.printer.add_object("temperature_ace " + self.name, self)
-        
-        # Skip timer setup if in debug mode
-        if self.printer.get_start_args().get('debugoutput') is not None:
-            return
-        
-        # Register timer for periodic temperature reading
-        self.sample_timer = self.reactor.register_timer(
-            self._sample_ace_temperature)
-        
-        # Register event handler to start after connection
-        self.printer.register_event_handler("klippy:connect",
-                                            self.handle_connect)
-        self.printer.register_event_handler("klippy:ready",
-                                            self.handle_ready)
-    
-    def handle_ready(self):
-        """Get reference to ACE module when Klipper is ready"""
-        try:
-            self.ace = self.printer.lookup_object('ace')
-            logging.info("ACE temperature sensor: ACE module found and linked")
-        except self.printer.config_error:
-            logging.warning("ACE temperature sensor: ACE module not found, sensor will report 0")
-            self.ace = None
-        except Exception as e:
-            logging.error(f"ACE temperature sensor: Error linking to ACE module: {e}")
-            self.ace = None
-        
-        # Start temperature sampling timer (if not in debug mode)
-        if hasattr(self, 'sample_timer'):
-            self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
-    
-    def handle_connect(self):
-        """Start temperature sampling when Klipper connects"""
-        if hasattr(self, 'sample_timer'):
-            self.reactor.update_timer(self.sample_timer, self.reactor.NOW)
-    
+
+        # Sampling is driven by the shared hub
+        self.hub = _lookup_hub(self.printer)
+        self.hub.add_sensor(self)
+
     def setup_minmax(self, min_temp, max_temp):
         """Setup min/max temperature limits (required by heaters system)"""
         self.min_temp = min_temp
         self.max_temp = max_temp
-    
+
     def setup_callback(self, cb):
         """Setup callback for temperature updates (required by heaters system)"""
         self._callback = cb
-    
+
     def get_report_time_delta(self):
         """Return time interval between temperature reports (required by heaters system)"""
         return ACE_REPORT_TIME
-    
-    def _sample_ace_temperature(self, eventtime):
-        """Periodic temperature sampling from ACE device"""
-        # Log first successful sample
-        if not hasattr(self, '_sample_logged'):
-            self._sample_logged = False
-        
+
+    def sample(self, info, print_time):
+        """Update value from ACE status (called by AceSensorHub)"""
         try:
-            if self.ace and hasattr(self.ace, '_info'):
-                # Get temperature from ACE device info
-                ace_temp = self.ace._info.get('temp', 0.0)
-                
-                # Log first successful temperature reading
-                if not self._sample_logged and ace_temp > 0:
-                    logging.info(f"ACE temperature sensor: Started sampling, current temp={ace_temp}°C")
+            if info is not None:
+                value = self._extract(info, self.hub)
+
+                # Log first successful reading
+                if not self._sample_logged and value > 0:
+                    logging.info(f"temperature_ace {self.name}: Started sampling {self.channel}={value}")
                     self._sample_logged = True
-                
-                self.temp = float(ace_temp)
-                
+
+                self.temp = float(value)
+
                 # Track min/max
-                if self.temp > 0:  # Only track valid temperatures
+                if self.temp > 0:  # Only track valid values
                     self.measured_min = min(self.measured_min, self.temp)
                     self.measured_max = max(self.measured_max, self.temp)
-                
-                # Check temperature limits
+
+                # Check limits
                 if self.temp < self.min_temp and self.temp > 0:
                     self.printer.invoke_shutdown(
-                        "ACE temperature %.1f below minimum temperature of %.1f"
-                        % (self.temp, self.min_temp))
+                        "ACE %s %.1f below minimum of %.1f"
+                        % (self.channel, self.temp, self.min_temp))
                 if self.temp > self.max_temp:
                     self.printer.invoke_shutdown(
-                        "ACE temperature %.1f above maximum temperature of %.1f"
-                        % (self.temp, self.max_temp))
+                        "ACE %s %.1f above maximum of %.1f"
+                        % (self.channel, self.temp, self.max_temp))
             else:
                 # ACE not available, report 0
-                if not hasattr(self, '_warning_shown'):
-                    logging.warning(f"temperature_ace: ACE module not available or _info not set (ace={self.ace}, has_info={hasattr(self.ace, '_info') if self.ace else False})")
+                if not self._warning_shown:
+                    logging.warning(f"temperature_ace {self.name}: ACE module not available or _info not set")
                     self._warning_shown = True
                 self.temp = 0.0
         except Exception:
-            logging.exception("temperature_ace: Error reading temperature from ACE")
+            logging.exception("temperature_ace: Error reading %s from ACE" % (self.channel,))
             self.temp = 0.0
-        
+
         # Call temperature callback if set
         if self._callback:
-            mcu = self.printer.lookup_object('mcu')
-            measured_time = self.reactor.monotonic()
-            self._callback(mcu.estimated_print_time(measured_time), self.temp)
-        
-        # Schedule next sample
-        return eventtime + ACE_REPORT_TIME
-    
+            self._callback(print_time, self.temp)
+
     def get_temp(self, eventtime):
-        """Get current temperature (required for temperature_sensor compatibility)"""
+        """Get current value (required for temperature_sensor compatibility)"""
         return self.temp, 0.0
-    
+
     def stats(self, eventtime):
         """Return statistics string for logging"""
-        return False, 'temperature_ace %s: temp=%.1f' % (self.name, self.temp)
-    
+        return False, 'temperature_ace %s: %s=%.1f' % (self.name, self.channel, self.temp)
+
     def get_status(self, eventtime):
         """Return status for Moonraker/API"""
         return {
             'temperature': round(self.temp, 2),
+            'channel': self.channel,
             'measured_min_temp': round(self.measured_min, 2),
             'measured_max_temp': round(self.measured_max, 2),
         }
@@ -159,4 +259,3 @@ def load_config(config):
     # Register sensor factory with heaters system
     pheaters = config.get_printer().load_object(config, "heaters")
     pheaters.add_sensor_factory("temperature_ace", TemperatureACE)
-
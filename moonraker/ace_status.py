@@ -7,14 +7,142 @@ Moonraker API Extension ValgACE
 """
 
 from __future__ import annotations
+import ast
+import json
 import logging
-from typing import TYPE_CHECKING, Optional, Dict, Any
+import re
+import time
+from typing import TYPE_CHECKING, Optional, Dict, Any, List, Set
 if TYPE_CHECKING:
     from confighelper import ConfigHelper
     from websockets import WebRequest
     from . import klippy_apis
     APIComp = klippy_apis.KlippyAPI
 
+# Klippy objects the dashboard state is built from
+ACE_STATUS_OBJECTS: Dict[str, Any] = {"ace": None, "save_variables": None}
+# Protocol counters, queried on demand and never subscribed
+ACE_METRICS_OBJECTS: Dict[str, Any] = {"ace_metrics": None}
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Commands accepted by /server/ace/commands in one request
+BATCH_MAX_COMMANDS = 32
+# Interleaved with the batch so a failed script tells how far it got
+BATCH_MARK_COMMAND = "ACE_BATCH_MARK"
+_GCODE_NAME = re.compile(r"^[A-Z_][A-Z0-9_]*$")
+# Would end the line, start a comment or break the quoting of a value
+_GCODE_UNSAFE = re.compile(r"[\r\n;#*\"']")
+
+
+def _escape_pointer(key: Any) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def json_diff(old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+    '''RFC 6902 patch (add/remove/replace subset) turning old into new'''
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops: List[Dict[str, Any]] = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape_pointer(key)}"})
+        for key, value in new.items():
+            sub = f"{path}/{_escape_pointer(key)}"
+            if key not in old:
+                ops.append({"op": "add", "path": sub, "value": value})
+            elif old[key] != value:
+                ops.extend(json_diff(old[key], value, sub))
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        ops = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            if a != b:
+                ops.extend(json_diff(a, b, f"{path}/{i}"))
+        return ops
+    return [{"op": "replace", "path": path, "value": new}]
+
+
+def _prom_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus(metrics: Dict[str, Any]) -> str:
+    '''Prometheus text exposition of the ace_metrics status'''
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, help_text: str) -> None:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    metric("ace_request_latency_seconds", "histogram",
+           "Time from sending a request to the ACE until its response")
+    bounds = [str(b) for b in metrics.get("latency_buckets", [])] + ["+Inf"]
+    for method, data in sorted(metrics.get("requests", {}).items()):
+        label = _prom_label(method)
+        for bound, count in zip(bounds, data.get("buckets", [])):
+            lines.append(
+                f'ace_request_latency_seconds_bucket{{method="{label}",le="{bound}"}} {count}')
+        lines.append(f'ace_request_latency_seconds_sum{{method="{label}"}} {data.get("sum", 0)}')
+        lines.append(f'ace_request_latency_seconds_count{{method="{label}"}} {data.get("count", 0)}')
+
+    metric("ace_frame_errors_total", "counter", "Invalid or unanswered frames by type")
+    for kind, count in sorted(metrics.get("errors", {}).items()):
+        lines.append(f'ace_frame_errors_total{{type="{_prom_label(kind)}"}} {count}')
+
+    for key, kind, help_text in (
+            ("bytes_in", "counter", "Bytes read from the ACE"),
+            ("bytes_out", "counter", "Bytes written to the ACE"),
+            ("frames_in", "counter", "Frames received from the ACE"),
+            ("frames_out", "counter", "Frames sent to the ACE"),
+            ("reconnects", "counter", "Serial reconnects since Klipper started"),
+            ("queue_coalesced", "counter", "Requests merged into an identical queued request"),
+            ("queue_superseded", "counter", "Queued requests dropped by a later conflicting one"),
+            ("queue_rejected", "counter", "Requests dropped because the queue was full"),
+            ("queue_depth", "gauge", "Requests waiting to be sent"),
+            ("inflight", "gauge", "Requests sent and not yet answered"),
+            ("connected", "gauge", "1 if the serial port is open")):
+        name = f"ace_{key}_total" if kind == "counter" else f"ace_{key}"
+        metric(name, kind, help_text)
+        lines.append(f"{name} {int(metrics.get(key, 0))}")
+
+    for key, name, help_text in (
+            ("connect_time", "ace_connect_seconds",
+             "Seconds from Klipper ready or a lost connection until the port was open"),
+            ("startup_time", "ace_startup_seconds",
+             "Seconds from Klipper ready or a lost connection until the ACE state was complete")):
+        if metrics.get(key) is None:
+            continue
+        metric(name, "gauge", help_text)
+        lines.append(f"{name} {metrics[key]}")
+    return "\n".join(lines) + "\n"
+
+
+def format_gcode_value(value: Any) -> str:
+    '''Parameter value for Klipper's extended gcode syntax'''
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (list, tuple)):
+        # Colors are sent as R,G,B
+        return ",".join(format_gcode_value(v) for v in value)
+    text = str(value)
+    if _GCODE_UNSAFE.search(text):
+        raise ValueError(f"invalid character in value {text!r}")
+    if not text or any(c.isspace() for c in text):
+        return f'"{text}"'
+    return text
+
+
+def format_gcode_command(command: Any, params: Optional[Dict[str, Any]]) -> str:
+    '''One gcode line from a command name and its parameters'''
+    name = str(command).strip().upper()
+    if not _GCODE_NAME.match(name):
+        raise ValueError(f"invalid command {command!r}")
+    parts = [name]
+    for key, value in (params or {}).items():
+        key = str(key).strip().upper()
+        if not _GCODE_NAME.match(key):
+            raise ValueError(f"invalid parameter {key!r} of {name}")
+        parts.append(f"{key}={format_gcode_value(value)}")
+    return " ".join(parts)
+
 
 class AceStatus:
     '''Beginning'''
@@ -22,10 +150,18 @@ class AceStatus:
         self.confighelper = config
         self.server = config.get_server()
         self.logger = logging.getLogger(__name__)
-        self.cached_model = "unknown"
-        self.cached_firmware = "unknown"
-        self.last_info_update = 0
-#        self.variables = self.printer.lookup_object('save_variables').allVariables
+
+        # Delta channel: clients load /server/ace/snapshot once, then apply
+        # the patches pushed as notify_ace_status_update. The version changes
+        # whenever the snapshot is rebuilt from scratch, seq on every patch.
+        self._ace_state: Dict[str, Any] = {}
+        self._variables: Dict[str, Any] = {}
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._version = int(time.time())
+        self._seq = 0
+        # ACE_* commands registered in Klippy, loaded on the first batch
+        self._ace_commands: Optional[Set[str]] = None
+        self._batch_id = 0
 
         # klippy_apis
         self.klippy_apis: APIComp = self.server.lookup_component('klippy_apis')
@@ -35,6 +171,32 @@ class AceStatus:
             ['GET'],
             self.handle_status_request
         )
+        self.server.register_endpoint(
+            "/server/ace/snapshot",
+            ['GET'],
+            self.handle_snapshot_request
+        )
+        self.server.register_endpoint(
+            "/server/ace/metrics",
+            ['GET'],
+            self.handle_metrics_request
+        )
+        try:
+            self.server.register_endpoint(
+                "/server/ace/metrics/prometheus",
+                ['GET'],
+                self.handle_prometheus_request,
+                wrap_result=False,
+                content_type=PROMETHEUS_CONTENT_TYPE
+            )
+        except TypeError:
+            # Older Moonraker: served as text/plain without the version
+            self.server.register_endpoint(
+                "/server/ace/metrics/prometheus",
+                ['GET'],
+                self.handle_prometheus_request,
+                wrap_result=False
+            )
         self.server.register_endpoint(
             "/server/ace/slots",
             ['GET'],
@@ -45,6 +207,11 @@ class AceStatus:
             ['POST'],
             self.handle_command_request
         )
+        self.server.register_endpoint(
+            "/server/ace/commands",
+            ['POST'],
+            self.handle_commands_request
+        )
         self.server.register_endpoint(
             "/server/ace/set_slot_color",
             ['POST'],
@@ -64,66 +231,140 @@ class AceStatus:
             "server:status_update",
             self._handle_status_update
         )
+        self.server.register_event_handler(
+            "server:klippy_ready",
+            self._handle_klippy_ready
+        )
+        self.server.register_event_handler(
+            "server:klippy_disconnect",
+            self._handle_klippy_disconnect
+        )
+        self.server.register_notification(
+            "ace:status_update",
+            "ace_status_update"
+        )
 
         self._last_status: Optional[Dict[str, Any]] = None
 
         self.logger.info("ACE Status API extension loaded")
 
+    def _compose_status(self) -> Dict[str, Any]:
+        '''Dashboard view: ace status merged with the saved variables'''
+        ace_data = dict(self._ace_state)
+        variables = self._variables
+
+        filament_pos = variables.get("ace_filament_pos")
+        ace_data["filament_pos"] = filament_pos if isinstance(filament_pos, str) else "unknown"
+
+        current_index = variables.get("ace_current_index")
+        ace_data["current_index"] = current_index if isinstance(current_index, int) else -1
+
+        # The ace object's inventory (AceSlot.to_dict()) is current, the
+        # saved variable is the fallback before the first status update
+        inventory = self._ace_state.get("inventory") or variables.get("ace_inventory")
+        if isinstance(inventory, str):
+            try:
+                inventory = json.loads(inventory)
+            except Exception:
+                inventory = None
+        if isinstance(inventory, list):
+            ace_data["slots"] = inventory
+        return ace_data
+
+    def _load_state(self, result: Dict[str, Any]) -> None:
+        ace_data = result.get("ace")
+        if isinstance(ace_data, dict):
+            self._ace_state = dict(ace_data)
+        variables = result.get("save_variables", {}).get("variables")
+        if isinstance(variables, dict):
+            self._variables = variables
+
+    def _reset_snapshot(self) -> None:
+        '''Rebuild the snapshot from scratch and tell clients to resync'''
+        self._version += 1
+        self._seq = 0
+        self._snapshot = self._compose_status()
+        self._last_status = self._snapshot
+        # An empty patch under the new version makes clients resync
+        self.server.send_event(
+            "ace:status_update",
+            {"version": self._version, "seq": self._seq, "patch": []}
+        )
+
+    def _publish(self) -> None:
+        '''Diff the new dashboard view against the snapshot and push it'''
+        if self._snapshot is None:
+            return
+        status = self._compose_status()
+        patch = json_diff(self._snapshot, status)
+        if not patch:
+            return
+        self._seq += 1
+        self._snapshot = status
+        self._last_status = status
+        self.server.send_event(
+            "ace:status_update",
+            {"version": self._version, "seq": self._seq, "patch": patch}
+        )
+
+    async def _handle_klippy_ready(self) -> None:
+        try:
+            result = await self.klippy_apis.subscribe_objects(ACE_STATUS_OBJECTS)
+        except Exception as e:
+            self.logger.warning(f"Could not subscribe to ACE status: {e}")
+            return
+        self._load_state(result)
+        if self._ace_state:
+            self._reset_snapshot()
+
+    async def _handle_klippy_disconnect(self) -> None:
+        # Keep serving the last known state, but rebuild on reconnect
+        self._snapshot = None
+        # A restart may load a different configuration
+        self._ace_commands = None
+
+    async def handle_snapshot_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        '''Full dashboard state plus the version/seq the patches continue from'''
+        if self._snapshot is None:
+            result = await self.klippy_apis.query_objects(ACE_STATUS_OBJECTS)
+            self._load_state(result)
+            if not self._ace_state:
+                return {"error": "ACE data not available"}
+            self._reset_snapshot()
+        return {
+            "version": self._version,
+            "seq": self._seq,
+            "status": self._snapshot
+        }
+
+    async def _query_metrics(self) -> Dict[str, Any]:
+        result = await self.klippy_apis.query_objects(ACE_METRICS_OBJECTS)
+        metrics = result.get("ace_metrics")
+        if not isinstance(metrics, dict):
+            raise self.server.error("ACE metrics not available", 503)
+        return metrics
+
+    async def handle_metrics_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        '''Protocol counters and latency histograms of the ace module'''
+        return await self._query_metrics()
+
+    async def handle_prometheus_request(self, webrequest: WebRequest) -> str:
+        '''Same counters in the Prometheus text format, for scraping'''
+        return format_prometheus(await self._query_metrics())
+
     async def handle_status_request(self, webrequest: WebRequest) -> Dict[str, Any]:
         '''Handles status request'''
         try:
+            if self._snapshot is not None:
+                return self._snapshot
+
             try:
-                result = await self.klippy_apis.query_objects({'ace': None})
-                ace_data = result.get('ace')
-
-                if ace_data and isinstance(ace_data, dict):
-                    # Merge ace_inventory from save_variables
-                    try:
-                        save_vars = await self.klippy_apis.query_objects(
-                            {"save_variables": None}
-                        )
-                        variables = save_vars.get("save_variables", {}).get("variables", {})
-                        inventory = variables.get("ace_inventory")
-                        filament_pos = variables.get("ace_filament_pos")
-                        current_index = variables.get("ace_current_index")
-
-                        if isinstance(filament_pos, str):
-                            ace_data["filament_pos"] = filament_pos
-                        else:
-                            ace_data["filament_pos"] = "unknown"
-
-                        if isinstance(current_index, str):
-                            ace_data["current_index"] = current_index
-                        else:
-                            ace_data["current_index"] = "None"
-
-                        if isinstance(inventory, str):
-                            try:
-                                inventory = json.loads(inventory)
-                            except Exception:
-                                inventory = None
-
-                        if isinstance(inventory, list):
-                            ace_data["slots"] = inventory
-                    except Exception:
-                        pass
-                    self._last_status = ace_data
-
-                    import time
-
-                    if time.time() - self.last_info_update > 300:
-                        response = await self.klippy_apis.run_gcode(
-                            "ACE_DEBUG METHOD=get_info"
-                        )
-                        result = response.get("result", {})
-                        self.cached_model = result.get("model", "unknown")
-                        self.cached_firmware = result.get("firmware", "unknown")
-                        self.last_info_update = time.time()
-
-                    ace_data["model"] = self.cached_model
-                    ace_data["firmware"] = self.cached_firmware
-
-                    return ace_data
+                result = await self.klippy_apis.query_objects(ACE_STATUS_OBJECTS)
+                self._load_state(result)
+
+                if self._ace_state:
+                    self._last_status = self._compose_status()
+                    return self._last_status
                 else:
                     self.logger.debug("ACE data not found in query_objects response")
 
@@ -183,68 +424,53 @@ class AceStatus:
             self.logger.error(f"Error getting slots: {e}")
             return {"error": str(e)}
 
+    async def _request_args(self, webrequest: WebRequest) -> Dict[str, Any]:
+        '''Query and body arguments, the JSON body is read once'''
+        args: Dict[str, Any] = {}
+        try:
+            json_body = await webrequest.get_json()
+            if isinstance(json_body, dict):
+                args.update(json_body)
+        except Exception:
+            pass
+        try:
+            args.update(webrequest.get_args() or {})
+        except Exception:
+            pass
+        return args
+
+    @staticmethod
+    def _parse_params(value: Any) -> Dict[str, Any]:
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                try:
+                    value = ast.literal_eval(value)
+                except (ValueError, SyntaxError):
+                    value = None
+        return value if isinstance(value, dict) else {}
+
     async def handle_command_request(self, webrequest: WebRequest) -> Dict[str, Any]:
         '''Handles the Command Request'''
         try:
-            command = webrequest.get_str("command", None)
-
-            if not command:
-                try:
-                    json_body = await webrequest.get_json()
-                    if isinstance(json_body, dict):
-                        command = json_body.get("command")
-                except Exception:
-                    pass
+            args = await self._request_args(webrequest)
+            command = args.get("command")
 
             if not command:
                 return {"error": "Command parameter is required"}
 
-            params: Dict[str, Any] = {}
-
-            try:
-                json_body = await webrequest.get_json()
-                if isinstance(json_body, dict) and "params" in json_body:
-                    jb_params = json_body["params"]
-                    if isinstance(jb_params, dict):
-                        params.update(jb_params)
-            except Exception:
-                pass
+            params = self._parse_params(args.get("params"))
+            for k, v in args.items():
+                if k in ("command", "params"):
+                    continue
+                params[str(k)] = v
 
-            try:
-                args = webrequest.get_args()
-            except Exception:
-                args = None
-
-            if args:
-                qp_params = args.get('params')
-                if qp_params:
-                    parsed = None
-                    if isinstance(qp_params, str):
-                        try:
-                            import json as _json
-                            parsed = _json.loads(qp_params)
-                        except Exception:
-                            try:
-                                parsed = eval(qp_params, {"__builtins__": {}})
-                            except Exception:
-                                parsed = None
-                    elif isinstance(qp_params, dict):
-                        parsed = qp_params
-                    if isinstance(parsed, dict):
-                        params.update(parsed)
-
-                for k, v in args.items():
-                    if k in ("command", "params"):
-                        continue
-                    params[str(k)] = v
-
-            gcode_cmd = command
+            gcode_cmd = str(command)
             if params:
-                def _fmt_val(val):
-                    if isinstance(val, bool):
-                        return '1' if val else '0'
-                    return str(val)
-                param_str = " ".join([f"{k}={_fmt_val(v)}" for k, v in params.items()])
+                # The command may carry parameters of its own, only the added ones are checked
+                param_str = " ".join(
+                    f"{k}={format_gcode_value(v)}" for k, v in params.items())
                 gcode_cmd = f"{command} {param_str}"
 
             try:
@@ -267,16 +493,144 @@ class AceStatus:
             self.logger.error(f"Error handling ACE command request: {e}")
             return {"error": str(e)}
 
+    async def _registered_commands(self) -> Optional[Set[str]]:
+        '''ACE_* commands Klippy knows, None if its gcode help is unavailable'''
+        if self._ace_commands is None:
+            try:
+                result = await self.klippy_apis._send_klippy_request("gcode/help", {})
+            except Exception as e:
+                self.logger.debug(f"ACE command list unavailable: {e}")
+                return None
+            self._ace_commands = {
+                name.upper() for name in result if name.upper().startswith("ACE_")}
+        return self._ace_commands
+
+    async def handle_commands_request(self, webrequest: WebRequest) -> Dict[str, Any]:
+        '''Runs a list of ACE commands as one gcode script
+
+        Body: {"commands": [{"command": "ACE_SET_SLOT", "params": {...}}, ...]}.
+        Everything is validated before anything runs. Klippy stops the
+        script at the first error; the ACE_BATCH_MARK lines between the
+        commands tell which one failed.
+        '''
+        args = await self._request_args(webrequest)
+        commands = args.get("commands")
+        if isinstance(commands, str):
+            try:
+                commands = json.loads(commands)
+            except ValueError:
+                commands = None
+        if not isinstance(commands, list) or not commands:
+            return {"success": False, "error": "commands must be a non-empty list"}
+        if len(commands) > BATCH_MAX_COMMANDS:
+            return {"success": False,
+                    "error": f"at most {BATCH_MAX_COMMANDS} commands per request"}
+
+        registered = await self._registered_commands()
+        results: List[Dict[str, Any]] = []
+        lines: List[str] = []
+        valid = True
+        for entry in commands:
+            if isinstance(entry, str):
+                entry = {"command": entry}
+            result: Dict[str, Any] = {"command": None, "gcode": None, "status": "invalid"}
+            results.append(result)
+            try:
+                if not isinstance(entry, dict):
+                    raise ValueError("each command must be an object")
+                name = str(entry.get("command", "")).strip().upper()
+                result["command"] = name
+                if not name.startswith("ACE_") or name == BATCH_MARK_COMMAND:
+                    raise ValueError(f"{name or 'command'} is not an ACE command")
+                if registered is not None and name not in registered:
+                    raise ValueError(f"{name} is not registered in Klipper")
+                result["gcode"] = format_gcode_command(
+                    name, self._parse_params(entry.get("params")))
+                result["status"] = "pending"
+            except ValueError as e:
+                result["error"] = str(e)
+                valid = False
+        if not valid:
+            for result in results:
+                if result["status"] == "pending":
+                    result["status"] = "skipped"
+            return {"success": False, "error": "invalid commands, nothing was run",
+                    "results": results}
+
+        self._batch_id += 1
+        batch = f"{self._version}-{self._batch_id}"
+        for seq, result in enumerate(results):
+            lines.append(result["gcode"])
+            lines.append(f"{BATCH_MARK_COMMAND} ID={batch} SEQ={seq + 1}")
+        script = "\n".join(lines)
+        try:
+            await self.klippy_apis.run_gcode(script)
+        except Exception as e:
+            done = 0
+            try:
+                status = await self.klippy_apis.query_objects({"ace": ["batch_mark"]})
+                mark = status.get("ace", {}).get("batch_mark") or {}
+                if mark.get("id") == batch:
+                    done = min(int(mark.get("seq", 0)), len(results) - 1)
+            except Exception:
+                pass
+            for seq, result in enumerate(results):
+                if seq < done:
+                    result["status"] = "ok"
+                elif seq == done:
+                    result["status"] = "error"
+                    result["error"] = str(e)
+                else:
+                    result["status"] = "skipped"
+            self.logger.error(f"ACE command batch failed at {results[done]['gcode']}: {e}")
+            return {"success": False, "error": str(e), "results": results}
+        for result in results:
+            result["status"] = "ok"
+        return {"success": True, "results": results}
+
     async def _handle_status_update(self, status: Dict[str, Any]) -> None:
         try:
+            changed = False
             ace_data = status.get('ace')
-
             if ace_data:
-                self._last_status = ace_data
-                self.server.send_event("ace:status_update", ace_data)
+                self._ace_state.update(ace_data)
+                changed = True
+            variables = status.get('save_variables', {}).get('variables')
+            if isinstance(variables, dict):
+                self._variables = variables
+                changed = True
+            if changed:
+                self._publish()
         except Exception as e:
             self.logger.debug(f"Error handling status update: {e}")
 
+    @staticmethod
+    def _parse_color(color: Any) -> List[int]:
+        '''[r, g, b] from a list, a JSON list or "R,G,B"'''
+        if isinstance(color, str):
+            try:
+                color = json.loads(color)
+            except ValueError:
+                color = color.split(",")
+        return [int(c) for c in color]
+
+    async def _update_slot(self, index: int, **fields: Any) -> None:
+        '''Change inventory fields through ACE_UPDATE_SLOT
+
+        Klipper owns the inventory (AceSlot in extras/ace.py), it validates
+        the fields and saves ace_inventory and ace_inventory_version.
+        '''
+        params = [f"INDEX={index}"]
+        if fields.get("color") is not None:
+            params.append("COLOR=" + ",".join(str(c) for c in fields["color"]))
+        if fields.get("type") is not None:
+            params.append('TYPE="%s"' % (str(fields["type"]).replace('"', ''),))
+        if fields.get("temp") is not None:
+            params.append(f"TEMP={int(fields['temp'])}")
+        gcode_cmd = "ACE_UPDATE_SLOT " + " ".join(params)
+        self.logger.info(f"Running: {gcode_cmd}")
+        await self.klippy_apis.run_gcode(gcode_cmd)
+
     async def handle_set_slot_color(self, webrequest):
         '''Handles updating slot colors'''
         try:
@@ -284,48 +638,9 @@ class AceStatus:
             data = webrequest.get_args()
 
             index = int(data.get("index"))
-            color = data.get("color")
+            color = self._parse_color(data.get("color"))
 
-            # If color arrives as string, parse it
-            if isinstance(color, str):
-                import json
-                color = json.loads(color)
-
-            color = [int(c) for c in color]
-
-            # Get current saved variables
-            result = await self.klippy_apis.query_objects({"save_variables": None})
-            variables = result.get("save_variables", {}).get("variables", {})
-
-            inventory = variables.get("ace_inventory")
-
-            if not isinstance(inventory, list):
-                return {"error": "ace_inventory not found or invalid"}
-
-            # Update correct slot
-            for slot in inventory:
-                if slot.get("index") == index:
-                    slot["color"] = color
-                    break
-
-            # IMPORTANT: Your firmware expects Python literal, not JSON
-            value_str = repr(inventory)
-            escaped = value_str.replace('"', '\\"')
-
-            gcode_cmd = f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE="{escaped}"'
-
-            self.logger.info(f"Running: {gcode_cmd}")
-
-            await self.klippy_apis.run_gcode(gcode_cmd)
-
-            self.server.send_event(
-                "ace_status_update",
-                {
-                    "ace_inventory": self.ace_inventory,
-                    "filament_pos": self.filament_pos,
-                    "current_index": self.current_index
-                }
-            )
+            await self._update_slot(index, color=color)
 
             return {"success": True}
 
@@ -341,36 +656,7 @@ class AceStatus:
             index = int(data.get("index"))
             new_type = str(data.get("type"))
 
-            result = await self.klippy_apis.query_objects({"save_variables": None})
-            variables = result.get("save_variables", {}).get("variables", {})
-
-            inventory = variables.get("ace_inventory")
-
-            if not isinstance(inventory, list):
-                return {"error": "ace_inventory not found or invalid"}
-
-            # Update slot
-            for slot in inventory:
-                if slot.get("index") == index:
-                    slot["type"] = new_type
-                    break
-
-            # Save using Python literal
-            value_str = repr(inventory)
-            escaped = value_str.replace('"', '\\"')
-
-            gcode_cmd = f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE="{escaped}"'
-
-            await self.klippy_apis.run_gcode(gcode_cmd)
-
-            self.server.send_event(
-                "ace_status_update",
-                {
-                    "ace_inventory": self.ace_inventory,
-                    "filament_pos": self.filament_pos,
-                    "current_index": self.current_index
-                }
-            )
+            await self._update_slot(index, type=new_type)
 
             return {"success": True}
 
@@ -389,34 +675,8 @@ class AceStatus:
             new_type = data.get("type")
             new_temp = data.get("temp")
 
-            # Parse color if string
-            if isinstance(new_color, str):
-                import json
-                new_color = json.loads(new_color)
-
             if new_color is not None:
-                # If color comes as JSON string
-                if isinstance(new_color, str):
-                    try:
-                        import json
-                        new_color = json.loads(new_color)
-                    except:
-                        # If it comes as "255,0,0"
-                        new_color = [int(x) for x in new_color.split(",")]
-
-                new_color = [int(c) for c in new_color]
-
-            if new_temp is not None:
-                new_temp = int(new_temp)
-
-            # Load inventory
-            result = await self.klippy_apis.query_objects({"save_variables": None})
-            variables = result.get("save_variables", {}).get("variables", {})
-            inventory = variables.get("ace_inventory")
-            current_index = variables.get("ace_current_index")
-
-            if not isinstance(inventory, list):
-                return {"error": "ace_inventory not found or invalid"}
+                new_color = self._parse_color(new_color)
 
             # Default material temp map
             material_temps = {
@@ -427,41 +687,11 @@ class AceStatus:
                 "OTHER": 0
             }
 
-            # Update slot
-            for slot in inventory:
-                if slot.get("index") == index:
-
-                    if new_color is not None:
-                        slot["color"] = new_color
-
-                    if new_type is not None:
-                        slot["type"] = new_type
-
-                        # Auto update temp when type changes
-                        if new_type in material_temps:
-                            slot["temp"] = material_temps[new_type]
-
-                    if new_temp is not None:
-                        slot["temp"] = new_temp
+            # Auto update temp when type changes
+            if new_temp is None and new_type in material_temps:
+                new_temp = material_temps[new_type]
 
-                    break
-
-            # Save using Python literal (required for your firmware)
-            value_str = repr(inventory)
-            escaped = value_str.replace('"', '\\"')
-
-            gcode_cmd = f'SAVE_VARIABLE VARIABLE=ace_inventory VALUE="{escaped}"'
-
-            await self.klippy_apis.run_gcode(gcode_cmd)
-
-            self.server.send_event(
-                "ace_status_update",
-                {
-                    "ace_inventory": self.ace_inventory,
-                    "filament_pos": self.filament_pos,
-                    "current_index": self.current_index
-                }
-            )
+            await self._update_slot(index, color=new_color, type=new_type, temp=new_temp)
 
             return {"success": True}
 
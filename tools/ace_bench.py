@@ -0,0 +1,743 @@
+#!/usr/bin/env python3
+"""
+End-to-end toolchange benchmark for extras/ace.py
+
+Runs the real BunnyAce on a virtual clock against the in-process ACE
+emulator (tools/ace_emulator.py). Klippy is replaced by small fakes: a
+reactor, a toolhead with a move queue, filament switch sensors and MCU
+endstops that trigger when the filament tip passes configurable distances.
+
+    python3 tools/ace_bench.py --changes 0,1,2,3,-1 --repeat 3 --json run.json
+    python3 tools/ace_bench.py --endless
+    python3 tools/ace_bench.py --compare base.json run.json
+
+Each toolchange reports simulated and wall-clock time per phase (from
+BunnyAce._toolchange_stats), planner moves, reactor wakeups and ACE
+requests. --compare exits non-zero when a metric regressed by more than
+--threshold percent.
+"""
+
+import argparse
+import ast
+import heapq
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+sys.path.insert(0, os.path.join(os.path.dirname(TOOLS_DIR), 'extras'))
+
+import ace_emulator
+
+# Same buffering limits as klippy/toolhead.py
+BUFFER_TIME_LOW = 1.0
+BUFFER_TIME_HIGH = 2.0
+
+# Filament tip distance (mm from the parked position behind the splitter)
+# where each sensor triggers. Matches the default toolchange_retract_length
+# and toolchange_load_length_runout in ace.cfg.
+DEFAULT_GEOMETRY = {
+    'splitter_sensor': 100.,
+    'extruder_sensor': 240.,
+    'extruder_gears': 250.,
+    'toolhead_sensor': 280.,
+}
+
+
+class CommandError(Exception):
+    pass
+
+
+class ConfigError(Exception):
+    pass
+
+
+# Reactor -----------------------------------------------------------------
+
+class VirtualTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+        self.running = False
+
+
+class VirtualCompletion:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = None
+        self.done = False
+
+    def test(self):
+        return self.done
+
+    def complete(self, result):
+        self.result = result
+        self.done = True
+
+    def wait(self, waketime=None, waketime_result=None):
+        waketime = self.reactor.NEVER if waketime is None else waketime
+        while not self.done and self.reactor.monotonic() < waketime:
+            if not self.reactor.step(waketime):
+                # Nothing left to run, sleep until the wake time
+                if waketime < self.reactor.NEVER:
+                    self.reactor.now = max(self.reactor.now, waketime)
+                break
+        return self.result if self.done else waketime_result
+
+
+class VirtualReactor:
+    """
+    Single threaded reactor on a virtual clock
+
+    pause() runs other due timers until the wake time instead of sleeping,
+    the same way a greenlet would yield in klippy's reactor.
+    """
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self, start=1000.):
+        self.now = start
+        self.timers = []
+        self.wakeups = 0
+        self.pauses = 0
+
+    def monotonic(self):
+        return self.now
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = VirtualTimer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+
+    def unregister_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def register_callback(self, callback, waketime=NOW):
+        def run(eventtime):
+            self.unregister_timer(timer)
+            callback(eventtime)
+            return self.NEVER
+        timer = self.register_timer(run, waketime)
+        return timer
+
+    def completion(self):
+        return VirtualCompletion(self)
+
+    def step(self, limit):
+        """Run the earliest timer due before limit, False if there is none"""
+        due = [t for t in self.timers if not t.running and t.waketime <= limit]
+        if not due:
+            return False
+        timer = min(due, key=lambda t: t.waketime)
+        self.now = max(self.now, timer.waketime)
+        self.wakeups += 1
+        timer.running = True
+        try:
+            waketime = timer.callback(self.now)
+        finally:
+            timer.running = False
+        if waketime is not None:
+            timer.waketime = waketime
+        return True
+
+    def pause(self, waketime):
+        self.pauses += 1
+        while self.step(waketime):
+            pass
+        self.now = max(self.now, waketime)
+        return self.now
+
+    run_until = pause
+
+
+# Motion and filament -----------------------------------------------------
+
+class FakeToolhead:
+    """Queues moves on the virtual clock and reports extrusion as it happens"""
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.position = [0., 0., 0., 0.]
+        self.busy_until = 0.
+        self.segments = []
+        self.moves = 0
+
+    def get_position(self):
+        return list(self.position)
+
+    def move(self, newpos, speed):
+        self.moves += 1
+        delta = [n - o for n, o in zip(newpos, self.position)]
+        distance = max(sum(d * d for d in delta[:3]) ** .5, abs(delta[3]))
+        now = self.reactor.monotonic()
+        start = max(now, self.busy_until)
+        self.busy_until = start + distance / speed
+        if delta[3]:
+            heapq.heappush(self.segments, (start, self.busy_until, delta[3]))
+        self.position = list(newpos)
+        # Like toolhead._check_pause: block once the queue runs too far ahead
+        if self.busy_until - now > BUFFER_TIME_HIGH:
+            self.reactor.pause(self.busy_until - BUFFER_TIME_LOW)
+
+    def take_extrusion(self, now):
+        """Extruder motion executed since the last call"""
+        moved = 0.
+        pending = []
+        while self.segments:
+            start, end, length = heapq.heappop(self.segments)
+            if start >= now:
+                pending.append((start, end, length))
+                break
+            if end <= now:
+                moved += length
+                continue
+            done = length * (now - start) / (end - start)
+            moved += done
+            pending.append((now, end, length - done))
+        for segment in pending:
+            heapq.heappush(self.segments, segment)
+        return moved
+
+    def get_last_move_time(self):
+        return max(self.busy_until, self.reactor.monotonic())
+
+    def wait_moves(self):
+        self.reactor.pause(self.busy_until)
+
+    def get_status(self, eventtime):
+        return {'homed_axes': 'xyz', 'position': self.get_position()}
+
+
+class FilamentPath:
+    """
+    Filament tip position from the ACE slot positions plus extruder motion
+
+    Once the tip reaches the extruder gears the filament is gripped: the ACE
+    can neither push it further nor pull it back while part of it is past
+    the gears, only extruder moves do.
+    """
+
+    def __init__(self, emulator, toolhead, geometry):
+        self.emulator = emulator
+        self.toolhead = toolhead
+        self.geometry = geometry
+        self.gripped = None
+        self.beyond_gears = 0.
+
+    def loaded_slot(self):
+        positions = self.emulator.positions
+        return max(range(len(positions)), key=lambda i: positions[i])
+
+    def sync(self):
+        self.emulator.poll()
+        positions = self.emulator.positions
+        gears = self.geometry['extruder_gears']
+        moved = self.toolhead.take_extrusion(self.toolhead.reactor.monotonic())
+        if self.gripped is None:
+            slot = self.loaded_slot()
+            if positions[slot] < gears:
+                return
+            self.gripped = slot
+            self.beyond_gears = 0.
+        slot = self.gripped
+        if moved > 0:
+            self.emulator.pull(slot, moved)
+        self.beyond_gears = max(0., self.beyond_gears + moved)
+        if self.beyond_gears > 0.:
+            positions[slot] = gears + self.beyond_gears
+        elif positions[slot] >= gears:
+            positions[slot] = gears
+        else:
+            self.gripped = None
+
+    def run_out(self, slot):
+        """The spool end passed the splitter, the rest is printed and ignored"""
+        self.emulator.runout(slot)
+        self.emulator.positions[slot] = 0.
+        if self.gripped == slot:
+            self.gripped = None
+            self.beyond_gears = 0.
+
+    def tip(self):
+        self.sync()
+        return max(self.emulator.positions)
+
+    def present(self, sensor):
+        return self.tip() >= self.geometry[sensor]
+
+
+class FakeRunoutHelper:
+    def __init__(self, path, sensor):
+        self.path = path
+        self.sensor = sensor
+
+    @property
+    def filament_present(self):
+        return self.path.present(self.sensor)
+
+
+class FakeSwitchSensor:
+    def __init__(self, path, sensor):
+        self.runout_helper = FakeRunoutHelper(path, sensor)
+
+    def get_status(self, eventtime):
+        return {'filament_detected': self.runout_helper.filament_present,
+                'enabled': True}
+
+
+class FakeEndstop:
+    def __init__(self, path, sensor):
+        self.path = path
+        self.sensor = sensor
+
+    def query_endstop(self, print_time):
+        return int(self.path.present(self.sensor))
+
+
+# Klippy objects ----------------------------------------------------------
+
+class FakeGCode:
+    error = CommandError
+
+    def __init__(self, printer, macro_times, verbose=False):
+        self.printer = printer
+        self.macro_times = macro_times
+        self.verbose = verbose
+        self.commands = {}
+        self.scripts = []
+        self.responses = []
+
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.commands[cmd] = func
+
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+        if self.verbose:
+            print('//', msg)
+
+    respond_raw = respond_info
+
+    def run_script_from_command(self, script):
+        reactor = self.printer.get_reactor()
+        for line in script.strip().split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            self.scripts.append(line)
+            cmd = line.split()[0].upper()
+            if cmd == 'SAVE_VARIABLE':
+                self._save_variable(line)
+            elif cmd in self.commands:
+                self.commands[cmd](FakeGCodeCommand(self, _parse_params(line)))
+            elif self.macro_times.get(cmd):
+                reactor.pause(reactor.monotonic() + self.macro_times[cmd])
+
+    run_script = run_script_from_command
+
+    def _save_variable(self, line):
+        params = _parse_params(line)
+        value = params.get('VALUE', '')
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        # Like save_variables.py the dict is replaced, not updated in place
+        save_variables = self.printer.lookup_object('save_variables')
+        variables = dict(save_variables.allVariables)
+        variables[params['VARIABLE'].lower()] = value
+        save_variables.allVariables = variables
+
+
+def _parse_params(line):
+    # Extended gcode parameters are split like klippy's gcode.py does
+    params = {}
+    for part in shlex.split(line)[1:]:
+        if '=' in part:
+            key, value = part.split('=', 1)
+            params[key.upper()] = value
+    return params
+
+
+class FakeGCodeCommand:
+    def __init__(self, gcode, params):
+        self.gcode = gcode
+        self.params = params
+        self.error = CommandError
+
+    def get(self, name, default=CommandError, **kw):
+        if name in self.params:
+            return self.params[name]
+        if default is CommandError:
+            raise CommandError('Missing %s' % (name,))
+        return default
+
+    def get_int(self, name, default=CommandError, **kw):
+        value = self.get(name, default)
+        return None if value is None else int(value)
+
+    def get_float(self, name, default=CommandError, **kw):
+        value = self.get(name, default)
+        return None if value is None else float(value)
+
+    def respond_info(self, msg, log=True):
+        self.gcode.respond_info(msg)
+
+
+class FakeFileConfig:
+    def add_section(self, section):
+        pass
+
+    def set(self, section, option, value):
+        pass
+
+
+class FakeConfig:
+    error = ConfigError
+
+    def __init__(self, printer, name, options):
+        self.printer = printer
+        self.name = name
+        self.options = options
+        self.fileconfig = FakeFileConfig()
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def get(self, option, default=None, **kw):
+        return self.options.get(option, default)
+
+    def _get(self, option, default, parser):
+        value = self.options.get(option, default)
+        return None if value is None else parser(value)
+
+    def getint(self, option, default=None, **kw):
+        return self._get(option, default, int)
+
+    def getfloat(self, option, default=None, **kw):
+        return self._get(option, default, float)
+
+    def getboolean(self, option, default=None, **kw):
+        return self._get(option, default, lambda v: v if isinstance(v, bool)
+                         else str(v).lower() in ('1', 'true', 'yes'))
+
+    def getchoice(self, option, choices, default=None):
+        return choices[self.options.get(option, default)]
+
+    def get_prefix_options(self, prefix):
+        return [o for o in self.options if o.startswith(prefix)]
+
+
+class FakePins:
+    def __init__(self, path):
+        self.path = path
+
+    def parse_pin(self, pin, can_invert=False, can_pullup=False):
+        return {'chip_name': 'mcu', 'pin': pin}
+
+    def allow_multi_use_pin(self, share_name):
+        pass
+
+    def setup_pin(self, pin_type, pin):
+        return FakeEndstop(self.path, pin)
+
+
+class FakeQueryEndstops:
+    def register_endstop(self, mcu_endstop, name):
+        pass
+
+
+class FakeSaveVariables:
+    def __init__(self):
+        self.allVariables = {'ace_current_index': -1,
+                             'ace_filament_pos': 'splitter'}
+
+
+class FakeGCodeMove:
+    def reset_last_position(self):
+        pass
+
+
+class FakePrinter:
+    config_error = ConfigError
+    command_error = CommandError
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.objects = {}
+        self.handlers = {}
+
+    def get_reactor(self):
+        return self.reactor
+
+    def get_start_args(self):
+        return {}
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def lookup_object(self, name, default=ConfigError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is ConfigError:
+            raise ConfigError('Unknown object %s' % (name,))
+        return default
+
+    def lookup_objects(self, module=None):
+        return [(name, obj) for name, obj in self.objects.items()
+                if module is None or name.split()[0] == module]
+
+    def load_object(self, config, section):
+        if section not in self.objects:
+            if section.startswith('filament_switch_sensor '):
+                sensor = section.split()[-1]
+                self.objects[section] = FakeSwitchSensor(self.path, sensor)
+            elif section == 'query_endstops':
+                self.objects[section] = FakeQueryEndstops()
+        return self.objects[section]
+
+    def register_event_handler(self, event, callback):
+        self.handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.handlers.get(event, [])]
+
+    def invoke_shutdown(self, msg):
+        raise RuntimeError('Shutdown: ' + msg)
+
+
+# Bench -------------------------------------------------------------------
+
+class AceBench:
+    """Klippy fakes wired to a real BunnyAce and an in-process emulator"""
+
+    def __init__(self, options=None, geometry=None, macro_times=None,
+                 faults=None, seed=0, verbose=False):
+        self.reactor = VirtualReactor()
+        self.printer = printer = FakePrinter(self.reactor)
+        self.emulator = ace_emulator.AceEmulator(
+            clock=self.reactor.monotonic, faults=faults, seed=seed)
+        self.toolhead = FakeToolhead(self.reactor)
+        self.path = FilamentPath(self.emulator, self.toolhead,
+                                 dict(DEFAULT_GEOMETRY, **(geometry or {})))
+        printer.path = self.path
+        self.gcode = FakeGCode(printer, macro_times or {}, verbose)
+        printer.add_object('gcode', self.gcode)
+        printer.add_object('save_variables', FakeSaveVariables())
+        printer.add_object('pins', FakePins(self.path))
+        printer.add_object('toolhead', self.toolhead)
+        printer.add_object('gcode_move', FakeGCodeMove())
+
+        import ace
+        ace_options = {
+            'splitter_sensor_pin': 'splitter_sensor',
+            'extruder_sensor_pin': 'extruder_sensor',
+            'toolhead_sensor_pin': 'toolhead_sensor',
+        }
+        ace_options.update(options or {})
+        self.ace = ace.BunnyAce(FakeConfig(printer, 'ace', ace_options))
+        self.ace.find_com_port = lambda name: 'emulator'
+        self.ace._open_serial = lambda port: ace_emulator.SerialLink(self.emulator)
+        for slot in self.emulator.slots:
+            self.ace.slots[slot['index']].set(
+                status=slot['status'], color=slot['color'], type=slot['type'],
+                temp=210, sku=slot['sku'], rfid=slot['rfid'])
+
+        printer.send_event('klippy:ready')
+        self.settle(2.)
+
+    def settle(self, seconds):
+        self.reactor.run_until(self.reactor.monotonic() + seconds)
+
+    def _counters(self):
+        return (self.toolhead.moves, self.reactor.wakeups,
+                self.emulator.stats['frames_in'], time.perf_counter())
+
+    def _result(self, before):
+        moves, wakeups, requests, _ = self._counters()
+        stats = dict(self.ace._toolchange_stats or {})
+        stats.update({
+            'moves': moves - before[0],
+            'wakeups': wakeups - before[1],
+            'requests': requests - before[2],
+        })
+        return stats
+
+    def toolchange(self, tool):
+        before = self._counters()
+        self.ace._toolchange_stats = None
+        gcmd = FakeGCodeCommand(self.gcode, {'TOOL': str(tool)})
+        self.ace.cmd_ACE_CHANGE_TOOL(gcmd)
+        self.toolhead.wait_moves()
+        result = self._result(before)
+        self.settle(1.)
+        return result
+
+    def endless_spool(self, timeout=120.):
+        """Run out the loaded slot and time the automatic switch"""
+        slot = self.variables().get('ace_current_index', -1)
+        if slot < 0:
+            raise RuntimeError('endless spool benchmark needs a loaded tool')
+        self.ace.endless_spool_enabled = True
+        before = self._counters()
+        self.ace._toolchange_stats = None
+        self.path.run_out(slot)
+        end = self.reactor.monotonic() + timeout
+        while self.ace._toolchange_stats is None and self.reactor.monotonic() < end:
+            self.settle(.5)
+        result = self._result(before)
+        self.ace.endless_spool_enabled = False
+        return result
+
+    def variables(self):
+        return self.ace.variables
+
+
+def summarize(results):
+    summary = {}
+    for result in results:
+        key = '%s %s->%s' % (result.get('kind', 'toolchange'),
+                             result.get('from'), result.get('to'))
+        entry = summary.setdefault(key, {'count': 0, 'time': 0., 'wall': 0.,
+                                         'moves': 0, 'wakeups': 0,
+                                         'requests': 0, 'phases': {}})
+        entry['count'] += 1
+        for metric in ('time', 'wall', 'moves', 'wakeups', 'requests'):
+            entry[metric] += result.get(metric, 0)
+        for name, phase in result.get('phases', {}).items():
+            entry['phases'][name] = entry['phases'].get(name, 0.) + phase['time']
+    for entry in summary.values():
+        count = entry['count']
+        for metric in ('time', 'wall', 'moves', 'wakeups', 'requests'):
+            entry[metric] = round(entry[metric] / count, 4)
+        entry['phases'] = {name: round(total / count, 3)
+                           for name, total in entry['phases'].items()}
+    return summary
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=TOOLS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(summary):
+    print('%-28s %5s %9s %9s %7s %8s %8s' % (
+        'transition', 'n', 'sim s', 'wall ms', 'moves', 'wakeups', 'requests'))
+    for key, entry in sorted(summary.items()):
+        print('%-28s %5d %9.2f %9.1f %7.0f %8.0f %8.0f' % (
+            key, entry['count'], entry['time'], entry['wall'] * 1000.,
+            entry['moves'], entry['wakeups'], entry['requests']))
+        for name, value in entry['phases'].items():
+            print('    %-24s %9.2f' % (name, value))
+
+
+def compare(base_path, new_path, threshold):
+    with open(base_path) as f:
+        base = json.load(f)['summary']
+    with open(new_path) as f:
+        new = json.load(f)['summary']
+    regressions = 0
+    print('%-28s %-9s %10s %10s %8s' % ('transition', 'metric', 'base', 'new', 'change'))
+    for key in sorted(set(base) & set(new)):
+        for metric in ('time', 'moves', 'wakeups', 'requests', 'wall'):
+            old, value = base[key][metric], new[key][metric]
+            change = (value - old) / old * 100. if old else 0.
+            flag = ''
+            # Wall time is too noisy to fail on
+            if metric != 'wall' and change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('%-28s %-9s %10.3f %10.3f %+7.1f%%%s' % (
+                key, metric, old, value, change, flag))
+    for key in sorted(set(base) ^ set(new)):
+        print('%-28s only in %s' % (key, base_path if key in base else new_path))
+    return regressions
+
+
+def _parse_pairs(values, convert=float):
+    result = {}
+    for value in values or ():
+        key, _, number = value.partition('=')
+        result[key.strip()] = convert(number)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE toolchange benchmark')
+    parser.add_argument('--changes', default='0,1,2,3,-1',
+                        help='comma separated tool sequence')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--endless', action='store_true',
+                        help='also benchmark an endless spool switch')
+    parser.add_argument('--geometry', action='append', metavar='SENSOR=MM',
+                        help='override a sensor distance, e.g. toolhead_sensor=660')
+    parser.add_argument('--macro-time', action='append', metavar='MACRO=S',
+                        help='simulated duration of a macro, e.g. CUT_TIP=3')
+    parser.add_argument('--option', action='append', metavar='NAME=VALUE',
+                        help='[ace] config option')
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=5.,
+                        help='regression threshold in percent for --compare')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    bench = AceBench(
+        options=_parse_pairs(args.option, str),
+        geometry=_parse_pairs(args.geometry),
+        macro_times={k.upper(): v for k, v in _parse_pairs(args.macro_time).items()},
+        faults=ace_emulator.Faults(latency=args.latency),
+        seed=args.seed, verbose=args.verbose)
+
+    tools = [int(t) for t in args.changes.split(',') if t.strip()]
+    results = []
+    wall_start = time.perf_counter()
+    for _ in range(args.repeat):
+        for tool in tools:
+            if tool == bench.variables().get('ace_current_index', -1):
+                continue
+            results.append(bench.toolchange(tool))
+    if args.endless:
+        if bench.variables().get('ace_current_index', -1) < 0:
+            results.append(bench.toolchange(0))
+        results.append(bench.endless_spool())
+
+    summary = summarize(results)
+    print_summary(summary)
+    report = {
+        'revision': _git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall_total': round(time.perf_counter() - wall_start, 3),
+        'options': vars(args),
+        'startup_time': bench.ace.metrics.startup_time,
+        'results': results,
+        'summary': summary,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Offline tool for ACE serial captures (ACE_CAPTURE / capture_file)
+
+    python3 tools/ace_capture.py decode ace.cap --method feed_filament
+    python3 tools/ace_capture.py decode ace.cap --min-latency 200
+    python3 tools/ace_capture.py stats ace.cap
+    python3 tools/ace_capture.py replay ace.cap --target emulator
+    python3 tools/ace_capture.py replay ace.cap --target decoder
+    python3 tools/ace_capture.py transcript ace.cap -o ace.jsonl
+
+Rotated files (ace.cap.1, ace.cap.2, ...) are read oldest first with --all.
+A capture can also be passed directly to ace_emulator.py --replay.
+"""
+
+import argparse
+import bisect
+import json
+import os
+import struct
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, TOOLS_DIR)
+
+# Must match extras/ace.py
+CAPTURE_MAGIC = b'ACECAP1\n'
+CAPTURE_HEADER = struct.Struct('<dd')
+CAPTURE_RECORD = struct.Struct('<dBI')
+CAPTURE_TX = 0
+CAPTURE_RX = 1
+DIRECTIONS = {CAPTURE_TX: 'host', CAPTURE_RX: 'ace'}
+
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]  # ms
+
+
+def capture_files(path, include_rotated=False):
+    """The capture and, optionally, its rotated backups oldest first"""
+    if not include_rotated:
+        return [path]
+    backups = []
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        backups.append('%s.%d' % (path, i))
+        i += 1
+    return list(reversed(backups)) + [path]
+
+
+def is_capture(path):
+    with open(path, 'rb') as f:
+        return f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def read_records(paths):
+    """Yield (reactor time, direction, raw bytes) from capture files"""
+    for path in paths:
+        with open(path, 'rb') as f:
+            if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError('%s is not an ACE capture' % (path,))
+            f.read(CAPTURE_HEADER.size)
+            while True:
+                head = f.read(CAPTURE_RECORD.size)
+                if len(head) < CAPTURE_RECORD.size:
+                    break
+                eventtime, direction, length = CAPTURE_RECORD.unpack(head)
+                data = f.read(length)
+                if len(data) < length:
+                    break  # Truncated by a crash or an unfinished write
+                yield eventtime, direction, data
+
+
+def calc_crc(buffer):
+    crc = 0xffff
+    for byte in buffer:
+        data = byte
+        data ^= crc & 0xff
+        data ^= (data & 0x0f) << 4
+        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
+    return crc & 0xffff
+
+
+class FrameDecoder:
+    """Reassembles frames from a byte stream split at arbitrary points"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Return a list of (frame dict or None, error or None)"""
+        self.buffer += data
+        result = []
+        while True:
+            start = self.buffer.find(b'\xff\xaa')
+            if start < 0:
+                if len(self.buffer) > 1:
+                    result.append((None, 'garbage %d bytes' % (len(self.buffer) - 1,)))
+                    del self.buffer[:-1]
+                return result
+            if start:
+                result.append((None, 'garbage %d bytes' % (start,)))
+                del self.buffer[:start]
+            if len(self.buffer) < 4:
+                return result
+            length = struct.unpack('<H', self.buffer[2:4])[0]
+            end = 4 + length + 2
+            if len(self.buffer) < end + 1:
+                return result
+            payload = bytes(self.buffer[4:4 + length])
+            crc = struct.unpack('<H', self.buffer[4 + length:end])[0]
+            tail = self.buffer[end]
+            del self.buffer[:end + 1]
+            if tail != 0xFE:
+                result.append((None, 'missing frame end'))
+                continue
+            if crc != calc_crc(payload):
+                result.append((None, 'bad CRC'))
+                continue
+            try:
+                result.append((json.loads(payload.decode('utf-8')), None))
+            except ValueError:
+                result.append((None, 'invalid JSON'))
+
+
+def decode(records):
+    """
+    Yield events {t, dir, frame, error, chunk} in capture order
+
+    Responses get 'method' and 'latency' (ms) from the matching request.
+    """
+    decoders = {CAPTURE_TX: FrameDecoder(), CAPTURE_RX: FrameDecoder()}
+    requests = {}
+    for chunk, (eventtime, direction, data) in enumerate(records):
+        for frame, error in decoders[direction].feed(data):
+            event = {'t': eventtime, 'dir': DIRECTIONS.get(direction, '?'),
+                     'frame': frame, 'error': error, 'chunk': chunk}
+            if frame is not None:
+                if direction == CAPTURE_TX:
+                    requests[frame.get('id')] = (eventtime, frame.get('method'))
+                    event['method'] = frame.get('method')
+                else:
+                    sent = requests.pop(frame.get('id'), None)
+                    if sent is not None:
+                        event['method'] = sent[1]
+                        event['latency'] = (eventtime - sent[0]) * 1000.
+            yield event
+
+
+def load_transcript(path, include_rotated=False):
+    """Records in the ace_emulator Transcript format"""
+    return [{'t': event['t'], 'dir': event['dir'], 'frame': event['frame']}
+            for event in decode(read_records(capture_files(path, include_rotated)))
+            if event['frame'] is not None]
+
+
+def _format_event(event):
+    frame = event['frame']
+    if frame is None:
+        return '%.3f %-4s ERROR %s' % (event['t'], event['dir'], event['error'])
+    if event['dir'] == 'host':
+        return '%.3f host  -> #%s %s %s' % (
+            event['t'], frame.get('id'), frame.get('method'),
+            json.dumps(frame.get('params', {})))
+    latency = event.get('latency')
+    return '%.3f ace   <- #%s %s code=%s %s%s' % (
+        event['t'], frame.get('id'), event.get('method', '?'), frame.get('code'),
+        json.dumps(frame.get('result', frame.get('msg', ''))),
+        '' if latency is None else ' (%.1f ms)' % (latency,))
+
+
+def cmd_decode(args):
+    for event in decode(read_records(capture_files(args.capture, args.all))):
+        if args.method and event.get('method') != args.method:
+            continue
+        if args.errors and event['error'] is None:
+            continue
+        latency = event.get('latency')
+        if args.min_latency is not None and (latency is None or latency < args.min_latency):
+            continue
+        if args.max_latency is not None and (latency is None or latency > args.max_latency):
+            continue
+        print(_format_event(event))
+
+
+def histogram(latencies):
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for latency in latencies:
+        counts[bisect.bisect_left(HISTOGRAM_BUCKETS, latency)] += 1
+    return counts
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def cmd_stats(args):
+    latencies = {}
+    errors = {}
+    frames = 0
+    pending = {}
+    for event in decode(read_records(capture_files(args.capture, args.all))):
+        if event['error'] is not None:
+            errors[event['error']] = errors.get(event['error'], 0) + 1
+            continue
+        frames += 1
+        if event['dir'] == 'host':
+            pending[event['frame'].get('id')] = event['method']
+        elif 'latency' in event:
+            pending.pop(event['frame'].get('id'), None)
+            latencies.setdefault(event['method'], []).append(event['latency'])
+    print('%d frames, %d unanswered requests' % (frames, len(pending)))
+    for error, count in sorted(errors.items()):
+        print('  %-20s %d' % (error, count))
+    labels = ['<=%d' % (b,) for b in HISTOGRAM_BUCKETS] + ['>%d' % (HISTOGRAM_BUCKETS[-1],)]
+    for method, values in sorted(latencies.items()):
+        print('\n%s: %d responses, p50 %.1f ms, p95 %.1f ms, max %.1f ms' % (
+            method, len(values), percentile(values, .5), percentile(values, .95),
+            max(values)))
+        counts = histogram(values)
+        peak = max(counts) or 1
+        for label, count in zip(labels, counts):
+            if count:
+                print('  %7s ms %6d %s' % (label, count, '#' * max(1, count * 40 // peak)))
+
+
+def replay_decoder(records):
+    """Feed ACE output with its original chunking, like BunnyAce._reader"""
+    decoder = FrameDecoder()
+    chunks = frames = errors = multi = 0
+    for eventtime, direction, data in records:
+        if direction != CAPTURE_RX:
+            continue
+        chunks += 1
+        result = decoder.feed(data)
+        frames += sum(1 for frame, error in result if frame is not None)
+        errors += sum(1 for frame, error in result if error is not None)
+        if len(result) > 1:
+            multi += 1
+    print('%d reads, %d frames, %d errors' % (chunks, frames, errors))
+    print('%d reads held more than one frame (BunnyAce._reader parses one per read)' % (multi,))
+
+
+def replay_emulator(records, quirks):
+    """Send the captured requests to the emulator at their original times"""
+    import ace_emulator
+
+    clock = [0.]
+    emulator = ace_emulator.AceEmulator(clock=lambda: clock[0], quirks=quirks)
+    decoder = FrameDecoder()
+    recorded = {}
+    events = list(decode(records))
+    for event in events:
+        if event['dir'] == 'ace' and event['frame'] is not None:
+            recorded[event['frame'].get('id')] = event
+    if not events:
+        print('Empty capture')
+        return
+    clock[0] = events[0]['t']
+
+    def advance(until):
+        while clock[0] < until:
+            clock[0] = min(until, clock[0] + 0.001)
+            emulator.poll()
+            for frame, error in decoder.feed(emulator.read_output()):
+                if frame is not None:
+                    answered[frame.get('id')] = clock[0]
+
+    answered = {}
+    sent = {}
+    for event in events:
+        if event['dir'] != 'host' or event['frame'] is None:
+            continue
+        advance(event['t'])
+        frame = event['frame']
+        sent[frame.get('id')] = (clock[0], frame.get('method'))
+        emulator.receive(ace_emulator.encode_frame(frame))
+    advance(clock[0] + 1.)
+
+    missing = [i for i in sent if i not in answered]
+    print('%d requests replayed, %d answered, %d lost' % (
+        len(sent), len(answered), len(missing)))
+    print('emulator stats: %s' % (json.dumps(emulator.stats),))
+    by_method = {}
+    for request_id, (t, method) in sent.items():
+        if request_id in answered:
+            entry = by_method.setdefault(method, {'emulator': [], 'recorded': []})
+            entry['emulator'].append((answered[request_id] - t) * 1000.)
+            if request_id in recorded and 'latency' in recorded[request_id]:
+                entry['recorded'].append(recorded[request_id]['latency'])
+    for method, entry in sorted(by_method.items()):
+        print('  %-24s emulator p50 %6.1f ms   recorded p50 %6.1f ms' % (
+            method, percentile(entry['emulator'], .5),
+            percentile(entry['recorded'], .5)))
+
+
+def cmd_replay(args):
+    records = list(read_records(capture_files(args.capture, args.all)))
+    if args.target == 'decoder':
+        replay_decoder(records)
+    else:
+        replay_emulator(records, not args.no_quirks)
+
+
+def cmd_transcript(args):
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for record in load_transcript(args.capture, args.all):
+            out.write(json.dumps(record) + '\n')
+    finally:
+        if args.output:
+            out.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE serial capture tool')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    def add(name, func, help):
+        p = sub.add_parser(name, help=help)
+        p.add_argument('capture')
+        p.add_argument('--all', action='store_true',
+                       help='include rotated files (capture.1, capture.2, ...)')
+        p.set_defaults(func=func)
+        return p
+
+    p = add('decode', cmd_decode, 'print decoded frames')
+    p.add_argument('--method', help='only frames of this method')
+    p.add_argument('--min-latency', type=float, help='only responses slower than this (ms)')
+    p.add_argument('--max-latency', type=float, help='only responses faster than this (ms)')
+    p.add_argument('--errors', action='store_true', help='only framing errors')
+    add('stats', cmd_stats, 'latency histograms per method')
+    p = add('replay', cmd_replay, 'replay against the emulator or the decoder')
+    p.add_argument('--target', choices=('emulator', 'decoder'), default='emulator')
+    p.add_argument('--no-quirks', action='store_true',
+                   help='disable emulator protocol quirks')
+    p = add('transcript', cmd_transcript, 'convert to an emulator transcript')
+    p.add_argument('-o', '--output')
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
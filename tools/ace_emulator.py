@@ -0,0 +1,671 @@
+#!/usr/bin/env python3
+"""
+Software emulator for the Anycubic ACE Pro
+
+Speaks the framed JSON protocol described in PROTOCOL.md on a PTY so that
+extras/ace.py can be exercised without hardware:
+
+    python3 tools/ace_emulator.py --link /tmp/ttyACE0
+    # ace.cfg: serial: /tmp/ttyACE0
+
+The device model is driven by poll() with an injectable clock, so the same
+AceEmulator can run in real time behind a PTY or in-process on a virtual
+clock (see SerialLink). It simulates busy/ready timing, per-slot filament
+positions, feed assist pushes and the dryer, and reproduces the documented
+quirks: frames longer than 1024 bytes freeze the device, 3 s without a
+complete frame makes it reboot (disconnect), and the shared ring buffer
+drops data when the host does not wait for responses.
+
+Faults can be injected with --drop-rate, --crc-rate and --disconnect-rate.
+With --replay the emulator answers requests from a recorded transcript
+(JSON lines, see Transcript) and falls back to the simulation when a method
+has no recorded responses left.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import pty
+import random
+import select
+import struct
+import sys
+import termios
+import time
+import tty
+
+try:
+    from serial import SerialException
+except ImportError:
+    SerialException = IOError
+
+FRAME_HEAD = b'\xff\xaa'
+FRAME_TAIL = 0xFE
+MAX_FRAME_LENGTH = 1024     # Longer frames freeze the ACE
+KEEPALIVE_TIMEOUT = 3.      # ACE reboots without a complete frame for this long
+RING_BUFFER_SIZE = 1024     # Shared input/output buffer
+
+AMBIENT_TEMP = 25.
+
+
+def calc_crc(buffer):
+    """CRC-16/MCRF4XX, same as BunnyAce._calc_crc"""
+    crc = 0xffff
+    for byte in buffer:
+        data = byte
+        data ^= crc & 0xff
+        data ^= (data & 0x0f) << 4
+        crc = ((data << 8) | (crc >> 8)) ^ (data >> 4) ^ (data << 3)
+    return crc & 0xffff
+
+
+def encode_frame(message, corrupt_crc=False):
+    payload = json.dumps(message).encode('utf-8')
+    crc = calc_crc(payload)
+    if corrupt_crc:
+        crc ^= 0x5a5a
+    return (FRAME_HEAD + struct.pack('<H', len(payload)) + payload
+            + struct.pack('<H', crc) + bytes([FRAME_TAIL]))
+
+
+def default_slots():
+    colors = [[255, 255, 255], [0, 0, 0], [200, 30, 30], [30, 60, 200]]
+    return [{
+        'index': i,
+        'status': 'ready',
+        'sku': 'EMU-%02d' % (i,),
+        'brand': 'Emulator',
+        'type': 'PLA',
+        'color': colors[i],
+        'rfid': 2,
+        'extruder_temp': {'min': 190, 'max': 230},
+        'hotbed_temp': {'min': 50, 'max': 70},
+        'diameter': 1.75,
+        'total': 330,
+        'current': 330,
+    } for i in range(4)]
+
+
+class Faults:
+    """Fault injection settings, rates are probabilities per frame or second"""
+
+    def __init__(self, drop_rate=0., crc_rate=0., disconnect_rate=0.,
+                 latency=0.01, latency_jitter=0.005, assist_slip=False):
+        self.drop_rate = drop_rate              # drop bytes from a response
+        self.crc_rate = crc_rate                # corrupt a response CRC
+        self.disconnect_rate = disconnect_rate  # spontaneous reboots per second
+        self.latency = latency                  # response delay
+        self.latency_jitter = latency_jitter
+        self.assist_slip = assist_slip          # feed assist pushes never finish
+
+
+class Transcript:
+    """
+    Recorded traffic used by replay mode
+
+    One JSON object per line: {"t": seconds, "dir": "host"|"ace", "frame": {...}}
+    Host frames are requests, ACE frames are the responses with matching id.
+    Binary captures written by ACE_CAPTURE are converted on load.
+    """
+
+    def __init__(self, records=()):
+        self.records = list(records)
+
+    @classmethod
+    def load(cls, path):
+        import ace_capture
+        if ace_capture.is_capture(path):
+            return cls(ace_capture.load_transcript(path))
+        records = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        return cls(records)
+
+    def responses_by_method(self):
+        """method -> [(response, delay)] in recorded order"""
+        pending = {}
+        result = {}
+        for record in self.records:
+            frame = record.get('frame', {})
+            if record.get('dir') == 'host':
+                pending[frame.get('id')] = (frame.get('method'), record['t'])
+            elif record.get('dir') == 'ace' and frame.get('id') in pending:
+                method, sent = pending.pop(frame['id'])
+                result.setdefault(method, []).append(
+                    (frame, max(0., record['t'] - sent)))
+        return result
+
+
+class AceEmulator:
+    """
+    ACE Pro device model
+
+    The host side calls receive() with bytes written to the port and
+    read_output() for bytes to deliver; poll() advances the model to the
+    current clock time.
+    """
+
+    def __init__(self, clock=time.monotonic, slots=None, faults=None,
+                 seed=None, quirks=True, replay=None, recorder=None,
+                 feed_shift_time=0.5, assist_speed=40., assist_push_length=10.,
+                 heat_rate=0.1):
+        self.clock = clock
+        self.faults = faults or Faults()
+        self.random = random.Random(seed)
+        self.quirks = quirks
+        self.replay = replay.responses_by_method() if replay else {}
+        self.recorder = recorder
+        self.feed_shift_time = feed_shift_time
+        self.assist_speed = assist_speed
+        self.assist_push_length = assist_push_length
+        self.heat_rate = heat_rate
+
+        self.info = {
+            'id': 0,
+            'slots': 4,
+            'model': 'Anycubic Color Engine Pro',
+            'firmware': 'V1.3.82',
+            'boot_firmware': 'V1.0.1',
+        }
+        self.slots = slots or default_slots()
+        # Filament length pushed out of the ACE per slot (mm)
+        self.positions = [0.] * len(self.slots)
+        self.gear_slot = -1
+        self.motion = None
+        self.assist_index = -1
+        self.assist_pending = 0.
+        self.assist_pushed = 0.
+        self.feed_assist_count = 0
+        self.cont_assist_time = 0.
+        self.enable_rfid = 1
+        self.temp = AMBIENT_TEMP
+        self.fan_speed = 0
+        self.dryer = {'status': 'stop', 'target_temp': 0, 'duration': 0,
+                      'remain_time': 0}
+
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.pending = []  # (due time, frame bytes)
+        self.frozen = False
+        self.connected = True
+        self.last_poll = None
+        self.last_frame_time = None
+        self.stats = {
+            'frames_in': 0, 'frames_out': 0, 'bad_crc': 0, 'dropped_bytes': 0,
+            'lost_responses': 0, 'reboots': 0, 'replayed': 0,
+        }
+
+    # Host side -------------------------------------------------------------
+
+    def receive(self, data):
+        if not self.connected or self.frozen:
+            return
+        now = self.clock()
+        if self.last_frame_time is None:
+            self.last_frame_time = now
+        if self.quirks:
+            room = RING_BUFFER_SIZE - len(self.rx) - len(self.tx)
+            if len(data) > room:
+                self.stats['dropped_bytes'] += len(data) - max(room, 0)
+                data = data[:max(room, 0)]
+        self.rx += data
+        self._parse(now)
+
+    def read_output(self, size=4096):
+        data = bytes(self.tx[:size])
+        del self.tx[:size]
+        return data
+
+    def reset(self):
+        """Power cycle: clears a freeze and all transient state"""
+        self.frozen = False
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.pending = []
+        self.motion = None
+        self.assist_index = -1
+        self.connected = True
+        self.last_frame_time = None
+
+    def disconnect(self):
+        """USB disconnect as seen after a keepalive reboot"""
+        self.connected = False
+        self.stats['reboots'] += 1
+        self.tx = bytearray()
+        self.pending = []
+        self.motion = None
+        self.assist_index = -1
+        self.last_frame_time = None
+        # Unlike output, partial input survives: frames can be split
+        # across connections
+
+    def reconnect(self):
+        self.connected = True
+
+    # Filament side (used by benchmarks / physics) ---------------------------
+
+    def pull(self, index, length):
+        """The extruder consumes filament from a slot"""
+        self.positions[index] += length
+        slot = self.slots[index]
+        slot['current'] = max(0., slot.get('current', 0) - length / 1000.)
+        if index == self.assist_index:
+            self.assist_pending += length
+
+    def set_slot(self, index, **fields):
+        self.slots[index].update(fields)
+
+    def runout(self, index):
+        self.set_slot(index, status='empty', current=0)
+
+    # Model -----------------------------------------------------------------
+
+    def poll(self):
+        now = self.clock()
+        dt = 0. if self.last_poll is None else max(0., now - self.last_poll)
+        self.last_poll = now
+        if not self.connected or self.frozen:
+            return
+
+        if (self.quirks and self.last_frame_time is not None
+                and now - self.last_frame_time > KEEPALIVE_TIMEOUT):
+            logging.info('ACE emulator: keepalive timeout, rebooting')
+            self.disconnect()
+            return
+        if (self.faults.disconnect_rate
+                and self.random.random() < self.faults.disconnect_rate * dt):
+            logging.info('ACE emulator: injected disconnect')
+            self.disconnect()
+            return
+
+        self._advance_motion(dt)
+        self._advance_assist(dt)
+        self._advance_dryer(dt)
+
+        due = [item for item in self.pending if item[0] <= now]
+        if due:
+            self.pending = [item for item in self.pending if item[0] > now]
+            for _, frame in due:
+                self.tx += frame
+                self.stats['frames_out'] += 1
+
+    def _advance_motion(self, dt):
+        motion = self.motion
+        if motion is None:
+            return
+        if motion['shift'] > 0.:
+            motion['shift'] -= dt
+            if motion['shift'] > 0.:
+                return
+            self.gear_slot = motion['index']
+            dt = -motion['shift']
+        step = min(motion['remaining'], motion['speed'] * dt)
+        motion['remaining'] -= step
+        index = motion['index']
+        self.positions[index] = max(0., self.positions[index]
+                                    + motion['direction'] * step)
+        if motion['remaining'] <= 0.:
+            self.motion = None
+
+    def _advance_assist(self, dt):
+        if self.assist_index < 0 or self.assist_pending <= 0.:
+            self.cont_assist_time = 0.
+            return
+        self.cont_assist_time += dt * 1000.
+        if self.faults.assist_slip:
+            return
+        step = min(self.assist_pending, self.assist_speed * dt)
+        self.assist_pending -= step
+        self.assist_pushed += step
+        while self.assist_pushed >= self.assist_push_length:
+            self.assist_pushed -= self.assist_push_length
+            self.feed_assist_count += 1
+
+    def _advance_dryer(self, dt):
+        dryer = self.dryer
+        if dryer['status'] == 'drying':
+            target = dryer['target_temp']
+            if self.temp < target:
+                self.temp = min(target, self.temp + self.heat_rate * dt)
+            dryer['remain_time'] = max(0., dryer['remain_time'] - dt)
+            if dryer['remain_time'] <= 0.:
+                self._stop_dryer()
+        elif self.temp > AMBIENT_TEMP:
+            self.temp = max(AMBIENT_TEMP, self.temp - self.heat_rate * dt)
+
+    def _stop_dryer(self):
+        self.dryer = {'status': 'stop', 'target_temp': 0, 'duration': 0,
+                      'remain_time': 0}
+        self.fan_speed = 0
+
+    # Framing ---------------------------------------------------------------
+
+    def _parse(self, now):
+        while True:
+            start = self.rx.find(FRAME_HEAD)
+            if start < 0:
+                # Keep a trailing 0xFF that may start the next header
+                del self.rx[:max(0, len(self.rx) - 1)]
+                return
+            del self.rx[:start]
+            if len(self.rx) < 4:
+                return
+            length = struct.unpack('<H', self.rx[2:4])[0]
+            if self.quirks and length > MAX_FRAME_LENGTH:
+                logging.info('ACE emulator: frame length %d, freezing', length)
+                self.frozen = True
+                return
+            end = 4 + length + 2
+            if len(self.rx) < end + 1:
+                return
+            payload = bytes(self.rx[4:4 + length])
+            crc = struct.unpack('<H', self.rx[4 + length:end])[0]
+            tail = self.rx.find(bytes([FRAME_TAIL]), end)
+            if tail < 0:
+                return
+            del self.rx[:tail + 1]
+            self.last_frame_time = now
+            if crc != calc_crc(payload):
+                self.stats['bad_crc'] += 1
+                continue
+            try:
+                request = json.loads(payload.decode('utf-8'))
+            except ValueError:
+                self.stats['bad_crc'] += 1
+                continue
+            self.stats['frames_in'] += 1
+            self._record('host', request, now)
+            if self.quirks and (self.tx or self.pending):
+                # Requests sent before the response was read clobber it
+                self.stats['lost_responses'] += len(self.pending) + bool(self.tx)
+                self.tx = bytearray()
+                self.pending = []
+            self._respond(request, now)
+
+    def _record(self, direction, frame, now):
+        if self.recorder is not None:
+            self.recorder.write(json.dumps(
+                {'t': round(now, 6), 'dir': direction, 'frame': frame}) + '\n')
+
+    def _respond(self, request, now):
+        method = request.get('method')
+        delay = self.faults.latency + self.random.uniform(
+            0., self.faults.latency_jitter)
+        recorded = self.replay.get(method)
+        if recorded:
+            response, delay = recorded.pop(0)
+            response = copy.deepcopy(response)
+            self.stats['replayed'] += 1
+        else:
+            handler = getattr(self, '_method_' + str(method), None)
+            if handler is None:
+                response = {'code': 1, 'msg': 'unknown method'}
+            else:
+                response = handler(request.get('params', {}))
+        response['id'] = request.get('id')
+        response.setdefault('code', 0)
+        response.setdefault('msg', 'success')
+        self._record('ace', response, now + delay)
+
+        frame = encode_frame(
+            response,
+            corrupt_crc=self.random.random() < self.faults.crc_rate)
+        if self.random.random() < self.faults.drop_rate:
+            cut = self.random.randrange(1, len(frame))
+            frame = frame[:cut] + frame[cut + self.random.randrange(1, 8):]
+            self.stats['dropped_bytes'] += 1
+        self.pending.append((now + delay, frame))
+
+    # Methods ---------------------------------------------------------------
+
+    def _status_slots(self):
+        return [{key: slot.get(key) for key in
+                 ('index', 'status', 'sku', 'brand', 'type', 'color', 'rfid')}
+                for slot in self.slots]
+
+    def _method_get_status(self, params):
+        action = None
+        if self.motion is not None:
+            action = 'shifting' if self.motion['shift'] > 0. else self.motion['action']
+        return {'result': {
+            'status': 'busy' if self.motion is not None else 'ready',
+            'action': action,
+            'dryer_status': dict(self.dryer),
+            'temp': round(self.temp),
+            'enable_rfid': self.enable_rfid,
+            'fan_speed': self.fan_speed,
+            'feed_assist_count': self.feed_assist_count,
+            'cont_assist_time': round(self.cont_assist_time, 1),
+            'slots': self._status_slots(),
+        }}
+
+    def _method_get_info(self, params):
+        return {'result': dict(self.info)}
+
+    def _method_get_filament_info(self, params):
+        index = params.get('index', -1)
+        if not 0 <= index < len(self.slots):
+            return {'code': 1, 'msg': 'invalid index'}
+        return {'result': copy.deepcopy(self.slots[index])}
+
+    def _method_enable_rfid(self, params):
+        self.enable_rfid = 1
+        return {}
+
+    def _method_disable_rfid(self, params):
+        self.enable_rfid = 0
+        return {}
+
+    def _start_motion(self, params, action, direction):
+        index = params.get('index', -1)
+        if not 0 <= index < len(self.slots):
+            return {'code': 1, 'msg': 'invalid index'}
+        if direction > 0 and self.slots[index]['status'] != 'ready':
+            return {'code': 1, 'msg': 'slot is empty'}
+        length = float(params.get('length', 0))
+        speed = float(params.get('speed', 25)) or 25.
+        if length < 0:
+            direction, length = -direction, -length
+        self.motion = {
+            'index': index, 'action': action, 'direction': direction,
+            'remaining': length, 'speed': speed,
+            'shift': self.feed_shift_time if index != self.gear_slot else 0.,
+        }
+        return {}
+
+    def _stop_motion(self, params, action):
+        if self.motion is not None and self.motion['action'] == action:
+            self.motion = None
+        return {}
+
+    def _update_speed(self, params, action):
+        if self.motion is not None and self.motion['action'] == action:
+            self.motion['speed'] = float(params.get('speed', self.motion['speed']))
+        return {}
+
+    def _method_feed_filament(self, params):
+        return self._start_motion(params, 'feeding', 1)
+
+    def _method_unwind_filament(self, params):
+        return self._start_motion(params, 'unwinding', -1)
+
+    def _method_stop_feed_filament(self, params):
+        return self._stop_motion(params, 'feeding')
+
+    def _method_stop_unwind_filament(self, params):
+        return self._stop_motion(params, 'unwinding')
+
+    def _method_update_feeding_speed(self, params):
+        return self._update_speed(params, 'feeding')
+
+    def _method_update_unwinding_speed(self, params):
+        return self._update_speed(params, 'unwinding')
+
+    def _method_start_feed_assist(self, params):
+        index = params.get('index', -1)
+        if not 0 <= index < len(self.slots):
+            return {'code': 1, 'msg': 'invalid index'}
+        self.assist_index = index
+        self.assist_pending = 0.
+        return {}
+
+    def _method_stop_feed_assist(self, params):
+        self.assist_index = -1
+        self.assist_pending = 0.
+        return {'msg': ''}
+
+    def _method_drying(self, params):
+        duration = int(params.get('duration', 240))
+        self.dryer = {
+            'status': 'drying',
+            'target_temp': params.get('temp', 50),
+            'duration': duration,
+            'remain_time': duration * 60.,
+        }
+        self.fan_speed = params.get('fan_speed', 7000)
+        return {'msg': 'drying'}
+
+    def _method_drying_stop(self, params):
+        self._stop_dryer()
+        return {}
+
+
+class SerialLink:
+    """
+    In-process stand-in for serial.Serial connected to an AceEmulator
+
+    Supports the subset BunnyAce uses: read(size), write(data), isOpen(),
+    close(). While the emulator is disconnected reads and writes raise
+    SerialException like a vanished USB device.
+    """
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self._open = True
+
+    def isOpen(self):
+        return self._open
+
+    is_open = property(isOpen)
+
+    def close(self):
+        self._open = False
+
+    def _check(self):
+        if not self._open or not self.emulator.connected:
+            raise SerialException('ACE emulator disconnected')
+
+    def write(self, data):
+        self._check()
+        self.emulator.receive(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        self._check()
+        self.emulator.poll()
+        return self.emulator.read_output(size)
+
+
+class PtyTransport:
+    """Exposes an AceEmulator on a PTY, recreated after each disconnect"""
+
+    def __init__(self, emulator, link, reconnect_delay=1., poll_interval=0.005):
+        self.emulator = emulator
+        self.link = link
+        self.reconnect_delay = reconnect_delay
+        self.poll_interval = poll_interval
+        self.master = None
+        self.slave = None
+
+    def _open(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave, termios.TCSANOW)
+        name = os.ttyname(self.slave)
+        if os.path.lexists(self.link):
+            os.unlink(self.link)
+        os.symlink(name, self.link)
+        logging.info('ACE emulator: listening on %s -> %s', self.link, name)
+
+    def _close(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def serve_forever(self):
+        self._open()
+        try:
+            while True:
+                ready, _, _ = select.select([self.master], [], [],
+                                            self.poll_interval)
+                if ready:
+                    try:
+                        data = os.read(self.master, 4096)
+                    except OSError:
+                        data = b''
+                    if data:
+                        self.emulator.receive(data)
+                self.emulator.poll()
+                output = self.emulator.read_output()
+                if output:
+                    os.write(self.master, output)
+                if not self.emulator.connected:
+                    self._close()
+                    time.sleep(self.reconnect_delay)
+                    self.emulator.reconnect()
+                    self._open()
+        finally:
+            self._close()
+            if os.path.lexists(self.link):
+                os.unlink(self.link)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE Pro emulator on a PTY')
+    parser.add_argument('--link', default='/tmp/ttyACE0',
+                        help='symlink created for the PTY slave')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='response delay in seconds')
+    parser.add_argument('--drop-rate', type=float, default=0.,
+                        help='probability of dropping bytes from a response')
+    parser.add_argument('--crc-rate', type=float, default=0.,
+                        help='probability of corrupting a response CRC')
+    parser.add_argument('--disconnect-rate', type=float, default=0.,
+                        help='spontaneous disconnects per second')
+    parser.add_argument('--assist-slip', action='store_true',
+                        help='feed assist never catches up (slip)')
+    parser.add_argument('--no-quirks', action='store_true',
+                        help='disable freeze, keepalive and ring buffer quirks')
+    parser.add_argument('--replay', help='answer from a recorded transcript')
+    parser.add_argument('--record', help='write a transcript of the session')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(message)s')
+    faults = Faults(drop_rate=args.drop_rate, crc_rate=args.crc_rate,
+                    disconnect_rate=args.disconnect_rate, latency=args.latency,
+                    assist_slip=args.assist_slip)
+    replay = Transcript.load(args.replay) if args.replay else None
+    recorder = open(args.record, 'w', buffering=1) if args.record else None
+    emulator = AceEmulator(faults=faults, seed=args.seed,
+                           quirks=not args.no_quirks, replay=replay,
+                           recorder=recorder)
+    try:
+        PtyTransport(emulator, args.link).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if recorder is not None:
+            recorder.close()
+        print(json.dumps(emulator.stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Fleet benchmark for ace-dashboard/ace-farm.py
+
+Starts N stand-in Moonraker servers on localhost, each speaking the part
+of the websocket JSON-RPC API the farm uses (server.info,
+printer.objects.subscribe, server.ace.snapshot and the
+notify_ace_status_update / notify_status_update notifications), with
+patches made by json_diff() of moonraker/ace_status.py. Then it measures:
+
+- how long the farm takes to connect to and sync every printer
+- the delay from a patch being sent until the farm's index has it
+- index queries against a scan over all mirrored printers
+
+    python3 tools/ace_farm_bench.py --printers 120 --updates 5000 --rate 1000
+    python3 tools/ace_farm_bench.py --printers 200 --gap-rate 0.01 --json farm.json
+
+At the end every mirror is compared with its stand-in and every query
+with the scan, a mismatch exits non-zero.
+"""
+
+import argparse
+import asyncio
+import copy
+import importlib.util
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'moonraker'))
+
+import ace_status
+
+
+def _load_farm():
+    # ace-farm.py is a script, its name is not importable
+    path = os.path.join(ROOT_DIR, 'ace-dashboard', 'ace-farm.py')
+    spec = importlib.util.spec_from_file_location('ace_farm', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+ace_farm = _load_farm()
+
+MATERIALS = ('PLA', 'PLA', 'PETG', 'PETG', 'ABS', 'ASA', 'TPU', 'PLA+')
+COLORS = ([0, 0, 0], [255, 255, 255], [200, 20, 20], [20, 60, 230], [30, 170, 60],
+          [250, 210, 20], [130, 130, 130], [250, 120, 10], [140, 40, 190])
+PRINT_STATES = ('standby', 'standby', 'printing', 'printing', 'printing',
+                'paused', 'complete', 'error')
+QUERIES = (
+    {'material': 'PETG', 'color': 'black', 'state': 'idle'},
+    {'material': 'PLA', 'state': 'idle', 'min_remaining': 100},
+    {'color': 'white', 'state': 'printing'},
+    {'material': 'TPU'},
+    {'material': 'ABS', 'color': 'red', 'state': 'idle', 'min_remaining': 30},
+    {'state': 'idle', 'min_remaining': 250},
+)
+
+
+class FakeMoonraker:
+    """One printer's Moonraker with an ACE, driven by mutate()"""
+
+    def __init__(self, name, rng):
+        self.name = name
+        self.rng = rng
+        self.version = rng.randrange(1, 1 << 30)
+        self.seq = 0
+        self.print_state = rng.choice(PRINT_STATES)
+        self.status = {
+            'status': 'ready',
+            'model': 'Anycubic Color Engine Pro',
+            'firmware': 'V1.3.84',
+            'dryer': {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0},
+            'temp': 25,
+            'filament_pos': 'nozzle',
+            'current_index': 0,
+            'slots': [self._random_slot(i) for i in range(4)],
+        }
+        self.clients = []
+        self.server = None
+        self.port = None
+        self.sent = {}      # seq -> perf_counter when sent
+        self.dropped = 0
+        self.last_dropped = False
+
+    def _random_slot(self, index):
+        rng = self.rng
+        if rng.random() < 0.15:
+            return {'index': index, 'status': 'empty', 'color': [0, 0, 0], 'type': '',
+                    'temp': 0, 'sku': '', 'rfid': 0}
+        slot = {'index': index, 'status': 'ready', 'color': list(rng.choice(COLORS)),
+                'type': rng.choice(MATERIALS), 'temp': rng.choice((200, 215, 240, 260)),
+                'sku': '', 'rfid': 0}
+        if rng.random() < 0.6:
+            slot.update(sku='AHPLBK-101', rfid=2, total=330., current=round(rng.uniform(5, 330), 1))
+        return slot
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+
+    async def _client(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            headers = dict((name.strip().lower(), value.strip()) for name, _, value in
+                           (line.partition(':') for line in
+                            request.decode('latin-1').split('\r\n')[1:] if line))
+            writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                          'Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n'
+                          % (ace_farm.accept_key(headers['sec-websocket-key']),)).encode())
+            self.clients.append(writer)
+            while True:
+                data = await ace_farm.read_message(reader, writer, mask=False)
+                if data is None:
+                    break
+                message = json.loads(data)
+                self._send(writer, {'jsonrpc': '2.0', 'id': message['id'],
+                                    'result': self._rpc(message['method'])})
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if writer in self.clients:
+                self.clients.remove(writer)
+            writer.close()
+
+    def _rpc(self, method):
+        if method == 'server.info':
+            return {'klippy_state': 'ready'}
+        if method == 'printer.objects.subscribe':
+            return {'eventtime': time.monotonic(),
+                    'status': {'print_stats': {'state': self.print_state}}}
+        if method == 'server.ace.snapshot':
+            return {'version': self.version, 'seq': self.seq,
+                    'status': copy.deepcopy(self.status)}
+        return {'error': 'unknown method %s' % (method,)}
+
+    def _send(self, writer, message):
+        writer.write(ace_farm.encode_frame(ace_farm.OP_TEXT, json.dumps(message).encode(),
+                                           mask=False))
+
+    def _broadcast(self, method, params):
+        for writer in self.clients:
+            self._send(writer, {'jsonrpc': '2.0', 'method': method, 'params': params})
+
+    def mutate(self, gap_rate=0., restart_rate=0.):
+        """One random change, returns the seq whose arrival is awaited or None"""
+        rng = self.rng
+        if rng.random() < restart_rate:
+            # Klippy restarted: new version, the empty patch makes clients resync
+            self.version += 1
+            self.seq = 0
+            self.last_dropped = False
+            self._broadcast('notify_ace_status_update',
+                            [{'version': self.version, 'seq': 0, 'patch': []}])
+            return None
+        roll = rng.random()
+        if roll < 0.1:
+            self.print_state = rng.choice(PRINT_STATES)
+            self._broadcast('notify_status_update',
+                            [{'print_stats': {'state': self.print_state}}, time.monotonic()])
+            return None
+        old = copy.deepcopy(self.status)
+        if roll < 0.2:
+            dryer = self.status['dryer']
+            drying = dryer['status'] != 'drying'
+            dryer.update(status='drying' if drying else 'stop',
+                         target_temp=55 if drying else 0, duration=240 if drying else 0)
+        elif roll < 0.4:
+            index = rng.randrange(4)
+            self.status['slots'][index] = self._random_slot(index)
+        else:
+            # Printing uses up filament
+            slot = self.status['slots'][rng.randrange(4)]
+            if 'current' in slot:
+                slot['current'] = round(max(0.1, slot['current'] - rng.uniform(0.1, 5)), 1)
+            self.status['temp'] = rng.randrange(24, 60)
+        patch = ace_status.json_diff(old, self.status)
+        if not patch:
+            return None
+        self.seq += 1
+        if rng.random() < gap_rate:
+            # Lost on the way: the next patch shows a gap
+            self.dropped += 1
+            self.last_dropped = True
+            return None
+        self.last_dropped = False
+        self.sent[self.seq] = time.perf_counter()
+        self._broadcast('notify_ace_status_update',
+                        [{'version': self.version, 'seq': self.seq, 'patch': patch}])
+        return self.seq
+
+
+def scan(farm, material=None, color=None, state=None, min_remaining=None):
+    """What a query costs without the index: every slot of every printer"""
+    found = []
+    for link in farm.printers.values():
+        if state and link.state != state:
+            continue
+        for info in ace_farm.slot_infos(link.name, link.status):
+            if material and info.material != ace_farm.material_key(material):
+                continue
+            if color and info.color != ace_farm.color_key(color):
+                continue
+            if min_remaining and (info.remaining is None or info.remaining < min_remaining):
+                continue
+            found.append(info)
+    return found
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _time_queries(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in QUERIES:
+            function(**query)
+    return (time.perf_counter() - start) / (repeat * len(QUERIES))
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    fakes = [FakeMoonraker('printer-%03d' % (i,), random.Random(rng.random()))
+             for i in range(args.printers)]
+    await asyncio.gather(*(fake.start() for fake in fakes))
+    by_name = {fake.name: fake for fake in fakes}
+
+    farm = ace_farm.Farm(args.max_connecting)
+    for fake in fakes:
+        farm.add_printer(fake.name, '127.0.0.1', fake.port)
+
+    latencies = []
+    synced = asyncio.Event()
+
+    def listener(link):
+        sent = by_name[link.name].sent.pop(link.seq, None)
+        if sent is not None:
+            latencies.append(time.perf_counter() - sent)
+        if not synced.is_set() and all(l.status is not None for l in farm.printers.values()):
+            synced.set()
+
+    farm.listeners.append(listener)
+    start = time.perf_counter()
+    farm.start()
+    await asyncio.wait_for(synced.wait(), args.timeout)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        rng.choice(fakes).mutate(args.gap_rate, args.restart_rate)
+        if args.rate:
+            await asyncio.sleep(1. / args.rate)
+        else:
+            await asyncio.sleep(0)
+    # A lost last patch only shows as a gap once the next one arrives
+    for fake in fakes:
+        while fake.last_dropped:
+            fake.mutate()
+    # Drain: patches in flight and resyncs after gaps
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        pending = any(fake.sent for fake in fakes)
+        stale = any(link.status is None or link.version != by_name[link.name].version
+                    or link.seq != by_name[link.name].seq for link in farm.printers.values())
+        if not pending and not stale:
+            break
+        await asyncio.sleep(0.01)
+    update_time = time.perf_counter() - start
+
+    mismatched = [link.name for link in farm.printers.values()
+                  if link.status != by_name[link.name].status
+                  or link.print_state != by_name[link.name].print_state]
+    inconsistent = []
+    for query in QUERIES:
+        key = lambda i: (i.printer, i.slot)
+        if sorted(farm.find(**query), key=key) != sorted(scan(farm, **query), key=key):
+            inconsistent.append(query)
+
+    index_time = _time_queries(farm.find, args.query_repeat)
+    scan_time = _time_queries(lambda **q: scan(farm, **q), max(1, args.query_repeat // 100))
+    example = farm.find(**QUERIES[0])
+
+    await farm.stop()
+    await asyncio.gather(*(fake.stop() for fake in fakes))
+
+    return {
+        'printers': args.printers,
+        'startup_time': round(startup, 3),
+        'updates': args.updates,
+        'update_time': round(update_time, 3),
+        'patches_delivered': len(latencies),
+        'patches_dropped': sum(fake.dropped for fake in fakes),
+        'resyncs': sum(link.resyncs for link in farm.printers.values()),
+        'latency_p50_ms': round(1000 * (_percentile(latencies, 0.5) or 0), 3),
+        'latency_p95_ms': round(1000 * (_percentile(latencies, 0.95) or 0), 3),
+        'latency_max_ms': round(1000 * max(latencies or [0]), 3),
+        'latency_mean_ms': round(1000 * statistics.mean(latencies or [0]), 3),
+        'loaded_slots': len(farm.index.slots),
+        'query_index_us': round(1e6 * index_time, 2),
+        'query_scan_us': round(1e6 * scan_time, 2),
+        'idle_black_petg': sorted(set(info.printer for info in example)),
+        'mismatched_printers': mismatched,
+        'inconsistent_queries': inconsistent,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ACE farm aggregator benchmark')
+    parser.add_argument('--printers', type=int, default=120)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=1000.,
+                        help='updates per second over the whole farm, 0 = as fast as possible')
+    parser.add_argument('--gap-rate', type=float, default=0.002,
+                        help='fraction of patches lost, each forces a resync')
+    parser.add_argument('--restart-rate', type=float, default=0.001,
+                        help='fraction of updates that are a Klippy restart')
+    parser.add_argument('--max-connecting', type=int, default=ace_farm.DEFAULT_MAX_CONNECTING)
+    parser.add_argument('--query-repeat', type=int, default=2000)
+    parser.add_argument('--timeout', type=float, default=30.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    for key, value in result.items():
+        if key != 'idle_black_petg':
+            print('%-22s %s' % (key, value))
+    print('%-22s %s' % ('idle_black_petg', ', '.join(result['idle_black_petg']) or '-'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    sys.exit(1 if result['mismatched_printers'] or result['inconsistent_queries'] else 0)
+
+
+if __name__ == '__main__':
+    main()